@@ -0,0 +1,122 @@
+""" Benchmark load generator
+
+A closed-loop asyncio HTTP/1.1 client: each of concurrency connections sends
+a request, reads the whole response and sends the next one until the
+duration is over. With keepalive the connections are reused, otherwise a
+new connection is opened (and timed) for every request, as ab does without
+-k. With a depth over 1 each write pipelines that many requests, and every
+response counts from the write. Latencies are recorded in a Histogram in
+microseconds
+"""
+
+import asyncio
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path: sys.path.insert(0, ROOT)
+
+from histogram import Histogram
+
+__all__ = ["Result", "run"]
+
+# Seconds a response may take before it counts as an error
+TIMEOUT = 10.0
+
+
+class Result(object):
+    """Counts of a load run"""
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.statuses = {}
+        self.received = 0
+        self.latency = Histogram()
+
+    def summary(self, duration):
+        """returns the counts as a dictionary (latencies in milliseconds)"""
+        p50, p90, p99, p999 = self.latency.percentiles()
+        return {'requests': self.requests, 'rps': self.requests / duration,
+                'errors': self.errors, 'statuses': dict((str(code), n)
+                    for code, n in sorted(self.statuses.items())),
+                'received_bytes': self.received,
+                'latency_ms': {'p50': p50 / 1000.0, 'p90': p90 / 1000.0,
+                    'p99': p99 / 1000.0, 'p99.9': p999 / 1000.0,
+                    'max': self.latency.max / 1000.0}}
+
+
+async def read_response(reader):
+    """Reads a response; returns its status code, the number of bytes read
+and whether the server closes the connection"""
+    head = await reader.readuntil(b'\r\n\r\n')
+    lines = head.split(b'\r\n')
+    code = int(lines[0].split(b' ', 2)[1])
+    length, chunked, close = None, False, False
+    for line in lines[1:]:
+        name, _, value = line.partition(b':')
+        name, value = name.strip().lower(), value.strip().lower()
+        if name == b'content-length': length = int(value)
+        elif name == b'transfer-encoding': chunked = value == b'chunked'
+        elif name == b'connection': close = value == b'close'
+    size = len(head)
+    if chunked:
+        while True:
+            line = await reader.readuntil(b'\r\n')
+            n = int(line.split(b';', 1)[0], 16)
+            await reader.readexactly(n + 2)
+            size += len(line) + n + 2
+            if n == 0: break
+    elif length is not None:
+        size += len(await reader.readexactly(length))
+    else:
+        # NOTE: The body is delimited by closing the connection
+        size += len(await reader.read())
+        close = True
+    return code, size, close
+
+
+async def client(port, request, keepalive, depth, deadline, result):
+    writer = None
+    while time.time() < deadline:
+        started = time.perf_counter()
+        try:
+            if writer is None:
+                reader, writer = await asyncio.wait_for(
+                        asyncio.open_connection('127.0.0.1', port), TIMEOUT)
+            writer.write(request * depth)
+            for _ in range(depth):
+                code, size, close = await asyncio.wait_for(
+                        read_response(reader), TIMEOUT)
+                result.requests += 1
+                result.received += size
+                result.statuses[code] = result.statuses.get(code, 0) + 1
+                if code >= 400: result.errors += 1
+                result.latency.record((time.perf_counter() - started) * 1e6)
+                # NOTE: The requests after a closing response are not answered
+                if close: break
+        except (OSError, ValueError, IndexError, asyncio.IncompleteReadError,
+                asyncio.LimitOverrunError, asyncio.TimeoutError):
+            result.errors += 1
+            close = True
+        if close or not keepalive:
+            if writer is not None: writer.close()
+            writer = None
+    if writer is not None: writer.close()
+
+
+async def generate(port, path, keepalive, concurrency, duration, depth):
+    result = Result()
+    request = 'GET {0} HTTP/1.1\r\nHost: localhost\r\n{1}\r\n'.format(path,
+            '' if keepalive else 'Connection: close\r\n').encode()
+    deadline = time.time() + duration
+    await asyncio.gather(*[client(port, request, keepalive, depth, deadline,
+        result) for _ in range(concurrency)])
+    return result
+
+
+def run(port, path, keepalive=True, concurrency=16, duration=5.0, depth=1):
+    """Loads the server at port with GET requests of path, depth of them
+pipelined at a time; returns a Result"""
+    return asyncio.run(generate(port, path, keepalive, concurrency, duration,
+        depth))
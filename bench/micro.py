@@ -0,0 +1,261 @@
+#!/usr/bin/env python
+"""HttpHandler microbenchmarks
+
+Measures the stages of answering a request without sockets or a server
+process. A FakeConnection feeds canned request bytes to the handler and
+takes what it sends back, and an OfflineServer provides the caches and
+metrics of a server configured by server.conf. For each stage, for parsing
+requests that arrive in small reads and for whole requests through
+HttpHandler.handle(), it prints the time per request and
+the memory it allocates: the peak of the bytes traced by tracemalloc while
+it runs and the memory blocks still held once it returned (CPython does not
+count allocations, so short-lived ones only show in the peak).
+Run it with python -O to leave out recording statistics.
+Usage: python bench/micro.py [requests] [stage,...]
+"""
+from __future__ import print_function
+
+import errno
+import gc
+import os
+import sys
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path: sys.path.insert(0, ROOT)
+
+import config
+import server
+
+__all__ = ["FakeConnection", "OfflineServer", "stages", "measure"]
+
+REQUEST = (b'GET /index.html HTTP/1.1\r\nHost: localhost:8000\r\n'
+        b'User-Agent: bench/1.0\r\nAccept: */*\r\n'
+        b'Accept-Language: en-US,en;q=0.5\r\n\r\n')
+# A request with 80 header fields and an 8 KiB cookie
+LARGE = REQUEST[:-2] + b''.join(b'X-Header-' + str(i).encode() + b': value\r\n'
+        for i in range(80)) + b'Cookie: ' + b'c' * 8192 + b'\r\n\r\n'
+
+
+class FakeConnection(object):
+    """In-memory stand-in for a connected socket. recv() returns the loaded
+request bytes (b'' once they were read, as if the client closed); what is
+sent is kept in output if capture is set and counted in sent either way"""
+    def __init__(self, data=b'', capture=True):
+        self.capture = capture
+        self.output = []
+        self.sent = 0
+        self.load(data)
+
+    def load(self, data):
+        """Sets the bytes the next recv() calls return"""
+        self.input = data
+        self.offset = 0
+
+    def recv(self, size):
+        data = self.input[self.offset:self.offset + size]
+        self.offset += len(data)
+        return data
+
+    def send(self, data):
+        if self.capture: self.output.append(bytes(data))
+        self.sent += len(data)
+        return len(data)
+
+    def sendmsg(self, buffers):
+        n = 0
+        for data in buffers: n += self.send(data)
+        return n
+
+    def fileno(self):
+        # NOTE: Makes FileBody items fall back from sendfile(2) to send()
+        raise OSError(errno.ENOTSOCK, os.strerror(errno.ENOTSOCK))
+
+    def gettimeout(self):
+        return None
+
+    def close(self):
+        pass
+
+    def received(self):
+        """returns and clears what was captured"""
+        data = b''.join(self.output)
+        self.output = []
+        return data
+
+
+class OfflineServer(server.CachesMixIn):
+    """The configuration, caches and metrics of a server without a socket,
+for handlers driven by a FakeConnection"""
+    def __init__(self, config_filename=os.path.join(ROOT, 'server.conf')):
+        self.cfg = config.Config()
+        self.cfg.file(config_filename)
+        self.setup_caches()
+        self.setup_metrics()
+        self.cgi_pool = None
+
+    def handler(self, data=b'', capture=True):
+        """returns an HttpHandler on a FakeConnection loaded with data"""
+        return server.HttpHandler(FakeConnection(data, capture),
+                ('127.0.0.1', 0), self, self.cfg)
+
+
+def parse(parser, chunks):
+    """Feeds chunks to parser as reads of a connection; returns the number of
+requests parsed"""
+    line = None
+    requests = 0
+    for chunk in chunks:
+        parser.feed(chunk)
+        while True:
+            if line is None:
+                line = parser.parse_request_line()
+                if line is None: break
+            if parser.parse_headers() is None: break
+            requests += 1
+            line = None
+    return requests
+
+
+def split(data, size):
+    """returns data in pieces of size bytes"""
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+def stages(srv, path='/index.html'):
+    """returns (name, setup, run, requests) of each stage, run on a single
+handler; setup is not measured and run answers requests requests"""
+    h = srv.handler(capture=False)
+    parser, conn = h._parser, h.conn
+    request = REQUEST.replace(b'/index.html', path.encode())
+    pipelined = request * 16
+    trickled = split(request, 16)
+    large = split(LARGE, 512)
+
+    def fresh():
+        h.discard()
+        h.refresh()
+        parser.reset()
+        parser.feed(request)
+
+    def status_line():
+        h.status_line_recieved()
+        h.status_line_parse()
+
+    def request_line():
+        fresh()
+        parser.parse_request_line()
+
+    def headers():
+        h.headers_recieved()
+        h.headers_parse()
+
+    def parsed():
+        fresh()
+        status_line()
+
+    def validate_path():
+        h.validate_path(path)
+
+    def new_response():
+        h._response = b''
+
+    def add_response():
+        h.add_response(200, 'OK')
+
+    def resolved():
+        parsed()
+        h.validate_path()
+
+    def parse_trickled():
+        parse(parser, trickled)
+
+    def parse_large():
+        parse(parser, large)
+
+    def load():
+        conn.load(request)
+
+    def load_pipelined():
+        conn.load(pipelined)
+
+    def handle():
+        h.handle()
+        h.send()
+
+    return [('status_line_parse', fresh, status_line, 1),
+            ('headers_parse', request_line, headers, 1),
+            ('parse 16 B reads', parser.reset, parse_trickled, 1),
+            ('parse large, 512 B', parser.reset, parse_large, 1),
+            ('validate_path', parsed, validate_path, 1),
+            ('add_response', new_response, add_response, 1),
+            ('queue_file', resolved, h.queue_file, 1),
+            ('handle', load, handle, 1),
+            ('handle x16 pipelined', load_pipelined, handle, 16)]
+
+
+def measure(setup, run, n=10000, per=1):
+    """Runs setup and run n times; returns the median and mean ns, the peak
+bytes allocated and the blocks kept per request of run"""
+    clock = time.perf_counter_ns
+    for _ in range(min(n, 1000)):
+        setup()
+        run()
+    # NOTE: The cost of reading the clock is subtracted
+    overhead = None
+    for _ in range(1000):
+        started = clock()
+        elapsed = clock() - started
+        if overhead is None or elapsed < overhead: overhead = elapsed
+    samples = [0] * n
+    gc.disable()
+    try:
+        for i in range(n):
+            setup()
+            started = clock()
+            run()
+            samples[i] = clock() - started - overhead
+        blocks = 0
+        for _ in range(1000):
+            setup()
+            before = sys.getallocatedblocks()
+            run()
+            blocks += sys.getallocatedblocks() - before
+        tracemalloc.start()
+        peak = 0
+        for _ in range(100):
+            setup()
+            tracemalloc.reset_peak()
+            current = tracemalloc.get_traced_memory()[0]
+            run()
+            peak += tracemalloc.get_traced_memory()[1] - current
+        tracemalloc.stop()
+    finally:
+        gc.enable()
+    samples.sort()
+    return (samples[n // 2] / float(per), sum(samples) / float(n * per),
+            peak / 100.0 / per, blocks / 1000.0 / per)
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    selected = sys.argv[2].split(',') if len(sys.argv) > 2 else None
+    srv = OfflineServer()
+    # NOTE: Checks that the canned requests are answered as expected
+    h = srv.handler(REQUEST * 2)
+    h.handle()
+    h.send()
+    statuses = h.conn.received().count(b'HTTP/1.1 200 OK\r\n')
+    if statuses != 2:
+        sys.exit("Expected 2 responses with status 200, got {0}".format(statuses))
+    print("{:<22} {:>10} {:>10} {:>12} {:>11}".format('stage', 'median ns',
+        'mean ns', 'peak B/req', 'blocks/req'))
+    for name, setup, run, per in stages(srv):
+        if selected and name not in selected: continue
+        median, mean, peak, blocks = measure(setup, run, n, per)
+        print("{:<22} {:>10.0f} {:>10.0f} {:>12.0f} {:>11.2f}".format(name,
+            median, mean, peak, blocks))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+"""Server benchmark suite
+
+Starts each backend on an ephemeral port and loads it with the workloads
+below, over persistent connections (keep-alive), with a new connection per
+request (close) and pipelining requests on persistent connections
+(pipelined). A backend is a server class, optionally with a variant:
+ForkingServer/prefork pre-forks a worker per connection of the load, and
+/cgi-pool runs CGI scripts in a worker pool. Requests per second, latency
+percentiles, errors, CPU time and resident memory of the server's processes
+are printed and saved as JSON. Compare mode flags the workloads whose requests per second dropped,
+whose p99 latency rose by more than threshold percent, or that had more
+errors than in a baseline.
+Run it with python -O to leave out publishing statistics, as in production.
+Usage: python bench/run.py [output] [duration] [concurrency] [backend,...]
+       python bench/run.py compare <baseline> <results> [threshold]
+"""
+from __future__ import print_function
+
+import json
+import os
+import platform
+import subprocess
+import sys
+import threading
+import time
+
+import loadgen
+import servers
+
+# Name and path of each workload, each run in every mode
+WORKLOADS = [('small', '/index.html'), ('large', '/large.bin'),
+        ('listing', '/pic/'), ('cgi', '/cgi-bin/script.py')]
+# Name, keep-alive and requests pipelined per write of each mode
+MODES = [('keep-alive', True, 1), ('close', False, 1), ('pipelined', True, 16)]
+DEFAULT_BACKENDS = ['ForkingServer', 'ForkingServer/prefork',
+        'NonBlockingServer', 'AsyncServer']
+# Workers of the CGI pool of /cgi-pool backends
+CGI_POOL_SIZE = 4
+# Seconds of load before measuring each workload
+WARMUP = 0.5
+ROW = "{:<26} {:<18} {:>9} {:>7} {:>9} {:>9} {:>7} {:>9}"
+
+
+def commit():
+    """returns the current git commit or None"""
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                cwd=servers.ROOT, stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def site(backend, concurrency):
+    """returns the Site a backend serves"""
+    variant = servers.split(backend)[1]
+    # NOTE: Each persistent connection holds a pre-forked worker
+    if variant == 'prefork': return servers.Site(workers=concurrency)
+    if variant == 'cgi-pool': return servers.Site(cgi_pool=CGI_POOL_SIZE)
+    return servers.Site()
+
+
+def measure(srv, path, keepalive, concurrency, duration, depth=1):
+    """Loads a server with one workload; returns the summary of the run with
+the CPU time and peak memory of the server's processes"""
+    loadgen.run(srv.port, path, keepalive, concurrency, WARMUP, depth)
+    peak = [srv.sample()[1]]
+    done = threading.Event()
+    def sample_memory():
+        while not done.wait(0.25):
+            peak[0] = max(peak[0], srv.sample()[1])
+    sampler = threading.Thread(target=sample_memory)
+    sampler.start()
+    cpu = srv.sample()[0]
+    started = time.time()
+    try:
+        result = loadgen.run(srv.port, path, keepalive, concurrency, duration,
+                depth)
+    finally:
+        done.set()
+        sampler.join()
+    elapsed = time.time() - started
+    cpu = srv.sample()[0] - cpu
+    summary = result.summary(elapsed)
+    summary.update({'cpu_seconds': cpu, 'cpu_percent': 100.0 * cpu / elapsed,
+        'rss_kib': peak[0]})
+    return summary
+
+
+def run(backends, concurrency, duration):
+    """Runs every workload on every backend; returns the results document"""
+    results = []
+    print(ROW.format('backend', 'workload', 'RPS', 'errors', 'p50 ms',
+        'p99 ms', 'CPU %', 'RSS KiB'))
+    for backend in backends:
+        served = site(backend, concurrency)
+        try:
+            srv = servers.Server(backend, served)
+            try:
+                for name, path in WORKLOADS:
+                    for mode, keepalive, depth in MODES:
+                        workload = '{0}/{1}'.format(name, mode)
+                        summary = measure(srv, path, keepalive, concurrency,
+                                duration, depth)
+                        summary.update({'backend': backend,
+                            'workload': workload, 'path': path})
+                        results.append(summary)
+                        print(ROW.format(backend, workload,
+                            '{0:.1f}'.format(summary['rps']), summary['errors'],
+                            '{0:.3f}'.format(summary['latency_ms']['p50']),
+                            '{0:.3f}'.format(summary['latency_ms']['p99']),
+                            '{0:.0f}'.format(summary['cpu_percent']),
+                            summary['rss_kib']))
+            finally:
+                srv.stop()
+        finally:
+            served.close()
+    return {'meta': {'time': time.time(), 'commit': commit(),
+        'python': platform.python_version(), 'platform': platform.platform(),
+        'cpus': os.cpu_count(), 'statistics': __debug__,
+        'concurrency': concurrency, 'duration': duration}, 'results': results}
+
+
+def compare(baseline, current, threshold=10.0):
+    """Prints the changes of every workload of current (a results document)
+present in baseline; returns the (backend, workload) pairs that regressed"""
+    if baseline['meta'].get('statistics') != current['meta'].get('statistics'):
+        print("* Warning: only one of the runs published statistics")
+    before = dict(((r['backend'], r['workload']), r)
+            for r in baseline['results'])
+    regressions = []
+    print("{:<26} {:<18} {:>9} {:>9} {:>7}".format('backend', 'workload',
+        'RPS', 'p99', 'errors'))
+    for result in current['results']:
+        key = (result['backend'], result['workload'])
+        old = before.get(key)
+        if old is None: continue
+        rps = change(old['rps'], result['rps'])
+        p99 = change(old['latency_ms']['p99'], result['latency_ms']['p99'])
+        regressed = rps < -threshold or p99 > threshold or \
+                result['errors'] > old['errors']
+        if regressed: regressions.append(key)
+        print("{:<26} {:<18} {:>+8.1f}% {:>+8.1f}% {:>7} {}".format(key[0],
+            key[1], rps, p99, result['errors'] - old['errors'],
+            'REGRESSION' if regressed else ''))
+    return regressions
+
+
+def change(old, new):
+    """returns the change from old to new in percent"""
+    if not old: return 0.0 if not new else float('inf')
+    return 100.0 * (new - old) / old
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == 'compare':
+        with open(sys.argv[2]) as f:
+            baseline = json.load(f)
+        with open(sys.argv[3]) as f:
+            current = json.load(f)
+        threshold = float(sys.argv[4]) if len(sys.argv) > 4 else 10.0
+        regressions = compare(baseline, current, threshold)
+        print("* {0} regressions over {1:g}%".format(len(regressions), threshold))
+        sys.exit(1 if regressions else 0)
+    output = sys.argv[1] if len(sys.argv) > 1 else 'bench-results.json'
+    duration = float(sys.argv[2]) if len(sys.argv) > 2 else 5
+    concurrency = int(sys.argv[3]) if len(sys.argv) > 3 else 16
+    backends = sys.argv[4].split(',') if len(sys.argv) > 4 else DEFAULT_BACKENDS
+    for backend in backends:
+        name, variant = servers.split(backend)
+        if name not in servers.BACKENDS or variant not in [''] + servers.VARIANTS:
+            sys.exit("Unknown backend {0}".format(backend))
+        if variant == 'prefork' and name != 'ForkingServer':
+            sys.exit("Only ForkingServer pre-forks workers")
+    document = run(backends, concurrency, duration)
+    with open(output, 'w') as f:
+        json.dump(document, f, indent=2)
+    print("* Saved {0} results to {1}".format(len(document['results']), output))
+
+if __name__ == '__main__':
+    main()
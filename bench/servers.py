@@ -0,0 +1,152 @@
+""" Benchmark servers
+
+Starts the backends of server.py on an ephemeral port, serving a copy of www
+with an added large file, and samples the CPU time and memory of a server
+and of the processes it forked (workers, per connection processes and CGI
+scripts) from /proc. A backend is the name of a server class, optionally
+followed by a variant: /prefork for pre-forked workers or /cgi-pool for a
+CGI worker pool
+"""
+
+import configparser
+import os
+import shutil
+import signal
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path: sys.path.insert(0, ROOT)
+
+import server
+
+__all__ = ["BACKENDS", "VARIANTS", "Site", "Server", "split"]
+
+BACKENDS = ['ForkingServer', 'NonBlockingServer', 'AsyncServer',
+        'AsyncioServer']
+VARIANTS = ['prefork', 'cgi-pool']
+
+# Size of the large file of the workloads
+LARGE_FILE = 1048576
+
+
+def split(backend):
+    """returns the server class name and the variant ('' for none) of a
+backend"""
+    name, _, variant = backend.partition('/')
+    return name, variant
+
+
+class Site(object):
+    """A temporary public directory (a copy of www with large.bin) and a
+config file based on server.conf that serves it with workers pre-forked
+workers and a CGI pool of cgi_pool workers (0 for none)"""
+    def __init__(self, workers=0, cgi_pool=0):
+        self.root = tempfile.mkdtemp(prefix='bistro-bench-')
+        self.public = os.path.join(self.root, 'www')
+        shutil.copytree(os.path.join(ROOT, 'www'), self.public,
+                ignore=shutil.ignore_patterns('__pycache__'))
+        with open(os.path.join(self.public, 'large.bin'), 'wb') as f:
+            f.write(os.urandom(LARGE_FILE))
+        cfg = configparser.ConfigParser()
+        cfg.read(os.path.join(ROOT, 'server.conf'))
+        if 'server' not in cfg: cfg['server'] = {}
+        cfg['server'].update({'host': '127.0.0.1', 'port': '0',
+            'public_dir': self.public,
+            'cgi_dir': os.path.join(self.public, 'cgi-bin'),
+            'workers': str(workers), 'cgi_pool_size': str(cgi_pool),
+            'cgi_pool_max_requests': '0'})
+        self.config = os.path.join(self.root, 'server.conf')
+        with open(self.config, 'w') as f:
+            cfg.write(f)
+
+    def close(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+
+class Server(object):
+    """A backend serving a Site in a forked process"""
+    def __init__(self, backend, site):
+        self.backend = backend
+        name = split(backend)[0]
+        # NOTE: The server is created (and its socket bound) before forking,
+        # so that the port is known here
+        if name == 'AsyncServer':
+            srv = server.AsyncServer(site.config, ('127.0.0.1', 0))
+            srv.init_socket()
+            self.port = srv.server_port
+        else:
+            srv = getattr(server, name)(site.config)
+            self.port = srv.socket.getsockname()[1]
+        # The CGI pool is run by this process, not the forked server
+        self.cgi_pool = srv.cgi_pool
+        self.pid = os.fork()
+        if self.pid == 0:
+            os.setpgid(0, 0)
+            devnull = os.open(os.devnull, os.O_WRONLY)
+            os.dup2(devnull, 1)
+            code = 0
+            try:
+                srv.serve_persistent()
+            except BaseException:
+                code = 1
+            finally:
+                os._exit(code)
+        srv.socket.close()
+
+    def stop(self, timeout=5.0):
+        """Terminates the server (a pre-forking one stops its workers), killing
+it if it did not exit within timeout seconds, and then any process it left"""
+        try:
+            os.kill(self.pid, signal.SIGTERM)
+        except OSError:
+            pass
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if os.waitpid(self.pid, os.WNOHANG)[0]: break
+            time.sleep(0.05)
+        else:
+            os.killpg(self.pid, signal.SIGKILL)
+            os.waitpid(self.pid, 0)
+        try:
+            os.killpg(self.pid, signal.SIGKILL)
+        except OSError:
+            pass
+        if self.cgi_pool is not None: self.cgi_pool.close()
+
+    def processes(self):
+        """returns the /proc stat fields of the server, its CGI pool workers
+and every process they forked, by pid"""
+        stats = {}
+        for name in os.listdir('/proc'):
+            if not name.isdigit(): continue
+            try:
+                with open('/proc/{0}/stat'.format(name)) as f:
+                    data = f.read()
+            except (IOError, OSError):
+                continue
+            # NOTE: The command name may hold spaces; it is in parentheses
+            stats[int(name)] = data[data.rindex(')') + 2:].split()
+        tree, added = {self.pid}, True
+        if self.cgi_pool is not None:
+            tree.update(w.pid for w in list(self.cgi_pool.workers))
+        while added:
+            added = False
+            for pid, fields in stats.items():
+                if pid not in tree and int(fields[1]) in tree:
+                    tree.add(pid)
+                    added = True
+        return dict((pid, stats[pid]) for pid in tree if pid in stats)
+
+    def sample(self):
+        """returns the CPU seconds used by the server and its processes so far
+(those that exited included, once reaped) and their resident memory in KiB"""
+        ticks = os.sysconf('SC_CLK_TCK')
+        page = os.sysconf('SC_PAGE_SIZE') // 1024
+        cpu, rss = 0, 0
+        for pid, fields in self.processes().items():
+            # utime, stime, cutime and cstime; rss in pages
+            cpu += sum(int(v) for v in fields[11:15])
+            rss += int(fields[21]) * page
+        return float(cpu) / ticks, rss
@@ -0,0 +1,156 @@
+""" Cache module
+
+Bounded caches used by the HTTP handler to skip repeated filesystem work
+"""
+
+import time
+from collections import namedtuple, OrderedDict
+
+__all__ = ["Resolution", "PathCache", "CachedResponse", "ResponseCache"]
+
+# Kinds of request path resolutions
+FILE = 'file'
+CGI = 'cgi'
+DIRECTORY = 'directory' # Directory without an index file
+MISSING = 'missing'
+
+# The result of resolving a request path on the filesystem. path is the
+# resolved file (or index file); size, mtime, mime, etag and encodings (the
+# precompressed sidecar files by content coding) are only set for files
+Resolution = namedtuple('Resolution', ['kind', 'path', 'size', 'mtime', 'mime',
+        'etag', 'encodings'])
+
+# A rendered response: the serialized headers that do not change between
+# requests (i.e. everything but Date and Connection) and the body
+CachedResponse = namedtuple('CachedResponse', ['mtime', 'headers', 'body'])
+
+
+class PathCache(object):
+    """LRU cache of request path resolutions.
+
+Entries (negative ones included) expire ttl seconds after they were
+resolved, so a changed file is picked up after at most ttl seconds"""
+    def __init__(self, size=1024, ttl=2.0):
+        """size is the maximum number of entries; 0 disables the cache"""
+        self.size = size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """Returns the Resolution cached for key or None"""
+        try:
+            entry, expires = self._entries[key]
+        except KeyError:
+            self.misses += 1
+            return None
+        if expires < time.time():
+            del self._entries[key]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry
+
+    def put(self, key, entry):
+        """Caches entry under key, evicting the least recently used entry"""
+        if self.size <= 0: return
+        self._entries[key] = (entry, time.time() + self.ttl)
+        self._entries.move_to_end(key)
+        if len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        """Drops all entries and resets the counters"""
+        self._entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get_counters(self):
+        """Returns a dictionary with the cache counters"""
+        return {'entries': len(self._entries), 'hits': self.hits,
+                'misses': self.misses}
+
+
+class ResponseCache(object):
+    """LRU cache of rendered file responses bounded by a byte budget.
+
+Entries are stored with the mtime of the file they were rendered from and
+are dropped once a request resolves the file to a different mtime"""
+    def __init__(self, size, max_file=65536):
+        """size is the byte budget (0 disables the cache); files larger than
+max_file bytes are never cached"""
+        self.size = size
+        self.max_file = max_file if size > 0 else 0
+        self.used = 0
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def enabled(self):
+        return self.size > 0
+
+    def get(self, key, mtime):
+        """Returns the CachedResponse for key if it is still current or None"""
+        try:
+            entry = self._entries[key]
+        except KeyError:
+            self.misses += 1
+            return None
+        if entry.mtime != mtime:
+            self._remove(key)
+            self.invalidations += 1
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry
+
+    def put(self, key, mtime, headers, body):
+        """Caches a rendered response, evicting least recently used entries
+until it fits in the budget"""
+        cost = len(headers) + len(body)
+        if len(body) > self.max_file or cost > self.size: return
+        if key in self._entries: self._remove(key)
+        while self.used + cost > self.size:
+            self._remove(next(iter(self._entries)))
+        self._entries[key] = CachedResponse(mtime, headers, body)
+        self.used += cost
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self.used -= len(entry.headers) + len(entry.body)
+
+    def clear(self):
+        """Drops all entries and resets the counters"""
+        self._entries.clear()
+        self.used = 0
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get_counters(self):
+        """Returns a dictionary with the cache counters"""
+        return {'entries': len(self._entries), 'bytes': self.used,
+                'hits': self.hits, 'misses': self.misses,
+                'invalidations': self.invalidations}
+
+
+def test():
+    """Creates a small cache and prints its counters"""
+    c = PathCache(2)
+    c.put('/a', Resolution(MISSING, '/a', None, None, None, None, None))
+    c.get('/a')
+    c.get('/b')
+    print(c.get_counters())
+
+if __name__ == "__main__":
+    test()
@@ -0,0 +1,306 @@
+""" CGI worker pool module
+
+Runs Python CGI scripts in a pool of long-lived worker processes, so that a
+request does not pay for starting an interpreter. The server talks to the
+workers over a unix socket with a FastCGI-like protocol: every record is a
+type byte and a 4-byte length followed by that many bytes of data. A
+request is sent as a PARAMS record and STDIN records ended by an empty one;
+the worker answers with STDOUT and STDERR records and a final END record
+Usage (started by Pool): python cgipool.py <fd> <max_requests> <idle>
+"""
+
+from __future__ import print_function
+
+import atexit
+import io
+import os
+import select
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import traceback
+
+__all__ = ["Pool", "PoolRequest"]
+
+# Record types
+PARAMS = 1 # The CGI environment as NUL terminated names and values
+STDIN = 2  # Request body; an empty record ends it
+STDOUT = 3 # Script output
+STDERR = 4 # Script error output
+END = 5    # End of the request, carries the exit status
+
+HEADER = struct.Struct('!BI')
+STATUS = struct.Struct('!i')
+
+# Largest STDOUT record written by a worker
+RECORD_SIZE = 65536
+
+
+def record(kind, data=b''):
+    """Returns a serialized record"""
+    return HEADER.pack(kind, len(data)) + data
+
+
+def encode_params(env):
+    return b''.join(name.encode('utf-8', 'surrogateescape') + b'\0' +
+            value.encode('utf-8', 'surrogateescape') + b'\0'
+            for name, value in env.items())
+
+
+def decode_params(data):
+    items = data.split(b'\0')[:-1]
+    return dict((items[i].decode('utf-8', 'surrogateescape'),
+            items[i + 1].decode('utf-8', 'surrogateescape'))
+            for i in range(0, len(items) - 1, 2))
+
+
+class Pool(object):
+    """A pool of up to size worker processes accepting requests on a shared
+unix socket.
+
+Workers exit after max_requests requests (0 never) or after idle seconds
+without one (0 never). A monitor thread starts workers while requests are
+waiting to be accepted and fewer than size are running"""
+    def __init__(self, size, max_requests=0, idle=0, path=None):
+        self.size = size
+        self.max_requests = max_requests
+        self.idle = idle
+        self.path = path or os.path.join(tempfile.gettempdir(),
+                'bistro-cgi-{0}.sock'.format(os.getpid()))
+        if os.path.exists(self.path): os.unlink(self.path)
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(self.path)
+        self.listener.listen(128)
+        self.workers = []
+        # Only the process that created the pool manages it; forked server
+        # processes just send requests
+        self.pid = os.getpid()
+        self._closed = threading.Event()
+        for _ in range(size):
+            self.spawn()
+        self._monitor = threading.Thread(target=self.monitor)
+        self._monitor.daemon = True
+        self._monitor.start()
+        atexit.register(self.close)
+
+    def spawn(self):
+        """Starts a worker process that inherits the listening socket"""
+        fd = self.listener.fileno()
+        self.workers.append(subprocess.Popen([sys.executable,
+            os.path.abspath(__file__), str(fd), str(self.max_requests),
+            str(self.idle)], pass_fds=[fd]))
+
+    def alive(self):
+        """returns the number of running workers"""
+        self.workers = [w for w in self.workers if w.poll() is None]
+        return len(self.workers)
+
+    def monitor(self):
+        """Starts a worker whenever requests wait on the socket and fewer than
+size workers are running"""
+        while not self._closed.is_set():
+            try:
+                waiting = select.select([self.listener], [], [], 0.5)[0]
+            except (OSError, ValueError):
+                return
+            if waiting and self.alive() < self.size:
+                self.spawn()
+                # NOTE: Gives the new worker time to start and accept, so
+                # that a single waiting request does not start several
+                self._closed.wait(0.25)
+            elif waiting:
+                self._closed.wait(0.05)
+
+    def request(self, env, body=b''):
+        """Sends a request to the pool; returns a PoolRequest for its output"""
+        return PoolRequest(self.path, env, body)
+
+    def close(self):
+        """Stops the workers and removes the socket"""
+        if os.getpid() != self.pid or self._closed.is_set(): return
+        self._closed.set()
+        for worker in self.workers:
+            if worker.poll() is None: worker.terminate()
+        for worker in self.workers:
+            worker.wait()
+        self.listener.close()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+
+class PoolRequest(object):
+    """A request run by a pool worker; read() returns the script's output as
+it arrives"""
+    def __init__(self, path, env, body=b''):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self.sock.connect(path)
+            self.sock.sendall(record(PARAMS, encode_params(env)) +
+                    (record(STDIN, body) if body else b'') + record(STDIN))
+        except socket.error:
+            self.sock.close()
+            raise
+        self.buffer = bytearray()
+        self.output = b''
+        # Exit status of the script, set by the END record
+        self.status = None
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def read(self, size):
+        """Returns up to size bytes of output, blocking until some arrive, or
+b'' once the request has ended"""
+        while not self.output:
+            if self.status is not None: return b''
+            if not self.read_record():
+                data = self.sock.recv(max(size, RECORD_SIZE))
+                # NOTE: The worker died without ending the request
+                if not data: return b''
+                self.buffer += data
+        data, self.output = self.output[:size], self.output[size:]
+        return data
+
+    def read_record(self):
+        """Processes the next buffered record; returns False if it was not
+completely received yet"""
+        if len(self.buffer) < HEADER.size: return False
+        kind, length = HEADER.unpack_from(self.buffer)
+        if len(self.buffer) < HEADER.size + length: return False
+        data = bytes(self.buffer[HEADER.size:HEADER.size + length])
+        del self.buffer[:HEADER.size + length]
+        if kind == STDOUT:
+            self.output = data
+        elif kind == STDERR:
+            sys.stderr.write(data.decode('utf-8', 'replace'))
+        elif kind == END:
+            self.status = STATUS.unpack(data)[0]
+        return True
+
+    def close(self, finished=True):
+        """Closes the connection; a worker still running the script notices it
+on its next write"""
+        self.sock.close()
+
+
+class RecordWriter(io.RawIOBase):
+    """Raw stream that sends whatever is written as records of a kind"""
+    def __init__(self, conn, kind):
+        self.conn = conn
+        self.kind = kind
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.conn.sendall(record(self.kind, bytes(data)))
+        return len(data)
+
+
+class Worker(object):
+    """Accepts requests on the pool socket and runs their scripts in process"""
+    def __init__(self, listener, max_requests=0, idle=0):
+        self.listener = listener
+        self.max_requests = max_requests
+        self.idle = idle
+        # Compiled scripts by path as (mtime, code) tuples
+        self.scripts = {}
+
+    def serve(self):
+        """Serves until max_requests requests were run or the worker was idle
+for idle seconds"""
+        self.listener.settimeout(self.idle or None)
+        served = 0
+        while not self.max_requests or served < self.max_requests:
+            try:
+                conn, _ = self.listener.accept()
+            except socket.timeout:
+                return
+            conn.settimeout(None)
+            served += 1
+            try:
+                self.handle(conn)
+            except (socket.error, IOError):
+                pass
+            finally:
+                conn.close()
+
+    def handle(self, conn):
+        """Reads a request from conn, runs its script and sends the output"""
+        reader = conn.makefile('rb')
+        env, body = {}, []
+        while True:
+            header = reader.read(HEADER.size)
+            if len(header) < HEADER.size: return
+            kind, length = HEADER.unpack(header)
+            data = reader.read(length)
+            if kind == PARAMS: env = decode_params(data)
+            elif kind == STDIN:
+                if not data: break
+                body.append(data)
+        status = self.run(env, b''.join(body), conn)
+        conn.sendall(record(END, STATUS.pack(status)))
+
+    def compile(self, path):
+        """Returns the code of the script at path, compiling it again only
+when it was modified"""
+        mtime = os.stat(path).st_mtime
+        entry = self.scripts.get(path)
+        if entry is None or entry[0] != mtime:
+            with open(path, 'rb') as f:
+                entry = (mtime, compile(f.read(), path, 'exec'))
+            self.scripts[path] = entry
+        return entry[1]
+
+    def run(self, env, body, conn):
+        """Runs a script with the CGI environment env and body as its input,
+sending its output to conn. Returns its exit status"""
+        path = env.get('SCRIPT_FILENAME', '')
+        saved = (sys.stdin, sys.stdout, sys.stderr, sys.argv, dict(os.environ))
+        os.environ.clear()
+        os.environ.update(env)
+        sys.argv = [path]
+        sys.stdin = io.TextIOWrapper(io.BufferedReader(io.BytesIO(body)),
+                encoding='utf-8')
+        sys.stdout = io.TextIOWrapper(io.BufferedWriter(
+            RecordWriter(conn, STDOUT), RECORD_SIZE), encoding='utf-8')
+        sys.stderr = io.TextIOWrapper(RecordWriter(conn, STDERR),
+                encoding='utf-8', write_through=True)
+        status = 0
+        try:
+            exec(self.compile(path), {'__name__': '__main__', '__file__': path})
+        except SystemExit as e:
+            if isinstance(e.code, int): status = e.code
+            elif e.code is not None:
+                print(e.code, file=sys.stderr)
+                status = 1
+        except Exception:
+            status = 1
+            traceback.print_exc()
+        finally:
+            try:
+                sys.stdout.flush()
+            except (socket.error, IOError, ValueError):
+                pass
+            sys.stdin, sys.stdout, sys.stderr, sys.argv, env = saved
+            os.environ.clear()
+            os.environ.update(env)
+        return status
+
+
+def main():
+    """Worker process entry point"""
+    fd, max_requests, idle = int(sys.argv[1]), int(sys.argv[2]), float(sys.argv[3])
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM, fileno=fd)
+    try:
+        Worker(listener, max_requests, idle).serve()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,8 @@
 from redis import Redis
 from redis.exceptions import ConnectionError
-from stats import Store
+from stats import ArrayStore, WindowStore
+import snapshot
+import wire
 from threading import Thread
 from os import path
 import sys
@@ -9,21 +11,27 @@ if sys.version[0] == '2':
     input = raw_input
 
 class Collector(Thread):
-    def __init__(self, r, channels):
+    def __init__(self, r, channels, store=None):
         Thread.__init__(self)
         self.redis = r
         self.pubsub = self.redis.pubsub()
         self.pubsub.subscribe(channels)
-        self.stats = Store()
+        self.stats = store if store is not None else ArrayStore()
+        # Messages that could not be decoded and events that could not be
+        # applied
+        self.invalid = 0
+        self.rejected = 0
 
     def shell(self):
         help_str = """\
 This shell accepts the following commands:
     help, ?         - display this message
-    print           - get current statistics
-    total           - get total statistics
-    save <filename> - save Store object to file
-    load <filename> - loads Store object from file
+    print           - get current statistics and request latencies
+    total           - get total statistics and invalid message counts
+    save <filename> - save a snapshot of the statistics to file
+    append <filename> - add what changed since to a saved snapshot
+    load <filename> - loads statistics from a snapshot (or pickle) file
+    export <filename> - export the statistics to a CSV file
     reset, clear    - clears current Store object
     exit, quit      - quit the interactive shell\
 """
@@ -41,40 +49,82 @@ This shell accepts the following commands:
                     self.stats.print_stats()
                 except ValueError:
                     print("Not enough data")
+                self.stats.print_latency()
             elif line.upper() in ['RESET', 'CLEAR']:
                 self.stats.reset()
             elif line.upper() == 'TOTAL':
                 print(self.stats.get_total())
+                print("Invalid messages: {0}, rejected events: {1}".format(
+                    self.invalid, self.rejected))
             else:
                 line = line.split(' ', 1)
                 op = line[0]
                 try:
                     filename = line[1]
                 except IndexError:
-                    if op.upper() in ['SAVE', 'LOAD']:
+                    if op.upper() in ['SAVE', 'APPEND', 'LOAD', 'EXPORT']:
                         print("You need to specify a filename to {}".format(op.lower()))
                         continue
+                if op.upper() in ['SAVE', 'APPEND', 'EXPORT'] and \
+                        not isinstance(self.stats, ArrayStore):
+                    print("Only per address statistics can be saved")
+                    continue
                 if op.upper() == 'SAVE':
-                    self.stats.save(path.normpath(filename))
+                    filename = path.normpath(filename)
+                    if path.isfile(filename):
+                        ans = input("File with name '{}' already exists. Override? (Y/n): ".format(filename))
+                        if ans.upper() != 'Y': continue
+                    n = self.stats.save(filename)
+                    print("Saved {} records".format(n))
+                elif op.upper() == 'APPEND':
+                    try:
+                        n = self.stats.save(path.normpath(filename), append=True)
+                    except ValueError as e:
+                        print("Could not append to '{}': {}".format(filename, e))
+                        continue
+                    print("Appended {} records".format(n))
+                elif op.upper() == 'EXPORT':
+                    n = self.stats.export_csv(path.normpath(filename))
+                    print("Exported {} records".format(n))
                 elif op.upper() == 'LOAD':
                     if self.stats.get_total()['handlers'] > 0:
                         ans = input("Any current statistics will be lost. Are you sure? (Y/n): ")
                     else:
                         ans = 'Y'
                     if ans.upper() == 'Y' or ans.upper() == 'YES':
-                        try:
-                            fh = open(path.normpath(filename), 'rb')
-                        except FileNotFoundError:
+                        filename = path.normpath(filename)
+                        if not path.isfile(filename):
                             print("File not found!".format(filename))
                             continue
-                        self.stats = pickle.load(fh)
+                        if snapshot.is_snapshot(filename):
+                            try:
+                                self.stats = ArrayStore.load(filename)
+                            except ValueError as e:
+                                print("Invalid snapshot: {}".format(e))
+                            continue
+                        # NOTE: Files saved before snapshots were pickles
+                        with open(filename, 'rb') as fh:
+                            self.stats = pickle.load(fh)
                 else:
                     print("Invalid command '{}'".format(op))
                     print(help_str)
 
     def work(self, item):
-        data = item['data'].decode()
-        # XXX: Needs message validation!
+        data = item['data']
+        if data.startswith(wire.MAGIC):
+            try:
+                strings, events = wire.decode(data)
+            except ValueError:
+                self.invalid += 1
+                return
+            self.rejected += self.stats.add_events(strings, events)
+            return
+        # NOTE: Text messages ("addr op value") carry a single event
+        try:
+            data = data.decode()
+        except UnicodeDecodeError:
+            self.invalid += 1
+            return
         data = data.rsplit(' ', 2)
         params = dict(zip(['addr','op','data'], data))
         #print(params) # Prits out the received message
@@ -85,16 +135,20 @@ This shell accepts the following commands:
             'recv': self.stats.add_received,
             'success': self.stats.add_success,
             'error': self.stats.add_error,
+            'not_modified': self.stats.add_not_modified,
             't_close': self.stats.close,
-            't_open': self.stats.open }.get(params['op'], None)
+            't_open': self.stats.open,
+            'latency': self.stats.add_latency,
+            'bytes': self.stats.add_bytes,
+            'path': self.stats.add_path }.get(params.get('op'), None)
         # Execute operation with given parameters
         if op:
             try:
                 op(params['addr'], params['data'])
             except (KeyError, ValueError):
-                print("Invalid data")
+                self.rejected += 1
         else:
-            print("Invalid operation")
+            self.invalid += 1
 
     def run(self):
         for item in self.pubsub.listen():
@@ -109,7 +163,9 @@ This shell accepts the following commands:
 if __name__ == '__main__':
     try:
         r = Redis()
-        c = Collector(r,['statistics'])
+        # NOTE: With --window only rolling counters of all addresses are kept
+        store = WindowStore() if '--window' in sys.argv[1:] else None
+        c = Collector(r,['statistics'], store)
         c.start()
         c.shell()
     except ConnectionError:
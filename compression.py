@@ -0,0 +1,110 @@
+""" Compression module
+
+Content codings used for Accept-Encoding negotiation and a tool that writes
+precompressed .gz/.br sidecar files next to the originals in a directory.
+Usage: python compression.py [config_file]
+"""
+
+import gzip
+import os
+import sys
+# Community modules (optional)
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+__all__ = ["SUFFIXES", "available", "compress", "compressible", "precompress"]
+
+# Supported content codings in order of preference and their sidecar suffixes
+CODINGS = ['br', 'gzip']
+SUFFIXES = {'br': '.br', 'gzip': '.gz'}
+
+# MIME types worth compressing besides text/*
+COMPRESSIBLE_TYPES = set([
+    'application/javascript',
+    'application/json',
+    'application/xml',
+    'application/xhtml+xml',
+    'application/rss+xml',
+    'application/atom+xml',
+    'application/x-javascript',
+    'image/svg+xml',
+    'image/x-icon',
+    'image/vnd.microsoft.icon',
+    ])
+
+
+def available(coding):
+    """returns True if coding can be produced on the fly"""
+    if coding == 'br': return brotli is not None
+    return coding == 'gzip'
+
+
+def compressible(mime):
+    """returns True for MIME types that benefit from compression"""
+    if not mime: return False
+    mime = mime.split(';', 1)[0].strip().lower()
+    return mime.startswith('text/') or mime in COMPRESSIBLE_TYPES
+
+
+def compress(data, coding, level=6):
+    """Returns data compressed with coding at level (1-9)"""
+    if coding == 'gzip':
+        # NOTE: A fixed mtime makes the output depend on data only
+        return gzip.compress(data, level, mtime=0)
+    if coding == 'br':
+        # Brotli qualities range from 0 to 11
+        return brotli.compress(data, quality=min(11, level + 2))
+    raise ValueError("Unsupported content coding '{0}'".format(coding))
+
+
+def precompress(directory, get_type, min_size=256, level=9):
+    """Writes a sidecar file for every coding available for each compressible
+file under directory, unless an up to date one exists. get_type maps a path
+to its MIME type. Returns the number of sidecar files written"""
+    written = 0
+    suffixes = tuple(SUFFIXES.values())
+    for root, dirs, files in os.walk(directory):
+        for name in files:
+            path = os.path.join(root, name)
+            if name.endswith(suffixes) or not compressible(get_type(path)):
+                continue
+            fs = os.stat(path)
+            if fs.st_size < min_size: continue
+            data = None
+            for coding in CODINGS:
+                if not available(coding): continue
+                sidecar = path + SUFFIXES[coding]
+                try:
+                    if os.stat(sidecar).st_mtime >= fs.st_mtime: continue
+                except OSError:
+                    pass
+                if data is None:
+                    with open(path, 'rb') as f: data = f.read()
+                content = compress(data, coding, level)
+                # NOTE: Variants that do not save anything are not written
+                if len(content) >= len(data): continue
+                # Written under a temporary name so that a concurrent request
+                # never reads a partial sidecar
+                tmp = sidecar + '.tmp'
+                with open(tmp, 'wb') as f: f.write(content)
+                os.rename(tmp, sidecar)
+                written += 1
+    return written
+
+
+def main():
+    """Precompresses the PUBLIC_DIR of the given configuration file"""
+    import config
+    import server
+    cfg = config.Config()
+    cfg.file(sys.argv[1] if len(sys.argv) > 1 else 'server.conf')
+    handler = server.HttpHandler(cfg=cfg)
+    written = precompress(cfg.get('PUBLIC_DIR'), handler.get_file_type,
+            cfg.get('COMPRESSION_MIN_SIZE'))
+    print("* Wrote {0} precompressed files in {1}".format(written,
+        cfg.get('PUBLIC_DIR')))
+
+if __name__ == "__main__":
+    main()
@@ -18,6 +18,18 @@ __all__ = ["Config"]
 # XXX: www and cgi folder should be relative to this file - not the best solution
 file_dir = os.path.dirname(__file__)
 
+# Properties parsed as integers
+INT_KEYS = ["PORT", "REQ_BUFFSIZE", "MAX_URL", "MAX_HEADERS",
+        "MAX_HEADER_SIZE", "WORKERS", "MAX_REQUESTS",
+        "PATH_CACHE_SIZE", "RESPONSE_CACHE_SIZE", "RESPONSE_CACHE_MAX_FILE",
+        "OUTPUT_HIGH_WATER", "COMPRESSION_LEVEL", "COMPRESSION_MIN_SIZE",
+        "COMPRESSION_MAX_FILE", "COMPRESSION_CACHE_SIZE", "PRECOMPRESS",
+        "CGI_POOL_SIZE", "CGI_POOL_MAX_REQUESTS", "UVLOOP",
+        "STATS_BUFFER_SIZE", "RAISE_NOFILE_LIMIT"]
+# Properties parsed as floats
+FLOAT_KEYS = ["HTTP_VERSION", "KEEPALIVE_TIMEOUT", "PATH_CACHE_TTL",
+        "CGI_POOL_IDLE", "CGI_TIMEOUT", "STATS_FLUSH_INTERVAL"]
+
 class Config(object):
     """Configuration helper"""
     def __init__(self):
@@ -43,10 +55,60 @@ class Config(object):
         self.set('PORT', 8000)
         self.set('REQ_BUFFSIZE', 4096)
         self.set('MAX_URL', 1024)
+        self.set('MAX_HEADERS', 100)
+        self.set('MAX_HEADER_SIZE', 16384)
         self.set('HTTP_VERSION', 1.0)
         self.set('PUBLIC_DIR', os.path.join(file_dir, 'www'))
         self.set('CGI_DIR', os.path.join(file_dir, 'www/cgi-bin'))
         self.set('INDEX_FILES', ['index.html', 'index.htm'])
+        # Pre-forked workers (0 forks a process per connection)
+        self.set('WORKERS', 0)
+        # Requests served before a worker is recycled (0 is unlimited)
+        self.set('MAX_REQUESTS', 0)
+        # Seconds an idle persistent connection may hold a worker
+        self.set('KEEPALIVE_TIMEOUT', 5.0)
+        # Cached request path resolutions (0 disables) and their lifetime
+        self.set('PATH_CACHE_SIZE', 1024)
+        self.set('PATH_CACHE_TTL', 2.0)
+        # Bytes of rendered small file responses to keep in memory (0
+        # disables) and the largest file that is cached
+        self.set('RESPONSE_CACHE_SIZE', 0)
+        self.set('RESPONSE_CACHE_MAX_FILE', 65536)
+        # Queued output bytes over which a connection is no longer read from
+        # until its client catches up (0 disables)
+        self.set('OUTPUT_HIGH_WATER', 262144)
+        # Compression level of files compressed on the fly (0 disables it),
+        # the size range of such files and the bytes of compressed variants
+        # kept in memory (0 disables the cache)
+        self.set('COMPRESSION_LEVEL', 6)
+        self.set('COMPRESSION_MIN_SIZE', 256)
+        self.set('COMPRESSION_MAX_FILE', 1048576)
+        self.set('COMPRESSION_CACHE_SIZE', 4194304)
+        # Write .gz/.br sidecar files for PUBLIC_DIR on startup (0 or 1)
+        self.set('PRECOMPRESS', 0)
+        # Seconds a CGI script may go without writing output before it is
+        # killed (0 waits forever)
+        self.set('CGI_TIMEOUT', 30.0)
+        # Statistics messages buffered for publishing (further ones are
+        # dropped) and the seconds between publishing them
+        self.set('STATS_BUFFER_SIZE', 65536)
+        self.set('STATS_FLUSH_INTERVAL', 0.05)
+        # Run AsyncioServer on uvloop when it is installed (0 or 1)
+        self.set('UVLOOP', 1)
+        # Raise the soft limit of open files of the process to its hard
+        # limit when NonBlockingServer starts, to hold more connections (0 or 1)
+        self.set('RAISE_NOFILE_LIMIT', 0)
+        # Worker processes running Python CGI scripts (0 runs every script as
+        # a new process), the requests each serves before it is replaced (0
+        # never) and the seconds an idle worker lives (0 forever)
+        self.set('CGI_POOL_SIZE', 0)
+        self.set('CGI_POOL_MAX_REQUESTS', 1000)
+        self.set('CGI_POOL_IDLE', 60.0)
+        # Unix socket of the pool (empty for one in the temporary directory)
+        self.set('CGI_POOL_SOCKET', '')
+        # Path the in-process metrics are served on in the Prometheus text
+        # format, to every client of the server (empty disables it)
+        self.set('METRICS_PATH', '')
         # NOTE: The following are currently unused
         self.set('LOGGING', True)
         self.set('LOG_FILE', 'server.log')
@@ -63,9 +125,9 @@ class Config(object):
                     for key in config["server"]:
                         try:
                             value = config["server"][key]
-                            if key.upper() == "PORT" or key.upper() == "REQ_BUFFSIZE":
+                            if key.upper() in INT_KEYS:
                                 value = int(value)
-                            elif key.upper() == "HTTP_VERSION":
+                            elif key.upper() in FLOAT_KEYS:
                                 value = float(config["server"][key])
                             elif key.upper() == "INDEX_FILES":
                                 value = config["server"][key].split()
@@ -89,9 +151,9 @@ class Config(object):
                         for pair in config.items("server"):
                             try:
                                 key, value = pair[0], pair[1]
-                                if key.upper() in ["PORT", "REQ_BUFFSIZE"]:
+                                if key.upper() in INT_KEYS:
                                     value = int(value)
-                                elif key.upper() == "HTTP_VERSION":
+                                elif key.upper() in FLOAT_KEYS:
                                     value = float(value)
                                 elif key.upper() == "INDEX_FILES":
                                     value = value.split()
@@ -0,0 +1,104 @@
+""" Latency histogram module
+
+Log-bucketed histograms in the manner of HdrHistogram. Values below 2**BITS
+have a bucket each; every larger power of two is split into 2**(BITS - 1)
+buckets, so a bucket is never wider than 1/2**(BITS - 1) of its values and
+percentiles are exact to within that. Recording is a few integer operations,
+and histograms merge by adding their counts, which lets the collector combine
+those of every server process
+"""
+
+__all__ = ["Histogram"]
+
+# Precision: 32 buckets per power of two, i.e. about 3%
+BITS = 6
+HALF = 1 << (BITS - 1)
+
+
+def bucket(value):
+    """returns the index of the bucket of a non-negative integer"""
+    shift = value.bit_length() - BITS
+    if shift <= 0: return value
+    return shift * HALF + (value >> shift)
+
+
+def bounds(index):
+    """returns the lowest and highest value of the bucket at index"""
+    if index < 2 * HALF: return index, index
+    shift = index // HALF - 1
+    low = (index - shift * HALF) << shift
+    return low, low + (1 << shift) - 1
+
+
+class Histogram(object):
+    """Counts of non-negative integer values (e.g. latencies in microseconds)
+in log-sized buckets"""
+    __slots__ = ('counts', 'total', 'max')
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        """Drops every recorded value"""
+        self.counts = []
+        self.total = 0
+        self.max = 0
+
+    def record(self, value, count=1):
+        """Records count occurrences of value; negative values count as 0"""
+        value = int(value)
+        if value < 0: value = 0
+        index = bucket(value)
+        counts = self.counts
+        if index >= len(counts): counts.extend([0] * (index + 1 - len(counts)))
+        counts[index] += count
+        self.total += count
+        if value > self.max: self.max = value
+
+    def merge(self, other):
+        """Adds the counts of another histogram to this one"""
+        counts = self.counts
+        if len(other.counts) > len(counts):
+            counts.extend([0] * (len(other.counts) - len(counts)))
+        for index, n in enumerate(other.counts):
+            if n: counts[index] += n
+        self.total += other.total
+        if other.max > self.max: self.max = other.max
+        return self
+
+    def percentile(self, p):
+        """returns the value below which p percent of the recorded values
+are, as the highest value of its bucket (never above the maximum)"""
+        if not self.total: return 0
+        rank = max(1, -(-self.total * p // 100))
+        seen = 0
+        for index, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank: return min(bounds(index)[1], self.max)
+        return self.max
+
+    def percentiles(self, ps=(50, 90, 99, 99.9)):
+        return [self.percentile(p) for p in ps]
+
+    def encode(self):
+        """returns the histogram as a string without spaces:
+max;index:count,index:count,..."""
+        return '{0};{1}'.format(self.max, ','.join('{0}:{1}'.format(i, n)
+            for i, n in enumerate(self.counts) if n))
+
+    @classmethod
+    def decode(cls, data):
+        """returns the histogram encoded by encode(); raises ValueError if
+data is malformed"""
+        histogram = cls()
+        maximum, _, items = data.partition(';')
+        for item in items.split(',') if items else ():
+            index, n = item.split(':')
+            index, n = int(index), int(n)
+            if index < 0 or n < 0: raise ValueError(item)
+            if index >= len(histogram.counts):
+                histogram.counts.extend([0] * (index + 1 - len(histogram.counts)))
+            histogram.counts[index] += n
+            histogram.total += n
+        histogram.max = int(maximum)
+        return histogram
@@ -0,0 +1,214 @@
+""" HTTP parser module
+
+Incremental HTTP/1.x request parser. Received data is appended to a single
+bytearray and scanned from saved offsets, so a request that arrives in many
+small pieces is never re-split or copied as a whole
+"""
+
+__all__ = ["ParseError", "Headers", "RequestParser", "parse_range",
+        "parse_qlist"]
+
+CRLF = b'\r\n'
+
+# Ranges of a single request served before the Range header is ignored
+MAX_RANGES = 16
+
+
+class ParseError(Exception):
+    """Raised for malformed or oversized requests; code is the HTTP status
+code the request should be answered with"""
+    def __init__(self, code, message=''):
+        Exception.__init__(self, code, message)
+        self.code = code
+        self.message = message
+
+
+class Headers(dict):
+    """Case-insensitive header mapping. Names are lower-cased once, when
+they are parsed; repeated fields are joined with a comma"""
+    def __getitem__(self, name):
+        return dict.__getitem__(self, name.lower())
+
+    def __contains__(self, name):
+        return dict.__contains__(self, name.lower())
+
+    def get(self, name, default=None):
+        return dict.get(self, name.lower(), default)
+
+
+class RequestParser(object):
+    """Incremental request parser.
+
+Data passed to feed() is appended to a bytearray. Consumed data is tracked
+with an offset and the search for the next CRLF resumes where the previous
+one stopped"""
+    def __init__(self, max_line=1024, max_headers=100, max_header_size=16384):
+        """max_line limits the request line, max_headers the number of header
+fields and max_header_size the size of the header block in bytes"""
+        self.max_line = max_line
+        self.max_headers = max_headers
+        self.max_header_size = max_header_size
+        self.reset()
+
+    def reset(self):
+        """Drops all buffered data"""
+        self.buffer = bytearray()
+        # Start of unconsumed data
+        self._pos = 0
+        # Offset from which to resume the search for CRLF
+        self._scan = 0
+
+    def feed(self, data):
+        """Appends received data to the buffer"""
+        if self._pos:
+            # NOTE: Deleting a bytearray prefix does not move the remainder
+            del self.buffer[:self._pos]
+            self._scan -= self._pos
+            self._pos = 0
+        self.buffer += data
+
+    def __len__(self):
+        """returns the number of buffered bytes not yet consumed"""
+        return len(self.buffer) - self._pos
+
+    def readline(self, limit, code=400):
+        """Returns the next line without its CRLF or None if it is not
+complete yet. Raises ParseError(code) when the line exceeds limit bytes"""
+        i = self.buffer.find(CRLF, self._scan)
+        if i < 0:
+            if len(self.buffer) - self._pos > limit:
+                raise ParseError(code, 'Line too long')
+            # A CR at the end of the buffer may be followed by LF
+            self._scan = max(len(self.buffer) - 1, self._pos)
+            return None
+        if i - self._pos > limit:
+            raise ParseError(code, 'Line too long')
+        line = bytes(self.buffer[self._pos:i])
+        self._pos = self._scan = i + 2
+        return line
+
+    def parse_request_line(self):
+        """Returns the request line or None if it is not complete yet. Empty
+lines preceding a request are skipped"""
+        while True:
+            line = self.readline(self.max_line, 414)
+            if line != b'': return line
+
+    def parse_headers(self):
+        """Returns the request Headers or None if the empty line ending the
+header block was not received yet. The block is parsed in one pass once it
+is complete; the search for its end resumes on the next call"""
+        buf, pos = self.buffer, self._pos
+        if buf[pos:pos + 2] == CRLF:
+            self._pos = self._scan = pos + 2
+            return Headers()
+        end = buf.find(b'\r\n\r\n', max(self._scan, pos))
+        if end < 0:
+            if len(buf) - pos > self.max_header_size:
+                raise ParseError(431, 'Header block too large')
+            # The end of the buffer may hold the first part of the terminator
+            self._scan = max(len(buf) - 3, pos)
+            return None
+        if end + 2 - pos > self.max_header_size:
+            raise ParseError(431, 'Header block too large')
+        lines = buf[pos:end].decode('latin-1').split('\r\n')
+        self._pos = self._scan = end + 4
+        if len(lines) > self.max_headers:
+            raise ParseError(431, 'Too many header fields')
+        fields = {}
+        for line in lines:
+            name, sep, value = line.partition(':')
+            # NOTE: Rejects obsolete line folding and whitespace before colon
+            if not sep or not name or name[-1] in ' \t' or name[0] in ' \t':
+                raise ParseError(400, 'Malformed header field')
+            name = name.lower()
+            value = value.strip()
+            if name in fields: value = fields[name] + ', ' + value
+            fields[name] = value
+        return Headers(fields)
+
+    def read(self, n):
+        """Returns the next n bytes or None if they were not received yet"""
+        if len(self.buffer) - self._pos < n: return None
+        data = bytes(self.buffer[self._pos:self._pos + n])
+        self._pos += n
+        self._scan = self._pos
+        return data
+
+
+def parse_range(value, size):
+    """Parses a Range header value for a representation of size bytes.
+
+Returns a list of (first, last) inclusive byte offsets, sorted and with
+overlapping or adjacent ranges merged, or an empty list if no range is
+satisfiable. Returns None if the header should be ignored: an unknown unit,
+a syntax error or more than MAX_RANGES ranges"""
+    unit, sep, spec = value.partition('=')
+    if not sep or unit.strip().lower() != 'bytes': return None
+    ranges = []
+    for item in spec.split(','):
+        item = item.strip()
+        if not item: continue
+        first, sep, last = item.partition('-')
+        first, last = first.strip(), last.strip()
+        if not sep or (last and not last.isdigit()): return None
+        if not first:
+            # Suffix range: the last N bytes
+            if not last: return None
+            if int(last) == 0 or size == 0: continue
+            ranges.append((max(size - int(last), 0), size - 1))
+            continue
+        if not first.isdigit(): return None
+        first = int(first)
+        last = int(last) if last else None
+        if last is not None and last < first: return None
+        if first >= size: continue
+        ranges.append((first, size - 1 if last is None else min(last, size - 1)))
+    if not ranges:
+        # NOTE: A header without a single well-formed range is invalid
+        return [] if spec.strip(' ,') else None
+    ranges.sort()
+    merged = [ranges[0]]
+    for first, last in ranges[1:]:
+        if first <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], last))
+        else:
+            merged.append((first, last))
+    if len(merged) > MAX_RANGES: return None
+    return merged
+
+
+def parse_qlist(value):
+    """Parses a header listing tokens with optional quality values, such as
+Accept-Encoding. Returns a dictionary mapping lower-cased tokens to their
+q value; tokens with a malformed q value are dropped"""
+    accepted = {}
+    for item in value.split(','):
+        token, _, params = item.partition(';')
+        token = token.strip().lower()
+        if not token: continue
+        q = 1.0
+        for param in params.split(';'):
+            name, _, v = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    q = float(v.strip())
+                except ValueError:
+                    q = None
+        if q is not None: accepted[token] = q
+    return accepted
+
+
+def test():
+    """Parses a request fed one byte at a time and prints the result"""
+    p = RequestParser()
+    request = b'GET / HTTP/1.1\r\nHost: localhost\r\nAccept: */*\r\n\r\n'
+    line = headers = None
+    for i in range(len(request)):
+        p.feed(request[i:i + 1])
+        if line is None: line = p.parse_request_line()
+        if line is not None and headers is None: headers = p.parse_headers()
+    print(line, headers)
+
+if __name__ == "__main__":
+    test()
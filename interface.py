@@ -2,8 +2,14 @@
 Currently contains only Stats interface
 """
 from redis import Redis
-from redis.exceptions import ConnectionError
+from redis.exceptions import ConnectionError, RedisError
+import atexit
+import os
+import threading
 import time
+import traceback
+from histogram import Histogram
+import wire
 
 __all__ = ['Stats']
 
@@ -18,6 +24,36 @@ class Stats(object):
         print("Warning: Could not connect to redis server! Run setup() to configure")
     # Default channel:
     _c = 'statistics'
+    # NOTE: Messages are not published from the request path. They are
+    # written to a ring buffer that a background thread drains every
+    # _interval seconds, sending up to _batch of them as one binary message
+    # (see wire).
+    # _head and _tail count the messages written and taken; only the
+    # request path moves _head and only senders move _tail, so writing
+    # needs no lock
+    _size = 65536
+    _ring = [None] * _size
+    _head = 0
+    _tail = 0
+    _interval = 0.05
+    _batch = 4096
+    _sender = None
+    _lock = threading.Lock()
+    _failing = False
+    # Request latency histograms by key recorded since the last flush; they
+    # are published as deltas, which the collector merges. _records guards
+    # them while they are updated and swapped out by flush()
+    _latency = {}
+    _records = threading.Lock()
+    # Requests per path since the last flush, also guarded by _records;
+    # paths beyond _max_paths are counted together
+    _paths = {}
+    _max_paths = 1024
+    # Messages dropped because the buffer was full, lost to Redis errors
+    # and published
+    dropped = 0
+    failed = 0
+    sent = 0
     # XXX: This class reuses assert isinstance checks - there should be a better
     # way to error handling!
 
@@ -34,10 +70,10 @@ class Stats(object):
     def set_count(self, addr, op, value=1):
         """Publishes a message containg issuers' address, increase operation and value.
 :addr -> string1
-:op -> string, either 'recv', 'success' or 'error'
+:op -> string, either 'recv', 'success', 'error', 'not_modified' or 'bytes'
 :value -> int,string, either int, '+' or '-'
 """
-        ops = ['recv', 'success', 'error']
+        ops = ['recv', 'success', 'error', 'not_modified', 'bytes']
         if op not in ops: raise ValueError('Invalid value for parameter :op')
         if value == "+": value = 1
         elif value == "-": value = -1
@@ -57,14 +93,150 @@ class Stats(object):
         else: assert isinstance(timestamp, float), 'parameter :time must be float'
         self._publish(addr, op, timestamp)
 
+    @classmethod
+    def set_latency(self, key, seconds):
+        """Records a request latency in the histogram of key, e.g.
+'ForkingServer/2xx'. The histograms are published with the buffered messages
+:key -> string without spaces
+:seconds -> float
+"""
+        with self._records:
+            histogram = self._latency.get(key)
+            if histogram is None:
+                histogram = self._latency[key] = Histogram()
+            histogram.record(seconds * 1000000)
+        if self._sender is None: self._start()
+
+    @classmethod
+    def set_path(self, path):
+        """Counts a request for path; the query string is left out. The
+counts are published with the buffered messages
+:path -> string
+"""
+        path = path.split('?', 1)[0][:256]
+        with self._records:
+            paths = self._paths
+            if path not in paths and len(paths) >= self._max_paths:
+                path = '(other)'
+            paths[path] = paths.get(path, 0) + 1
+        if self._sender is None: self._start()
+
     @classmethod
     def _publish(self, addr, op, value):
-        """Helper method to prepare and publish the message"""
-        msg = "{} {} {}".format(str(addr), op, value)
+        """Helper method to queue the message for the sender"""
+        head = self._head
+        if head - self._tail >= self._size:
+            self.dropped += 1
+            return
+        self._ring[head % self._size] = (addr, op, value)
+        self._head = head + 1
+        if self._sender is None: self._start()
+
+    @classmethod
+    def _start(self):
+        """Starts the sender thread of this process"""
+        self._sender = threading.Thread(target=self._run)
+        self._sender.daemon = True
+        self._sender.start()
+
+    @classmethod
+    def _run(self):
+        """Publishes the buffered messages every _interval seconds. Errors are
+reported and publishing goes on; should the thread end anyway, the next
+message starts a new one"""
         try:
-            self.r.publish(self._c, msg)
-        except ConnectionError as err:
-            print("Connection Error: Could not publish message")
+            while True:
+                time.sleep(self._interval)
+                try:
+                    self.flush()
+                except Exception:
+                    traceback.print_exc()
+        finally:
+            self._sender = None
+
+    @classmethod
+    def flush(self):
+        """Publishes the buffered messages. Returns the number published"""
+        published = 0
+        with self._lock:
+            head, tail = self._head, self._tail
+            while tail < head:
+                n = min(head - tail, self._batch)
+                ring, size = self._ring, self._size
+                try:
+                    message = wire.encode(ring[i % size]
+                            for i in range(tail, tail + n))
+                except Exception as e:
+                    # NOTE: A batch that cannot be encoded is dropped rather
+                    # than retried on every flush
+                    print("Stats Error: Could not encode messages ({0!r})"
+                            .format(e))
+                    message = None
+                tail += n
+                # NOTE: Frees the slots for the request path
+                self._tail = tail
+                if message is None:
+                    self.failed += n
+                    continue
+                try:
+                    self.r.publish(self._c, message)
+                except RedisError:
+                    # Only the first of consecutive failures is reported
+                    if not self._failing:
+                        print("Connection Error: Could not publish messages")
+                    self._failing = True
+                    self.failed += n
+                    continue
+                self._failing = False
+                self.sent += n
+                published += n
+            # NOTE: Once swapped out, the histograms and path counts are only
+            # read here
+            with self._records:
+                latency, self._latency = self._latency, {}
+                paths, self._paths = self._paths, {}
+            events = [(key, 'latency', histogram.encode())
+                    for key, histogram in latency.items()]
+            events.extend((path, 'path', n) for path, n in paths.items())
+            if events:
+                try:
+                    self.r.publish(self._c, wire.encode(events))
+                except Exception:
+                    # NOTE: A Redis error or an event that cannot be encoded
+                    self.failed += len(events)
+                else:
+                    self.sent += len(events)
+                    published += len(events)
+        return published
+
+    @classmethod
+    def configure(self, size=None, interval=None):
+        """Sets the number of messages the buffer holds and the seconds
+between flushes. Buffered messages are published first"""
+        self.flush()
+        with self._lock:
+            if size:
+                self._size = size
+                self._ring = [None] * size
+                self._head = self._tail = 0
+            if interval: self._interval = interval
+
+    @classmethod
+    def counters(self):
+        """Returns the numbers of published, dropped and failed messages and
+of messages waiting in the buffer"""
+        return {'sent': self.sent, 'dropped': self.dropped,
+                'failed': self.failed, 'queued': self._head - self._tail}
+
+    @classmethod
+    def _forked(self):
+        """Drops the parent's buffered messages and sender in a child process"""
+        self._lock = threading.Lock()
+        self._records = threading.Lock()
+        self._tail = self._head
+        self._latency = {}
+        self._paths = {}
+        self._sender = None
 
     @classmethod
     def set_channel(self, channel):
@@ -78,3 +250,8 @@ class Stats(object):
     def get_channel(self):
         """Used to retreive current class channel"""
         return self._c
+
+atexit.register(Stats.flush)
+# NOTE: Threads do not survive fork(); a child starts its own sender
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=Stats._forked)
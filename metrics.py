@@ -0,0 +1,198 @@
+""" Metrics module
+
+In-process counters and gauges of a server, served in the Prometheus text
+exposition format on its METRICS_PATH. Unlike the statistics published to
+the collector, they need neither Redis nor another process.
+
+Every metric is a 64-bit integer at a fixed position of a row. The rows are
+a table in shared memory created before the server forks, and a process only
+writes to its own row, so the processes of a ForkingServer add up:
+
+    row 0       single process servers, and the processes a ForkingServer
+                forks per connection, each merged in when its connection
+                closes
+    row 1..n    the workers of a pre-forking ForkingServer, one each
+
+A scrape sums the rows. What it renders depends on the number of distinct
+series (bounded by the methods, status codes, caches and buckets below) and
+never on the amount of traffic
+"""
+
+import bisect
+import mmap
+import multiprocessing
+import numpy
+
+__all__ = ["Metrics"]
+
+# Methods counted by name; any other one counts as 'other'
+METHODS = ['GET', 'HEAD', 'POST', 'other']
+# Status codes counted, 100 to 599
+FIRST_CODE = 100
+CODES = 500
+# Caches whose lookups are counted, in the order Metrics gets them
+CACHES = ['path', 'response', 'compressed']
+# Upper bounds of the latency histogram buckets in seconds (+Inf aside)
+BUCKETS = [0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+        0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+BOUNDS = [int(round(b * 1e6)) for b in BUCKETS]
+
+# Positions in a row: requests by method and status code, bytes sent,
+# connections accepted and open, hits and misses of each cache, and the
+# latency histogram (the count of each bucket, +Inf last, and the sum of all
+# latencies in microseconds)
+REQUESTS = 0
+SENT = REQUESTS + len(METHODS) * CODES
+CONNECTIONS = SENT + 1
+ACTIVE = CONNECTIONS + 1
+CACHE = ACTIVE + 1
+LATENCY = CACHE + 2 * len(CACHES)
+LATENCY_SUM = LATENCY + len(BUCKETS) + 1
+SIZE = LATENCY_SUM + 1
+
+OFFSETS = dict((method, REQUESTS + i * CODES - FIRST_CODE)
+        for i, method in enumerate(METHODS))
+OTHER = OFFSETS['other']
+
+# NOTE: Everything but the values is rendered once
+HEADERS = {}
+for name, kind, text in [
+        ('bistro_requests_total', 'counter',
+            'Requests answered, by method and status code.'),
+        ('bistro_sent_bytes_total', 'counter', 'Bytes of responses sent.'),
+        ('bistro_connections_total', 'counter', 'Connections accepted.'),
+        ('bistro_connections_active', 'gauge', 'Connections open.'),
+        ('bistro_cache_requests_total', 'counter',
+            'Cache lookups, by cache and result.'),
+        ('bistro_cache_hit_ratio', 'gauge',
+            'Lookups of each cache that were hits.'),
+        ('bistro_request_duration_seconds', 'histogram',
+            'Time from the first byte of a request to the last byte of its '
+            'response.')]:
+    HEADERS[name] = '# HELP {0} {2}\n# TYPE {0} {1}\n'.format(name, kind, text)
+REQUEST_LABELS = [['bistro_requests_total{{method="{0}",code="{1}"}} '.format(
+    method, FIRST_CODE + code) for code in range(CODES)] for method in METHODS]
+CACHE_LABELS = ['bistro_cache_requests_total{{cache="{0}",result="{1}"}} '
+        .format(cache, result) for cache in CACHES for result in ['hit', 'miss']]
+RATIO_LABELS = ['bistro_cache_hit_ratio{{cache="{0}"}} '.format(cache)
+        for cache in CACHES]
+BUCKET_LABELS = ['bistro_request_duration_seconds_bucket{{le="{0}"}} '.format(le)
+        for le in ['{0:g}'.format(b) for b in BUCKETS] + ['+Inf']]
+
+
+class Metrics(object):
+    """Counters of a server and of the processes it forks (see the module
+docstring). slots is the number of rows; caches are the PathCache and
+ResponseCache objects (or None) whose lookups are counted, in the order of
+CACHES"""
+    def __init__(self, slots=1, caches=()):
+        self.slots = slots
+        self.caches = list(caches)
+        self._map = mmap.mmap(-1, slots * SIZE * 8)
+        self.table = numpy.frombuffer(self._map, numpy.int64).reshape(slots, SIZE)
+        self._rows = memoryview(self._map).cast('q')
+        # Guards row 0 against the processes forked per connection
+        self._lock = multiprocessing.Lock()
+        # Counts of a process forked per connection, merged into row 0
+        self._private = None
+        # Cache hits and misses already counted
+        self._seen = [0] * (2 * len(CACHES))
+        self.values = self._rows[:SIZE]
+
+    def attach(self, slot):
+        """Makes this process (a pre-forked worker) write to row slot"""
+        self._private = None
+        self.values = self._rows[slot * SIZE:(slot + 1) * SIZE]
+        # NOTE: The connections of a worker that died are not open anymore
+        self.values[ACTIVE] = 0
+
+    def detach(self):
+        """Makes this process (forked per connection) count privately, adding
+its counts to row 0 when its connection closes"""
+        self._private = bytearray(SIZE * 8)
+        self.values = memoryview(self._private).cast('q')
+
+    def request(self, method, code):
+        """Counts a response of status code to a request of method"""
+        self.values[OFFSETS.get(method, OTHER) + code] += 1
+
+    def sent(self, count):
+        """Counts bytes sent"""
+        self.values[SENT] += count
+
+    def observe(self, seconds):
+        """Records the latency of a request"""
+        value = int(seconds * 1e6)
+        values = self.values
+        values[LATENCY + bisect.bisect_left(BOUNDS, value)] += 1
+        values[LATENCY_SUM] += value
+
+    def opened(self):
+        """Counts an accepted connection"""
+        self.values[CONNECTIONS] += 1
+        if self._private is None:
+            self.values[ACTIVE] += 1
+        else:
+            with self._lock: self._rows[ACTIVE] += 1
+
+    def closed(self):
+        """Counts a closed connection; a process forked per connection adds
+its counts to row 0"""
+        self.count_caches()
+        if self._private is None:
+            self.values[ACTIVE] -= 1
+            return
+        private = numpy.frombuffer(self._private, numpy.int64)
+        with self._lock:
+            self._rows[ACTIVE] -= 1
+            self.table[0] += private
+        private[:] = 0
+
+    def count_caches(self):
+        """Counts the cache lookups since the last call"""
+        seen, values = self._seen, self.values
+        for i, cache in enumerate(self.caches):
+            if cache is None: continue
+            for j, n in enumerate([cache.hits, cache.misses]):
+                k = 2 * i + j
+                # NOTE: Clearing a cache resets its counters
+                if n < seen[k]: seen[k] = 0
+                values[CACHE + k] += n - seen[k]
+                seen[k] = n
+
+    def totals(self):
+        """returns the sum of all rows (and of the counts of this process)"""
+        self.count_caches()
+        totals = self.table.sum(axis=0)
+        if self._private is not None:
+            totals += numpy.frombuffer(self._private, numpy.int64)
+        return totals
+
+    def render(self):
+        """returns the metrics in the Prometheus text format (as bytes)"""
+        totals = self.totals()
+        out = [HEADERS['bistro_requests_total']]
+        for i, labels in enumerate(REQUEST_LABELS):
+            counts = totals[REQUESTS + i * CODES:REQUESTS + (i + 1) * CODES]
+            for code in numpy.flatnonzero(counts).tolist():
+                out.append('{0}{1}\n'.format(labels[code], counts[code]))
+        for name, index in [('bistro_sent_bytes_total', SENT),
+                ('bistro_connections_total', CONNECTIONS),
+                ('bistro_connections_active', ACTIVE)]:
+            out.append('{0}{1} {2}\n'.format(HEADERS[name], name, totals[index]))
+        out.append(HEADERS['bistro_cache_requests_total'])
+        for k, labels in enumerate(CACHE_LABELS):
+            out.append('{0}{1}\n'.format(labels, totals[CACHE + k]))
+        out.append(HEADERS['bistro_cache_hit_ratio'])
+        for i, labels in enumerate(RATIO_LABELS):
+            hits, misses = totals[CACHE + 2 * i], totals[CACHE + 2 * i + 1]
+            out.append('{0}{1:g}\n'.format(labels,
+                float(hits) / (hits + misses) if hits + misses else 0.0))
+        out.append(HEADERS['bistro_request_duration_seconds'])
+        counts = numpy.cumsum(totals[LATENCY:LATENCY_SUM])
+        for labels, n in zip(BUCKET_LABELS, counts.tolist()):
+            out.append('{0}{1}\n'.format(labels, n))
+        out.append('bistro_request_duration_seconds_sum {0:.6f}\n'
+                'bistro_request_duration_seconds_count {1}\n'.format(
+                    totals[LATENCY_SUM] / 1e6, counts[-1]))
+        return ''.join(out).encode('ascii')
@@ -1,14 +1,226 @@
 #!/usr/bin/env python
+""" Live monitor
+
+A top-like terminal dashboard of the statistics channel: request and
+connection rates, error rate, bytes sent, latency percentiles and the
+busiest clients and paths, refreshed every interval seconds.
+Usage: python monitor.py [interval] [channel]
+"""
+from __future__ import print_function
+
 import cmd
+import heapq
+import re
+import shutil
+import sys
+import threading
+import time
+import numpy
+from histogram import Histogram
+import stats
+import wire
+
+# Client part of the published connection addresses, e.g. "('10.0.0.1', 80)"
+CLIENT = re.compile(r"^\('([^']*)'")
+
+
+def client(address):
+    """returns the host of a published connection address"""
+    match = CLIENT.match(address)
+    return match.group(1) if match else address
+
+
+def human(n):
+    """returns a byte count with a binary unit"""
+    for unit in ['B', 'KiB', 'MiB', 'GiB']:
+        if abs(n) < 1024: return "{0:.1f} {1}".format(n, unit)
+        n /= 1024.0
+    return "{0:.1f} TiB".format(n)
+
+
+class MonitorStore(stats.WindowStore):
+    """WindowStore that also counts the requests and bytes of every client,
+the requests of every path and the latencies since the dashboard last took
+them (see take())"""
+    # Most clients or paths counted between two refreshes
+    MAX_KEYS = 10000
+
+    def __init__(self, resolutions=None):
+        self._lock = threading.RLock()
+        stats.WindowStore.__init__(self, resolutions)
+
+    def reset(self):
+        with self._lock:
+            stats.WindowStore.reset(self)
+            self.clear()
+
+    def clear(self):
+        self.clients = {}
+        self.recent_paths = {}
+        self.recent_latency = {}
+
+    def take(self):
+        """returns the client, path and latency counts since the last call"""
+        with self._lock:
+            taken = self.clients, self.recent_paths, self.recent_latency
+            self.clear()
+        return taken
+
+    @classmethod
+    def bump(cls, counts, key, value):
+        if key not in counts and len(counts) >= cls.MAX_KEYS: key = '(other)'
+        counts[key] = counts.get(key, 0) + value
+
+    def count_client(self, address, requests=0, sent=0):
+        host = client(address)
+        entry = self.clients.get(host)
+        if entry is None:
+            if len(self.clients) >= self.MAX_KEYS: host = '(other)'
+            entry = self.clients.setdefault(host, [0, 0])
+        entry[0] += requests
+        entry[1] += sent
+
+    def add_received(self, address, value=1):
+        with self._lock:
+            stats.WindowStore.add_received(self, address, value)
+            self.count_client(address, requests=int(value))
+
+    def add_bytes(self, address, value):
+        with self._lock:
+            stats.WindowStore.add_bytes(self, address, value)
+            self.count_client(address, sent=int(value))
+
+    def add_path(self, path, value=1):
+        with self._lock:
+            stats.WindowStore.add_path(self, path, value)
+            self.bump(self.recent_paths, path, int(value))
+
+    def add_latency(self, key, data):
+        with self._lock:
+            stats.WindowStore.add_latency(self, key, data)
+            histogram = Histogram.decode(data)
+            if key in self.recent_latency: self.recent_latency[key].merge(histogram)
+            else: self.recent_latency[key] = histogram
+
+    def add_events(self, strings, events):
+        """Applies a decoded wire message, counting the requests and bytes
+of each address of the batch once"""
+        with self._lock:
+            ops, addrs, values = events['op'], events['addr'], events['value']
+            for name in ['recv', 'bytes']:
+                selected = ops == wire.CODES[name]
+                if not selected.any(): continue
+                totals = numpy.bincount(addrs[selected], values[selected],
+                        len(strings))
+                for i in numpy.flatnonzero(totals).tolist():
+                    if name == 'recv':
+                        self.count_client(strings[i], requests=int(totals[i]))
+                    else:
+                        self.count_client(strings[i], sent=int(totals[i]))
+            # NOTE: The WindowStore methods skip the per client counting done
+            # above
+            return stats.WindowStore.add_events(self, strings, events)
+
+
+class Dashboard(object):
+    """Renders a MonitorStore to the terminal every interval seconds"""
+    def __init__(self, store, interval=1.0, out=None, collector=None):
+        self.store = store
+        self.interval = interval
+        self.out = out or sys.stdout
+        self.collector = collector
+
+    def render(self, now=None, width=80, height=24):
+        """returns the lines of one screen, taking the recent counts"""
+        if now is None: now = time.time()
+        store, series = self.store, self.store.series
+        clients, paths, latency = self.store.take()
+        lines = []
+        lines.append("bistro monitor - {0}, every {1:g}s".format(
+            time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(now)), self.interval))
+        rates = [(label, series.rate('received', seconds, now),
+            series.rate('error', seconds, now)) for label, seconds in
+            [('1s', 1), ('10s', 10), ('1m', 60)]]
+        lines.append("Requests/s: " + "  ".join("{0:9.1f} ({1})".format(rate, label)
+            for label, rate, _ in rates))
+        lines.append("Errors:     " + "  ".join("{0:8.2f}% ({1})".format(
+            100.0 * errors / rate if rate else 0.0, label)
+            for label, rate, errors in rates))
+        lines.append("Connections: {0} active, {1:.1f}/s   Sent: {2}/s".format(
+            store.active, series.rate('connections', 10, now),
+            human(series.rate('bytes', 1, now))))
+        if self.collector is not None:
+            lines.append("Messages: {0} invalid, {1} events rejected".format(
+                self.collector.invalid, self.collector.rejected))
+        lines.append("")
+        lines.append("{0:<26} {1:>8} {2:>9} {3:>9} {4:>9} {5:>9}".format(
+            "Latency (ms, last {0:g}s)".format(self.interval), 'count', 'p50',
+            'p90', 'p99', 'max'))
+        for key in sorted(latency):
+            h = latency[key]
+            p50, p90, p99 = h.percentiles((50, 90, 99))
+            lines.append("{0:<26} {1:>8} {2:>9.3f} {3:>9.3f} {4:>9.3f} {5:>9.3f}"
+                    .format(key[:26], h.total, p50 / 1000.0, p90 / 1000.0,
+                        p99 / 1000.0, h.max / 1000.0))
+        # NOTE: The tables share what is left of the screen
+        rows = max(1, (height - len(lines) - 5) // 2)
+        lines.append("")
+        lines.append("{0:<40} {1:>10} {2:>14}".format('Top clients', 'req/s', 'sent/s'))
+        for host, (requests, sent) in heapq.nlargest(rows, clients.items(),
+                key=lambda item: item[1]):
+            lines.append("{0:<40} {1:>10.1f} {2:>14}".format(host[:40],
+                requests / self.interval, human(sent / self.interval)))
+        lines.append("")
+        lines.append("{0:<40} {1:>10}".format('Top paths', 'req/s'))
+        for path, requests in heapq.nlargest(rows, paths.items(),
+                key=lambda item: item[1]):
+            lines.append("{0:<40} {1:>10.1f}".format(path[:40],
+                requests / self.interval))
+        return [line[:width] for line in lines]
+
+    def run(self):
+        """Redraws the dashboard until interrupted"""
+        tty = self.out.isatty()
+        deadline = time.time()
+        try:
+            while True:
+                # NOTE: Redraws on a fixed schedule however long drawing took
+                deadline += self.interval
+                time.sleep(max(0, deadline - time.time()))
+                size = shutil.get_terminal_size()
+                lines = self.render(width=size.columns, height=size.lines)
+                if tty: self.out.write('\x1b[H\x1b[2J')
+                self.out.write('\n'.join(lines) + '\n')
+                self.out.flush()
+        except KeyboardInterrupt:
+            pass
+
+
+def start(channel='statistics', interval=1.0):
+    """Starts collecting the channel and returns its Dashboard"""
+    from redis import Redis
+    import collector
+    store = MonitorStore()
+    c = collector.Collector(Redis(), [channel], store)
+    c.daemon = True
+    c.start()
+    return Dashboard(store, interval, collector=c)
+
 
 class Shell(cmd.Cmd):
     """Interactive Monitor Shell"""
     def do_greet(self, line):
         print('hello')
 
+    def do_top(self, line):
+        """top [interval] - show the live dashboard until CTRL+C"""
+        start(interval=float(line or 1)).run()
+
     def do_exit(self, line):
         """Documentation"""
         return True
 
 if __name__ == '__main__':
-    Shell().cmdloop()
+    interval = float(sys.argv[1]) if len(sys.argv) > 1 else 1.0
+    channel = sys.argv[2] if len(sys.argv) > 2 else 'statistics'
+    start(channel, interval).run()
@@ -7,7 +7,7 @@ TODO: About
 NAME = "bistro"
 VERSION = "0.0.2"
 
-__all__ = ["HttpHandler", "ForkingServer", "NonBlockingServer"]
+__all__ = ["HttpHandler", "ForkingServer", "NonBlockingServer", "AsyncioServer"]
 
 # Standard modules
 import socket
@@ -17,31 +17,160 @@ import subprocess
 import signal
 import errno
 import sys
+import stat
 import mimetypes
 import datetime
 import io
+import collections
+import binascii
+import email.utils
+import re
+import tempfile
 # Non-blocking IO
 import select
+import selectors
+import resource
 import time
+import traceback
+import asyncio
 from gevent.server import StreamServer
+from gevent.socket import wait_read, wait_write
 import config
 import stats
+import cache
+import compression
+import cgipool
+import httpparser
+import metrics
 import urllib
 from interface import Stats
 
-# Import correct config parser and queue
-if sys.version_info > (3, 0):
-    import configparser
-    import queue as queue
-else:
-    import ConfigParser
-    import Queue as queue
 # Community modules (optional)
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
 try:
     import magic
 except ImportError:
     pass
 
+class FileBody(object):
+    """A span of an open file queued to be sent after the response headers"""
+    def __init__(self, f, offset, count, owner=True):
+        """owner is False for all but the last of several spans that share
+one file, so that the file is closed once"""
+        self.file = f
+        self.offset = offset
+        self.remaining = count
+        self.owner = owner
+        # Cleared when sendfile(2) is not supported for this file or socket
+        self.sendfile = hasattr(os, 'sendfile')
+
+    def close(self):
+        if self.owner: self.file.close()
+
+class CgiProcess(object):
+    """Output source of a CGI script run as a child process"""
+    # Scripts closed before they exited, reaped by reap()
+    unreaped = []
+
+    @classmethod
+    def reap(cls):
+        """Reaps the closed scripts that exited since; never blocks"""
+        cls.unreaped[:] = [p for p in cls.unreaped if p.poll() is None]
+
+    def __init__(self, process):
+        self.process = process
+        self.fd = process.stdout.fileno()
+
+    def fileno(self):
+        return self.fd
+
+    def read(self, size):
+        """Returns output the script wrote; b'' at its end"""
+        return os.read(self.fd, size)
+
+    def close(self, finished=True):
+        """Reaps the script without waiting for it; one that has not finished
+is killed. A script still running is left to reap()"""
+        self.process.stdout.close()
+        if not finished and self.process.poll() is None: self.process.kill()
+        CgiProcess.reap()
+        if self.process.poll() is None: CgiProcess.unreaped.append(self.process)
+
+class CgiBody(object):
+    """The output of a running CGI script, streamed after the response
+headers as the script produces it"""
+    def __init__(self, source, timeout=0):
+        """source is the script's output: a CgiProcess or a request run by
+the CGI worker pool. A script that writes nothing for timeout seconds is
+killed (0 waits forever)"""
+        self.source = source
+        self.fd = source.fileno()
+        # NOTE: Reads never block; handlers wait for the script themselves
+        os.set_blocking(self.fd, False)
+        # Content-Length set by the script (None if it gave none); output
+        # past it is dropped. chunked frames the output with the chunked coding
+        self.length = None
+        self.chunked = False
+        # The header block read so far
+        self.head = b''
+        # Framed output waiting to be sent
+        self.pending = b''
+        self.eof = False
+        self.killed = False
+        self.timeout = timeout
+        self.touch()
+
+    def touch(self):
+        """Restarts the timeout after the script wrote output"""
+        self.deadline = time.time() + self.timeout if self.timeout > 0 else None
+
+    def remaining(self):
+        """returns the seconds left before the script times out (None if it
+never does)"""
+        if self.deadline is None: return None
+        return max(0, self.deadline - time.time())
+
+    def expired(self):
+        return self.deadline is not None and time.time() >= self.deadline
+
+    def kill(self):
+        """Ends the output early; the script is killed when the body is closed"""
+        self.killed = True
+        self.eof = True
+        self.pending = b''
+
+    def frame(self, data):
+        """Sets data read from the script as the pending output"""
+        if self.length is not None:
+            data = data[:self.length]
+            self.length -= len(data)
+        if data and self.chunked:
+            data = '{0:x}\r\n'.format(len(data)).encode() + data + b'\r\n'
+        self.pending = memoryview(data)
+
+    def feed(self, data):
+        """Frames output read from the script; b'' ends the output"""
+        if data:
+            self.frame(data)
+            return
+        self.eof = True
+        if self.chunked and not self.killed:
+            self.pending = memoryview(b'0\r\n\r\n')
+
+    def truncated(self):
+        """returns True if the script was killed or ended before its
+Content-Length"""
+        return self.eof and (self.killed or bool(self.length))
+
+    def close(self):
+        self.source.close(self.eof and not self.killed)
+
+# Queue items that stream a response body
+STREAMS = (FileBody, CgiBody)
+
 class HttpHandler():
     """ TODO """
     # NOTE: HttpHandler is implemented as a State Machine with six stages,
@@ -54,20 +183,20 @@ class HttpHandler():
     STAGE1 = -1
     STAGE2 = 0
     STAGE3 = 1
+    # Metrics of the handlers created without a server (see __init__)
+    shared_metrics = None
 
-    # XXX: Using StringIO rather than lists of string objects returned by
-    # recv() minimizes memory usage and fragmentation that occurs when
-    # rbufsize is large compared to the typical return value of recv().
-    # SOURCE: https://svn.python.org/projects/python/trunk/Lib/socket.py
+    # NOTE: Received data is kept by an incremental parser in a single
+    # bytearray that is scanned from saved offsets (see httpparser)
     def reset_buffer(self):
         """init and reset socket data buffer"""
-        self._input_buffer = b''
+        self._parser.reset()
 
     # Current request variables. When done, should be cleared with refresh()
     def refresh(self):
         """init and reset current request variables"""
         self._status_line = ''
-        self._headers = []
+        self._headers = httpparser.Headers()
         self._body = b''
         self._response = b''
         self._method = ''
@@ -76,26 +205,49 @@ class HttpHandler():
         self._content_length = ''
         self._content_type = ''
         self._cgi = False
+        self._file = None
         self._stage = self.STAGE1
 
-    # The outgoing message queue
-    #response_queue = queue.Queue()
+    # The outgoing message queue (a deque of bytes and FileBody items)
     # List of supported methods and a dictionarry of supported response codes
     _supported_methods = ['GET', 'HEAD', 'POST']
     _responses = {
         200: 'OK',
         201: 'Created',
+        206: 'Partial Content',
+        304: 'Not Modified',
         400: 'Bad Request',
         403: 'Forbidden',
         404: 'Not Found',
         414: 'Request URI Too Long',
+        416: 'Requested Range Not Satisfiable',
+        431: 'Request Header Fields Too Large',
         500: 'Internal Server Error',
         501: 'Not Implemented',
+        502: 'Bad Gateway',
+        504: 'Gateway Timeout',
         505: 'HTTP Version Not Supported'
     }
 
     # CRLF
     _lt = '\r\n'
+
+    # Last formatted Date header value as a (timestamp, string) tuple
+    _date = (None, '')
+
+    # Files up to this size are sent along with their headers in a single
+    # send() call; larger ones are streamed in SENDFILE_CHUNK sized pieces
+    SENDFILE_THRESHOLD = 16384
+    SENDFILE_CHUNK = 65536
+    # Largest piece of CGI output read (and so buffered) at a time
+    CGI_CHUNK = 65536
+    # End of the header block of a CGI script (which may use bare LFs)
+    CGI_HEADER_END = re.compile(b'\r?\n\r?\n')
+    # Maximum number of queued responses written with a single sendmsg()
+    try:
+        IOV_MAX = os.sysconf('SC_IOV_MAX')
+    except (AttributeError, ValueError, OSError):
+        IOV_MAX = 16
     
     # Error template
     ERROR_TEMPLATE = """<html>
@@ -126,9 +278,8 @@ class HttpHandler():
         #        'should be a socket instance')
         #if not isinstance(cfg, config.Config): raise TypeError('cfg parameter ' +
         #        'should be a Config instance')
-        self._input_buffer = b''
         self._status_line = ''
-        self._headers = []
+        self._headers = httpparser.Headers()
         self._body = b''
         self._response = b''
         self._method = ''
@@ -137,17 +288,69 @@ class HttpHandler():
         self._content_length = ''
         self._content_type = ''
         self._cgi = False
+        self._file = None
         self._stage = self.STAGE1
         self.close = True
         self.finished = False
-        self.response_queue = queue.Queue()
+        self.response_queue = collections.deque()
+        # Partially sent response item (a memoryview of what is left of it or
+        # a FileBody) and the chunk buffer used when a file cannot be sent
+        # with sendfile(2)
+        self._sending = None
+        # CGI response whose script has not written its header block yet (no
+        # further requests are processed until it did) and the CgiBody whose
+        # script the handler waits for in non-blocking mode
+        self._cgi_head = None
+        self._script = None
+        # Bytes queued but not sent yet, FileBody items included, and bytes
+        # sent (of them, the ones already published)
+        self.output_size = 0
+        self.sent_bytes = 0
+        self._published_bytes = 0
+        # Request latency: the time of the last read, the time the request
+        # being received started at, the numbers of items queued and of items
+        # completely sent, and a (last item, start time, status code) tuple
+        # of every response not sent yet
+        self._received = 0.0
+        self._started = None
+        self._queued = 0
+        self._completed = 0
+        self._timings = collections.deque()
+        self._chunk = None
+        self._sendmsg = hasattr(conn, 'sendmsg')
         self.conn = conn or None
+        # NOTE: Queued responses are already written in batches; without Nagle's
+        # algorithm the separate writes of streamed bodies are not held back
+        # waiting for the client's delayed ACK
+        if getattr(conn, 'family', None) in (socket.AF_INET, socket.AF_INET6):
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
         self.addr = addr or None
         self.server = server or None
-        self.cfg = cfg or None
+        # Latencies are recorded per server class
+        self.backend = type(server).__name__ if server else 'HttpHandler'
+        self.cfg = cfg or getattr(server, 'cfg', None)
+        # Request path resolutions and rendered responses shared by the
+        # server's handlers
+        self.path_cache = getattr(server, 'path_cache', None)
+        self.response_cache = getattr(server, 'response_cache', None)
+        if self.response_cache is None:
+            self.response_cache = cache.ResponseCache(0)
+        self.compressed_cache = getattr(server, 'compressed_cache', None)
+        if self.compressed_cache is None:
+            self.compressed_cache = cache.ResponseCache(0)
+        # Worker pool running Python CGI scripts, if configured
+        self.cgi_pool = getattr(server, 'cgi_pool', None)
+        # In-process counters of the server, served on metrics_path. Handlers
+        # without a server share one table
+        self.metrics = getattr(server, 'metrics', None)
+        if self.metrics is None:
+            if HttpHandler.shared_metrics is None:
+                HttpHandler.shared_metrics = metrics.Metrics()
+            self.metrics = HttpHandler.shared_metrics
         if not self.cfg:
             self.cfg = config.Config()
             self.cfg.defaults()
+        self.metrics_path = self.cfg.get('METRICS_PATH', '')
         if self.cfg.get('HTTP_VERSION') == 1.1: 
             self.version = 'HTTP/1.1'
         elif self.cfg.get('HTTP_VERSION') == 1.0: 
@@ -155,6 +358,15 @@ class HttpHandler():
         else:
             self.version = 'HTTP/1.0'
         self._version = self.version
+        self._parser = httpparser.RequestParser(self.cfg.get('MAX_URL'),
+                self.cfg.get('MAX_HEADERS'), self.cfg.get('MAX_HEADER_SIZE'))
+        # Reading and processing stop while more than high_water bytes are
+        # waiting to be sent (0 never stops)
+        self.high_water = self.cfg.get('OUTPUT_HIGH_WATER', 0)
+        # Requests served on this connection; once max_requests is reached
+        # the connection is closed (0 is unlimited)
+        self.requests = 0
+        self.max_requests = 0
  
     def finish(self):
         self.finished = True
@@ -163,20 +375,26 @@ class HttpHandler():
     def handle_loop(self):
         #self.server.stats.add_handler(self.addr, time.time())
         if __debug__: Stats.register(self.addr, time.time())
+        self.metrics.opened()
         while True:
             if not self.handle():
                 if __debug__: Stats.set_time(self.addr, 't_close', time.time())
+                self.metrics.closed()
                 #self.server.stats.close(self.addr, time.time())
                 return
-            if self.finished:
+            while self.finished:
                 #Stats.set_count(self.addr, 'success', '+')
                 #self.server.stats
                 #self.server.count_requests += 1
                 self.send()
+                if self.max_requests and self.requests >= self.max_requests:
+                    self.close = True
                 if self.close:
                     if __debug__: Stats.set_time(self.addr, 't_close', time.time())
+                    self.metrics.closed()
                     #self.server.stats.close(self.addr)
                     return
+                if not self.resume(): break
 
     #@profile
     def handle(self):
@@ -188,69 +406,119 @@ class HttpHandler():
             # XXX: this closes the connection and does not produce a response
             # There should be a better way to account for this
             return False
+        self.process()
+        return True
+
+    def feed(self, data):
+        """Processes data the server received for this connection; used
+instead of handle() when the handler does not read the socket itself"""
+        self._received = time.monotonic()
+        self._parser.feed(data)
+        self.process()
+
+    def process(self):
+        """Processes every complete request in the input buffer. Responses
+are queued in the order the requests were received"""
+        self.finished = False
+        while not self.paused() and self.step():
+            pass
+
+    def resume(self):
+        """Processes requests left in the input buffer after the output
+drained below the high-water mark. Returns True if any request was answered"""
+        if self.close or self.paused() or not len(self._parser): return False
+        self.process()
+        return self.finished
+
+    def paused(self):
+        """returns True while queued output is over the high-water mark or a
+CGI script has not written its header block yet"""
+        if self._cgi_head is not None: return True
+        return self.high_water > 0 and self.output_size > self.high_water
+
+    def reading(self):
+        """returns False while the handler is paused and holds more input than
+a request line and header block may take; further input is left in the
+socket buffer until it resumes"""
+        if not self.paused(): return True
+        parser = self._parser
+        return len(parser) < parser.max_line + parser.max_header_size
+
+    def waiting(self):
+        """returns the CgiBody of the script the handler waits for before it
+can send anything else, or None"""
+        return self._script
+
+    def step(self):
+        """Advances the state machine. Returns True if a request was answered
+and the connection stays open, so another one may follow"""
         # Check stage
         if self._stage == self.STAGE1:
-            self.finished = False
             #if __debug__: print("-----STAGE 1-----")
-            if self.status_line_recieved():
-                #if __debug__: print("Status line received:\r\n" \
-                #        + self.__status_line)
-                if self.status_line_parse():
-                    #if __debug__: print("Status line parsed")
-                    if self._version == 'HTTP/0.9':
-                        self.queue_file()
-                        # XXX: The follwing call should be moved to queue_file
-                        #and send_error (calle it queue_error)
-                        self.finish()
-                    else:
-                        self._stage = self.STAGE2
-                else:
-                    self.finish()
-                #error was sent
+            # NOTE: Bytes left over from a previous request are timed from
+            # the last read
+            if self._started is None and len(self._parser):
+                self._started = self._received
+            if not self.status_line_recieved(): return False
+            if not self.status_line_parse():
+                self.finish()
+                return False #error was sent
+            if __debug__: Stats.set_path(self._path)
+            if self._version == 'HTTP/0.9':
+                if self.validate_path(): self.queue_file()
+                self.finish()
+                return False
+            self._stage = self.STAGE2
         if self._stage == self.STAGE2:
             #if __debug__: print("-----STAGE 2-----")
-            if self.headers_recieved():
-                #if __debug__: print("Headers received:\r\n" + str(self.__headers))
-                if self.headers_parse():
-                    if self._cgi:
-                        if self._method == 'POST' and \
-                                self._content_length != '' and \
-                                self._content_length != '0':
-                            self._stage = self.STAGE3
-                        else:
-                            self.queue_cgi()
-                    else:
-                        #if __debug__: print("Headers parsed")
-                        self.queue_file()
-                        #if __debug__:
-                        #    print("Queued files:" + str(self.response_queue.qsize()))
-                        #    print("Close:" + str(self.close))
-                        #    print("Finished:" + str(self.finished))
-                        self.finish()
-                else:
-                    self.finish()
+            if not self.headers_recieved(): return False
+            #if __debug__: print("Headers received:\r\n" + str(self.__headers))
+            self.headers_parse()
+            # NOTE: The last request a connection may serve closes it, so
+            # that pipelined requests after it are not processed
+            if self.max_requests and self.requests + 1 >= self.max_requests:
+                self.close = True
+            if 'transfer-encoding' in self._headers:
+                # NOTE: Chunked request bodies are not supported
+                self.close = True
+                self.send_error(501)
+                return False
+            if self._content_length != '' and self._content_length != '0':
+                self._stage = self.STAGE3
+            else:
+                self.dispatch()
+                return not self.close
         if self._stage == self.STAGE3:
             #if __debug__: print("------STAGE 3------")
-            if self.body_received():
-                #if __debug__: print("Body received:\r\n" + str(self.__body))
-                self.queue_cgi()
-            else:
-                self.finish()
-        return True
+            # NOTE: Waits in this stage until the whole body was received
+            if not self.body_received(): return False
+            #if __debug__: print("Body received:\r\n" + str(self.__body))
+            self.dispatch()
+        return not self.close
+
+    def dispatch(self):
+        """Answers a completely received request"""
+        if self.metrics_path and \
+                self._path.partition('?')[0] == self.metrics_path:
+            self.queue_metrics()
+        elif self.validate_path():
+            if self._cgi: self.queue_cgi()
+            else: self.queue_file()
+        self.finish()
 
     def body_received(self):
-        """"""
+        """returns True if the request body was received"""
         try:
-            print(self._content_length)
-            print(self._input_buffer)
-            # XXX: Better slicing?
             l = int(self._content_length)
-            self._body = self._input_buffer[0:l] # XXX:l+1?
-            if len(self._body) < l: raise ValueError
-            self._input_buffer = self._input_buffer[l:]
-            return True
+            if l < 0: raise ValueError
         except ValueError:
+            self.close = True
+            self.send_error(400)
             return False
+        body = self._parser.read(l)
+        if body is None: return False
+        self._body = body
+        return True
 
     #@profile
     def recv(self):
@@ -258,7 +526,7 @@ class HttpHandler():
         # Read until the socket blocks
         # XXX: Better use file handlers
         #if __debug__: print("Receiving..")
-        while True:
+        while self.reading():
             try:
                 data = self.conn.recv(self.cfg.get('REQ_BUFFSIZE'))
                 #if __debug__: print("Received data: \r\n{}".format(str(data)))
@@ -267,7 +535,8 @@ class HttpHandler():
                 # detect invalid queries if \r\n was not reached
                 data = data if data != b'\xff\xf4\xff\xfd\x06' else None
                 if data:
-                    self._input_buffer += data
+                    self._received = time.monotonic()
+                    self._parser.feed(data)
                 else:
                 # NOTE:client closed connection
                     self.close = True
@@ -282,42 +551,247 @@ class HttpHandler():
         return True
 
     def send(self):
-        """returns void"""
-        try:
-            next_response = self.response_queue.get_nowait()
-        except queue.Empty:
-            #if __debug__: print("Queue is empty")
-            return False
-        else:
-            # XXX: Needs error handling
+        """Sends queued responses until the queue is drained or the socket
+would block. Consecutive responses are sent together with one sendmsg()
+call. Returns True if nothing is left to send"""
+        output = self.response_queue
+        while True:
+            item = self._sending
+            if item is None:
+                if not output:
+                    if self._cgi_head is None: return True
+                    # NOTE: The response of a CGI script is queued once its
+                    # header block was read
+                    if not self.read_cgi_headers(): return False
+                    continue
+                item = output.popleft()
+            batch = None
             try:
-                self.conn.send(next_response)
-                #if __debug__: print("{0}:{1} - - [{2}] \"{3}\" {4} -"
-                #.format(self.addr[0], self.addr[1],
-                #time.strftime("%d/%m/%Y %H:%M:%S", time.localtime()),
-                #next_response.decode().split('\r\n',1)[0], self.code))
-            except (socket.error) as e:
-                print(e)
-                pass
-            return True
+                if isinstance(item, FileBody):
+                    done = self.send_file(item)
+                elif isinstance(item, CgiBody):
+                    done = self.send_cgi(item)
+                elif output and self._sendmsg and not isinstance(output[0], STREAMS):
+                    batch = [item]
+                    while output and len(batch) < self.IOV_MAX and \
+                            not isinstance(output[0], STREAMS):
+                        batch.append(output.popleft())
+                    sent = self.conn.sendmsg(batch)
+                    self.output_size -= sent
+                    self.sent_bytes += sent
+                    for i, buf in enumerate(batch):
+                        if sent < len(buf): break
+                        sent -= len(buf)
+                    else:
+                        i, buf, sent = len(batch) - 1, batch[-1], len(batch[-1])
+                    if i: self.completed(i)
+                    # Put back whatever was not sent
+                    output.extendleft(reversed(batch[i + 1:]))
+                    done = sent == len(buf)
+                    # NOTE: A memoryview resumes the write without copying
+                    if not done: item = memoryview(buf)[sent:]
+                else:
+                    sent = self.conn.send(item)
+                    self.output_size -= sent
+                    self.sent_bytes += sent
+                    done = sent == len(item)
+                    if not done: item = memoryview(item)[sent:]
+            except (socket.error, IOError) as e:
+                if batch: output.extendleft(reversed(batch[1:]))
+                if e.errno == errno.EINTR:
+                    done = False
+                elif e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    self._sending = item
+                    return False
+                else:
+                    # NOTE: The client went away (EPIPE, ECONNRESET, etc.);
+                    # nothing queued can be delivered anymore
+                    self._sending = item
+                    self.discard()
+                    self.close = True
+                    return True
+            if done:
+                if isinstance(item, STREAMS): item.close()
+                self._sending = None
+                self.completed()
+            else:
+                self._sending = item
+                if self.conn.gettimeout() == 0: return False
+
+    def send_file(self, body):
+        """Streams a FileBody to the socket using sendfile(2), falling back to
+reading it in chunks. Returns True when the body was completely sent and
+False when a non-blocking socket would block"""
+        while body.remaining > 0:
+            try:
+                if body.sendfile:
+                    try:
+                        sent = os.sendfile(self.conn.fileno(), body.file.fileno(),
+                                body.offset, min(body.remaining, self.SENDFILE_CHUNK))
+                    except OSError as e:
+                        if e.errno not in (errno.EINVAL, errno.ENOSYS,
+                                errno.EOPNOTSUPP, errno.ENOTSOCK):
+                            raise
+                        body.sendfile = False
+                        continue
+                else:
+                    sent = self.send_file_chunk(body)
+            except (socket.error, IOError) as e:
+                if e.errno == errno.EINTR: continue
+                if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK): raise
+                if self.conn.gettimeout() == 0: return False
+                # Sockets with a timeout are non-blocking at the OS level
+                self.wait_write()
+                continue
+            if sent == 0:
+                # NOTE: The file was truncated; the promised Content-Length
+                # can no longer be honoured
+                self.output_size -= body.remaining
+                self.close = True
+                return True
+            body.offset += sent
+            body.remaining -= sent
+            self.output_size -= sent
+            self.sent_bytes += sent
+        return True
+
+    def send_cgi(self, body):
+        """Streams the output of a CgiBody as the script produces it, one
+CGI_CHUNK at a time. Returns True when the output was completely sent and
+False when a non-blocking socket would block"""
+        while True:
+            if not body.pending:
+                if body.eof: break
+                data = b''
+                if body.length != 0:
+                    data = self.read_script(body)
+                    if data is None: return False
+                body.feed(data)
+                self.output_size += len(body.pending)
+                continue
+            try:
+                sent = self.conn.send(body.pending)
+            except (socket.error, IOError) as e:
+                if e.errno == errno.EINTR: continue
+                if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK): raise
+                if self.conn.gettimeout() == 0: return False
+                # Sockets with a timeout are non-blocking at the OS level
+                self.wait_write()
+                continue
+            body.pending = body.pending[sent:]
+            self.output_size -= sent
+            self.sent_bytes += sent
+        # NOTE: The promised Content-Length can no longer be honoured
+        if body.truncated(): self.close = True
+        return True
+
+    def read_script(self, body):
+        """Reads the next output of the script of a CgiBody. Handlers with a
+blocking socket wait for it; with a non-blocking socket None is returned if
+there is none yet, and waiting() returns the body until the server calls
+send() again. A script that writes nothing for its timeout is killed and
+b'' returned"""
+        while True:
+            try:
+                data = body.source.read(self.CGI_CHUNK)
+            except (socket.error, OSError) as e:
+                if e.errno == errno.EINTR: continue
+                if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    # NOTE: Treated as the end of the output
+                    data = b''
+                elif body.expired():
+                    print("ERROR CGI script timed out after {0}s".format(
+                        body.timeout))
+                    body.kill()
+                    data = b''
+                elif self.conn.gettimeout() == 0:
+                    self._script = body
+                    return None
+                else:
+                    self.wait_script(body)
+                    continue
+            self._script = None
+            body.touch()
+            return data
+
+    def wait_script(self, body):
+        """Blocks until the script of a CgiBody wrote output or timed out"""
+        poller = select.poll()
+        poller.register(body.fd, select.POLLIN)
+        timeout = body.remaining()
+        poller.poll(None if timeout is None else timeout * 1000)
+
+    def send_file_chunk(self, body):
+        """Reads the next chunk of a FileBody into a reusable buffer and sends it"""
+        if self._chunk is None:
+            self._chunk = memoryview(bytearray(self.SENDFILE_CHUNK))
+        body.file.seek(body.offset)
+        n = body.file.readinto(self._chunk[:min(body.remaining, self.SENDFILE_CHUNK)])
+        if not n: return 0
+        return self.conn.send(self._chunk[:n])
+
+    def wait_write(self):
+        """Blocks until the socket is writable or its timeout expires"""
+        poller = select.poll()
+        poller.register(self.conn.fileno(), select.POLLOUT)
+        timeout = self.conn.gettimeout()
+        if not poller.poll(None if timeout is None else timeout * 1000):
+            raise socket.timeout('timed out')
+
+    def completed(self, count=1):
+        """Counts queued items that were completely sent and records the
+latency of the responses they ended"""
+        self._completed += count
+        timings = self._timings
+        if not timings or timings[0][0] > self._completed: return
+        now = time.monotonic()
+        while timings and timings[0][0] <= self._completed:
+            _, started, code = timings.popleft()
+            self.metrics.observe(now - started)
+            if __debug__: Stats.set_latency('{0}/{1}xx'.format(self.backend,
+                code // 100), now - started)
+        sent = self.sent_bytes - self._published_bytes
+        self.metrics.sent(sent)
+        if __debug__: Stats.set_count(self.addr, 'bytes', sent)
+        self._published_bytes = self.sent_bytes
+
+    def pending(self):
+        """returns True if there are responses waiting to be sent"""
+        return self._sending is not None or len(self.response_queue) > 0 or \
+                self._cgi_head is not None
+
+    def discard(self):
+        """Drops every queued response, closing the files of FileBody items
+and killing CGI scripts that are still running"""
+        if self._sending is not None: self.response_queue.appendleft(self._sending)
+        if self._cgi_head is not None: self.response_queue.append(self._cgi_head)
+        for item in self.response_queue:
+            if isinstance(item, STREAMS): item.close()
+        self.response_queue.clear()
+        self._sending = None
+        self._cgi_head = None
+        self._script = None
+        self.output_size = 0
+        self._completed = self._queued
+        self._timings.clear()
 
     #@profile
     def status_line_recieved(self):
         """returns True if status line was recieved"""
         try:
-            self._status_line, self._input_buffer = \
-                    self._input_buffer.split(self._lt.encode('utf-8'), 1)
-            self._status_line = self._status_line.decode('utf-8')
-            #self.server.stats.add_received(self.addr)
-            if __debug__: Stats.set_count(self.addr, 'recv', '+')
-            return True
-        except ValueError:
-            if len(self._input_buffer) > self.cfg.get('MAX_URL'):
-                self.send_error(414)
-                self.refresh()
-                # NOTE: Reset input buffer
-                self.reset_buffer()
+            line = self._parser.parse_request_line()
+        except httpparser.ParseError as e:
+            self.close = True
+            self.send_error(e.code)
+            self.refresh()
+            # NOTE: Reset input buffer
+            self.reset_buffer()
             return False
+        if line is None: return False
+        self._status_line = line.decode('utf-8', 'surrogateescape')
+        #self.server.stats.add_received(self.addr)
+        if __debug__: Stats.set_count(self.addr, 'recv', '+')
+        return True
 
     #n@profile
     def status_line_parse(self):
@@ -325,20 +799,20 @@ class HttpHandler():
         status_line = self._status_line.strip()
         status_line = status_line.split(' ')
         #print(status_line)
+        # NOTE: Closes on errors; a valid HTTP/1.1 version keeps it open
+        self.close = True
         # HTTP/1.0 and HTTP/1.1
         if len(status_line) == 3:
             self._method, self._path, self._version = status_line
-            if self.validate_version() and self.validate_method() \
-                    and self.validate_path(): return True
+            if self.validate_version() and self.validate_method(): return True
+            self.close = True
+            return False #error was sent
         # HTTP/0.9
         elif len(status_line) == 2:
             self._version = 'HTTP/0.9'
             self._method, self._path = status_line
-            if self._method == 'GET' and self.validate_path(): \
-                    return True
-            self.send_error(400)
+            if self._method == 'GET': return True
         # Bad request
-        self.close = True
         self.send_error(400)
         return False
 
@@ -374,6 +848,7 @@ class HttpHandler():
     def validate_method(self, method=None):
         if not method: method = self._method
         if method not in self._supported_methods:
+            self.close = True
             self.send_error(501)
             return False
         return True
@@ -398,88 +873,131 @@ class HttpHandler():
         path = self.cfg.get('PUBLIC_DIR') + path
         # CGI?
         # FIXME: Replace input with configurable i.e. CGIDIR, DIRCGI, CGIPATH
-        if path.startswith(self.cfg.get('CGI_DIR') + "/"):
-            if self._version == 'HTTP/0.9':
-                self.send_error(403)
-                return False
-            if os.path.isfile(path):
-                self._filename = os.path.basename(path)
-                self._cgi = True
-                self._path = path
-                return True
+        if self._version == 'HTTP/0.9' and \
+                path.startswith(self.cfg.get('CGI_DIR') + "/"):
+            self.send_error(403)
+            return False
+        entry = self.resolve_path(path)
+        if entry.kind == cache.CGI:
+            self._filename = os.path.basename(entry.path)
+            self._cgi = True
+            self._path = entry.path
+            return True
+        # Directory without index files?
+        if entry.kind == cache.DIRECTORY:
+            #self.send_error(403)
+            self.list_directory(entry.path)
+            return False
+        # File?
+        if entry.kind == cache.FILE:
+            self._path = entry.path
+            self._file = entry
+            return True
+        # Not found
+        self.send_error(404)
+        return False
+
+    def resolve_path(self, path):
+        """Returns the Resolution of a filesystem path, using the path cache
+when the server has one"""
+        if self.path_cache is not None:
+            entry = self.path_cache.get(path)
+            if entry is not None: return entry
+        entry = self._resolve_path(path)
+        if self.path_cache is not None: self.path_cache.put(path, entry)
+        return entry
+
+    def _resolve_path(self, path):
+        """Resolves a filesystem path with a single stat call per candidate"""
+        fs = self.stat_path(path)
+        if fs and stat.S_ISREG(fs.st_mode) and \
+                path.startswith(self.cfg.get('CGI_DIR') + "/"):
+            return cache.Resolution(cache.CGI, path, fs.st_size, fs.st_mtime, None,
+                    None, None)
         # Directory?
-        if os.path.isdir(path):
+        if fs and stat.S_ISDIR(fs.st_mode):
             for index in self.cfg.get('INDEX_FILES'):
                 #index = os.path.join(path, index) #TOO SLOW
                 if path.endswith("/"): index = path + index
                 else: index = path + "/" + index
-                if os.path.isfile(index):
-                    path = index
-                    break
-            else:
-                #self.send_error(403)
-                self.list_directory(path)
-                return False
+                fs = self.stat_path(index)
+                if fs and stat.S_ISREG(fs.st_mode):
+                    return self.file_resolution(index, fs)
+            return cache.Resolution(cache.DIRECTORY, path, None, None, None, None,
+                    None)
         # File?
-        if os.path.isfile(path):
-            self._path = path
-            return True
+        if fs and stat.S_ISREG(fs.st_mode):
+            return self.file_resolution(path, fs)
         # Strip /; check again
-        path = path.rstrip("/")
-        if os.path.isfile(path):
-            self._path = path
-            return True
-        # Not found
-        self.send_error(404)
-        return False
+        if path.endswith("/"):
+            path = path.rstrip("/")
+            fs = self.stat_path(path)
+            if fs and stat.S_ISREG(fs.st_mode):
+                return self.file_resolution(path, fs)
+        return cache.Resolution(cache.MISSING, path, None, None, None, None, None)
+
+    def file_resolution(self, path, fs):
+        """Returns a file Resolution from the path and its stat result"""
+        return cache.Resolution(cache.FILE, path, fs.st_size, fs.st_mtime,
+                self.get_file_type(path), self.file_etag(fs),
+                self.file_sidecars(path, fs))
+
+    def file_sidecars(self, path, fs):
+        """returns a dictionary mapping content codings to (path, size) tuples
+of the precompressed variants of a file that are at least as new as it"""
+        sidecars = {}
+        for coding, suffix in compression.SUFFIXES.items():
+            sfs = self.stat_path(path + suffix)
+            if sfs and stat.S_ISREG(sfs.st_mode) and sfs.st_mtime >= fs.st_mtime:
+                sidecars[coding] = (path + suffix, sfs.st_size)
+        return sidecars
+
+    def file_etag(self, fs):
+        """returns a weak entity tag built from the inode, size and
+modification time of a stat result"""
+        return 'W/"{0:x}-{1:x}-{2:x}"'.format(fs.st_ino, fs.st_size,
+                int(fs.st_mtime * 1000000))
+
+    def stat_path(self, path):
+        """Returns os.stat(path) or None if it cannot be accessed"""
+        try:
+            return os.stat(path)
+        except OSError:
+            return None
 
     #@profile
     def headers_recieved(self):
         """returns True if headers were received"""
-        # FIXME: Should validate headers, ignore bad headers, or send 400
         try:
-            while True:
-                header, self._input_buffer = \
-                        self._input_buffer.split(self._lt.encode('utf-8'), 1)
-                if not header: break
-                self._headers.append(header.decode('utf-8'))
-            return True
-        except ValueError:
+            headers = self._parser.parse_headers()
+        except httpparser.ParseError as e:
+            self.close = True
+            self.send_error(e.code)
+            self.reset_buffer()
             return False
+        if headers is None: return False
+        self._headers = headers
+        return True
+
     #@profile
     def headers_parse(self):
-        # XXX: Currently ignores badly formed request headers
-        # FIXME: Should close connection in HTTP/1.0 unless keep-alive was
-        # specified.
-        connection = ''
-        for line in self._headers:
-            #print(line)
-            try:
-                f, v = [x.strip() for x in line.split(':', 1)]
-                if f.lower() == 'connection':
-                    if v.lower() == 'close':
-                        connection = v.lower()
-                    elif v.lower() == 'keep-alive':
-                        connection = v.lower()
-                elif f.lower() == 'content-length':
-                    self._content_length = v
-                elif f.lower() == 'content-type':
-                    self._content_type = v
-            except:
-                # XXX: Should handle this
-                pass
+        connection = self._headers.get('connection', '').lower()
+        self._content_length = self._headers.get('content-length', '')
+        self._content_type = self._headers.get('content-type', '')
         # Check if connection header was set
-        #print(connection)
-        if len(connection) > 0:
-            self.close = True if connection == 'close' else False
+        if connection == 'close':
+            self.close = True
+        elif connection == 'keep-alive':
+            self.close = False
         else:
             if self._version == 'HTTP/0.9' or self._version == 'HTTP/1.0':
                 self.close = True
             else: self.close = False # HTTP/1.1
         return True
 
-    def send_error(self, code):
-        """adds error to response queue"""
+    def send_error(self, code, headers=()):
+        """adds error to response queue; headers is a sequence of additional
+(name, value) pairs"""
         try:
             msg = self._responses[code]
         except KeyError:
@@ -495,6 +1013,7 @@ class HttpHandler():
             else: self.add_header('Connection', 'keep-alive')
             self.add_header('Content-Type', 'text-html')
             self.add_header('Content-Length', str(c_size))
+            for name, value in headers: self.add_header(name, value)
         self.add_end_header()
         self._response += content
         self.queue_response()
@@ -502,36 +1021,289 @@ class HttpHandler():
         if __debug__: Stats.set_count(self.addr, 'error', '+')
         # TODO: Add message boyd
 
-    def queue_response(self):
-        """adds current response to response queue and resets current vars"""
-        self.response_queue.put(self._response)
+    def queue_response(self, *body):
+        """adds current response (and the FileBody or bytes items of the body
+that follow it) to response queue and resets current vars"""
+        self.response_queue.append(self._response)
+        self.output_size += len(self._response)
+        self._queued += 1
+        for item in body:
+            if item is None: continue
+            self.response_queue.append(item)
+            self._queued += 1
+            if isinstance(item, FileBody): self.output_size += item.remaining
+            elif isinstance(item, CgiBody): self.output_size += len(item.pending)
+            else: self.output_size += len(item)
+        self._timings.append((self._queued, self._started or self._received,
+            self.code))
+        self.metrics.request(self._method, self.code)
+        self._started = None
+        self.requests += 1
         self.refresh()
         self.finish()
 
     #@profile
     def queue_file(self):
         """adds a file to response queue"""
+        resolved = self._file is not None and self._file.path == self._path
+        responses = self.response_cache
+        conditional = self._version != 'HTTP/0.9' and \
+                self._method in ('GET', 'HEAD')
+        ranged = conditional and self._method == 'GET' and 'range' in self._headers
+        # NOTE: Range requests are always answered from the unencoded file
+        if resolved and conditional and not ranged:
+            coding = self.select_coding(self._file)
+            if coding and self.queue_encoded(self._file, coding): return
+        # NOTE: Validated against the resolution, so the file is not opened
+        if resolved and conditional and self.not_modified(self._file):
+            self.queue_not_modified(self._file)
+            return
+        if resolved and not ranged and self._version != 'HTTP/0.9' and \
+                responses.enabled():
+            cached = responses.get(self._path, self._file.mtime)
+            if cached:
+                self.queue_cached(cached)
+                return
         try:
-            with io.open(self._path, 'rb') as f:
-                self.add_response(200, 'OK')
-                if self._version != 'HTTP/0.9':
-                    size, mtime = self.get_file_info(f)
-                    self.add_header('Content-Length', str(size))
-                    if self.close: self.add_header('Connection', 'close')
-                    else: self.add_header('Connection', 'keep-alive')
-                    self.add_header('Content-Type', self.get_file_type(self._path))
-                self.add_end_header()
-                if self._method != 'HEAD': self._response += f.read()
-                self.queue_response()
-                # NOTE: stats
-                #self.server.stats.add_success(self.addr)
-                if __debug__: Stats.set_count(self.addr, 'success', '+')
+            f = io.open(self._path, 'rb')
         # XXX: OSError, etc.?
         except IOError as e:
             if e.errno == errno.EACCES:
                 self.send_error(403)
             else:
                 self.send_error(500)
+            return
+        if resolved: entry = self._file
+        else: entry = self.file_resolution(self._path, os.fstat(f.fileno()))
+        size, mtime, mime = entry.size, entry.mtime, entry.mime
+        if ranged and self.if_range(entry):
+            ranges = httpparser.parse_range(self._headers['range'], size)
+            if ranges is not None:
+                self.queue_ranges(f, ranges, entry)
+                return
+        self.add_response(200, 'OK')
+        if self._version != 'HTTP/0.9':
+            start = len(self._response)
+            self.add_header('Content-Length', str(size))
+            self.add_header('Content-Type', mime)
+            self.add_header('Accept-Ranges', 'bytes')
+            self.add_validators(entry)
+            headers = self._response[start:]
+            if self.close: self.add_header('Connection', 'close')
+            else: self.add_header('Connection', 'keep-alive')
+        self.add_end_header()
+        body = None
+        if self._method == 'HEAD' or size == 0:
+            f.close()
+        elif size <= self.SENDFILE_THRESHOLD or size <= responses.max_file:
+            with f: content = f.read(size)
+            # NOTE: The file shrank since it was resolved
+            if len(content) < size: self.close = True
+            elif self._version != 'HTTP/0.9':
+                responses.put(self._path, mtime, headers, content)
+            self._response += content
+        else:
+            body = FileBody(f, 0, size)
+        self.queue_response(body)
+        # NOTE: stats
+        #self.server.stats.add_success(self.addr)
+        if __debug__: Stats.set_count(self.addr, 'success', '+')
+
+    def add_validators(self, entry, etag=None):
+        """Writes the Last-Modified and ETag headers of a file Resolution (etag
+overrides the one of the unencoded file) and Vary if it has encoded
+variants"""
+        self.add_header('Last-Modified', self.last_modified(entry.mtime))
+        self.add_header('ETag', etag or entry.etag)
+        if entry.encodings or self.compressible(entry):
+            self.add_header('Vary', 'Accept-Encoding')
+
+    def compressible(self, entry):
+        """returns True if a file Resolution may be compressed on the fly"""
+        return self.cfg.get('COMPRESSION_LEVEL', 0) > 0 and \
+                self.cfg.get('COMPRESSION_MIN_SIZE', 0) <= entry.size <= \
+                self.cfg.get('COMPRESSION_MAX_FILE', 0) and \
+                compression.compressible(entry.mime)
+
+    def select_coding(self, entry):
+        """returns the content coding of a file Resolution preferred by the
+Accept-Encoding header or None to send it unencoded. Codings with higher
+q values win; ties are broken in compression.CODINGS order"""
+        value = self._headers.get('accept-encoding')
+        if not value: return None
+        accepted = httpparser.parse_qlist(value)
+        if 'x-gzip' in accepted: accepted.setdefault('gzip', accepted['x-gzip'])
+        on_the_fly = self.compressible(entry)
+        best, best_q = None, 0
+        for coding in compression.CODINGS:
+            q = accepted.get(coding, accepted.get('*', 0))
+            if q > best_q and (coding in entry.encodings or \
+                    (on_the_fly and compression.available(coding))):
+                best, best_q = coding, q
+        return best
+
+    def queue_encoded(self, entry, coding):
+        """adds a file Resolution encoded with coding to response queue, from
+its sidecar file or compressed on the fly through the compressed cache.
+Returns False if the encoded variant cannot be read"""
+        etag = entry.etag[:-1] + '-' + coding + '"'
+        if self.not_modified(entry, etag):
+            self.queue_not_modified(entry, etag)
+            return True
+        body = None
+        content = b''
+        if coding in entry.encodings:
+            path, size = entry.encodings[coding]
+            try:
+                f = io.open(path, 'rb')
+            except IOError:
+                return False
+            if self._method == 'HEAD':
+                f.close()
+            elif size <= self.SENDFILE_THRESHOLD:
+                with f: content = f.read(size)
+                # NOTE: The sidecar shrank since it was resolved
+                if len(content) < size: self.close = True
+            else:
+                body = FileBody(f, 0, size)
+        else:
+            key = (entry.path, coding)
+            cached = self.compressed_cache.get(key, entry.mtime)
+            if cached:
+                content = cached.body
+            else:
+                try:
+                    with io.open(entry.path, 'rb') as f: data = f.read(entry.size)
+                except IOError:
+                    return False
+                content = compression.compress(data, coding,
+                        self.cfg.get('COMPRESSION_LEVEL'))
+                # NOTE: A file that changed since it was resolved is not cached
+                if len(data) == entry.size:
+                    self.compressed_cache.put(key, entry.mtime, b'', content)
+            size = len(content)
+            if self._method == 'HEAD': content = b''
+        self.add_response(200, 'OK')
+        self.add_header('Content-Length', str(size))
+        self.add_header('Content-Type', entry.mime)
+        self.add_header('Content-Encoding', coding)
+        self.add_validators(entry, etag)
+        if self.close: self.add_header('Connection', 'close')
+        else: self.add_header('Connection', 'keep-alive')
+        self.add_end_header()
+        self._response += content
+        self.queue_response(body)
+        if __debug__: Stats.set_count(self.addr, 'success', '+')
+        return True
+
+    def last_modified(self, mtime):
+        """returns a modification time formatted as an HTTP date"""
+        return self.httpdate(datetime.datetime.utcfromtimestamp(int(mtime)))
+
+    def not_modified(self, entry, etag=None):
+        """returns True if the conditional headers of the request show that the
+client's copy of a file Resolution (or of its variant tagged etag) is
+current. If-None-Match takes precedence over If-Modified-Since"""
+        etag = etag or entry.etag
+        value = self._headers.get('if-none-match')
+        if value is not None:
+            if value.strip() == '*': return True
+            # NOTE: Weak comparison, the W/ prefixes are ignored
+            for tag in value.split(','):
+                tag = tag.strip()
+                if tag.startswith('W/'): tag = tag[2:]
+                if tag == etag[2:]: return True
+            return False
+        value = self._headers.get('if-modified-since')
+        if value is None: return False
+        try:
+            since = email.utils.mktime_tz(email.utils.parsedate_tz(value))
+        except (TypeError, ValueError, OverflowError):
+            return False
+        return int(entry.mtime) <= since
+
+    def queue_not_modified(self, entry, etag=None):
+        """adds a bodyless 304 response for a file Resolution to response queue"""
+        self.add_response(304)
+        self.add_validators(entry, etag)
+        if self.close: self.add_header('Connection', 'close')
+        else: self.add_header('Connection', 'keep-alive')
+        self.add_end_header()
+        self.queue_response()
+        if __debug__: Stats.set_count(self.addr, 'not_modified', '+')
+
+    def if_range(self, entry):
+        """returns True unless an If-Range header names another version of a
+file Resolution. Dates must match its modification time exactly; entity
+tags never match, as If-Range needs a strong one and only weak ones are
+sent"""
+        value = self._headers.get('if-range')
+        if value is None: return True
+        return value == self.last_modified(entry.mtime)
+
+    def queue_ranges(self, f, ranges, entry):
+        """adds a 206 response with the requested spans of an open file to
+response queue, or a 416 error if none of the ranges is satisfiable. More
+than one range is sent as a multipart/byteranges body"""
+        size, mime = entry.size, entry.mime
+        if not ranges:
+            f.close()
+            self.send_error(416, [('Content-Range', 'bytes */{0}'.format(size))])
+            return
+        self.add_response(206)
+        if len(ranges) == 1:
+            first, last = ranges[0]
+            self.add_header('Content-Range', 'bytes {0}-{1}/{2}'\
+                    .format(first, last, size))
+            self.add_header('Content-Type', mime)
+            body = [FileBody(f, first, last - first + 1)]
+        else:
+            boundary = binascii.hexlify(os.urandom(12)).decode()
+            body = []
+            for first, last in ranges:
+                body.append('\r\n--{0}\r\nContent-Type: {1}\r\n'
+                        'Content-Range: bytes {2}-{3}/{4}\r\n\r\n'\
+                        .format(boundary, mime, first, last, size).encode())
+                body.append(FileBody(f, first, last - first + 1, False))
+            body[-1].owner = True
+            body.append('\r\n--{0}--\r\n'.format(boundary).encode())
+            self.add_header('Content-Type',
+                    'multipart/byteranges; boundary=' + boundary)
+        length = sum(item.remaining if isinstance(item, FileBody) else len(item)
+                for item in body)
+        self.add_header('Content-Length', str(length))
+        self.add_header('Accept-Ranges', 'bytes')
+        self.add_validators(entry)
+        if self.close: self.add_header('Connection', 'close')
+        else: self.add_header('Connection', 'keep-alive')
+        self.add_end_header()
+        self.queue_response(*body)
+        if __debug__: Stats.set_count(self.addr, 'success', '+')
+
+    def queue_cached(self, cached):
+        """adds a response served from the response cache to response queue"""
+        self.add_response(200, 'OK')
+        self._response += cached.headers
+        if self.close: self.add_header('Connection', 'close')
+        else: self.add_header('Connection', 'keep-alive')
+        self.add_end_header()
+        if self._method != 'HEAD': self._response += cached.body
+        self.queue_response()
+        if __debug__: Stats.set_count(self.addr, 'success', '+')
+
+    def queue_metrics(self):
+        """adds the server's metrics in the Prometheus text format to
+response queue"""
+        body = self.metrics.render()
+        self.add_response(200, 'OK')
+        self.add_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.add_header('Content-Length', str(len(body)))
+        if self.close: self.add_header('Connection', 'close')
+        else: self.add_header('Connection', 'keep-alive')
+        self.add_end_header()
+        if self._method != 'HEAD': self._response += body
+        self.queue_response()
+        if __debug__: Stats.set_count(self.addr, 'success', '+')
 
     def add_response(self, code, message=None):
         """writes response status code and default headers"""
@@ -574,7 +1346,12 @@ class HttpHandler():
 
     def date_time_string(self):
         """returns current date time"""
-        return self.httpdate(datetime.datetime.utcnow())
+        # NOTE: Formatted once per second and shared by all handlers
+        now = int(time.time())
+        if now != HttpHandler._date[0]:
+            HttpHandler._date = (now, self.httpdate(
+                datetime.datetime.utcfromtimestamp(now)))
+        return HttpHandler._date[1]
 
     def httpdate(self, dt):
         """Return a string representation of a date according to RFC 1123
@@ -605,35 +1382,127 @@ class HttpHandler():
         env["QUERY_STRING"] = self._query_string
         env["PATH_INFO"] = path
         env["SCRIPT_NAME"] = self._filename
+        env["SCRIPT_FILENAME"] = path
         env["CONTENT_LENGTH"] = str(self._content_length)
         env["CONTENT_TYPE"] = self._content_type
 
+        source = None
+        # Python scripts run in the worker pool when there is one
+        if self.cgi_pool is not None and path.endswith('.py'):
+            try:
+                source = self.cgi_pool.request(env, self._body or b'')
+            except (socket.error, OSError) as e:
+                # NOTE: Falls back to running the script as a process
+                print("ERROR sending \"{0}\" to the CGI pool:\r\n {1}".format(
+                    env["SCRIPT_NAME"], e))
+        if source is None:
+            source = self.cgi_process(path, env)
+            if source is None:
+                self.send_error(500)
+                return
+        self._cgi_head = CgiBody(source, self.cfg.get('CGI_TIMEOUT'))
+        # NOTE: Handlers with a blocking socket wait for the header block
+        # here. Otherwise send() reads it as the script writes it, so that
+        # the server keeps serving other connections meanwhile
+        if self.conn is None or self.conn.gettimeout() != 0:
+            self.read_cgi_headers()
+
+    def cgi_process(self, path, env):
+        """Executes the CGI script at path; returns a CgiProcess for its output
+or None if it could not be started"""
+        # NOTE: The request body is passed through a temporary file, so that a
+        # script writing output before reading its input cannot deadlock
+        stdin = subprocess.DEVNULL
         try:
-            process = subprocess.Popen([path], stdin=subprocess.PIPE,\
-                    stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env)
-            if self._body: stdin = self._body
-            else: stdin = b''
-            (output, err) = process.communicate(stdin)
-            exit_code = process.wait()
-            if exit_code == 1 or err:
-                print("ERROR calling \"{0}\":\r\n {1}".format(env["SCRIPT_NAME"],\
-                        err.decode()))
-                raise Exception
-            self.add_response(200)
-            self._response += output
-            self.queue_response()
-            #self.server.stats.add_success(self.addr)
-            if __debug__: Stats.set_count(self.addr, 'success', '+')
-        except Exception:
-            raise
-            self.send_error(500)
+            if self._body:
+                stdin = tempfile.TemporaryFile()
+                stdin.write(self._body)
+                stdin.seek(0)
+            # NOTE: The script's stderr goes to the server's
+            process = subprocess.Popen([path], stdin=stdin,\
+                    stdout=subprocess.PIPE, env=env)
+        except (OSError, IOError) as e:
+            print("ERROR calling \"{0}\":\r\n {1}".format(env["SCRIPT_NAME"], e))
+            return None
+        finally:
+            if stdin is not subprocess.DEVNULL: stdin.close()
+        return CgiProcess(process)
 
-    def get_file_info(self, f):
-        """Returns a (size, mtype) tuple of corresponding file size and last updated timestamp"""
-        fs = os.fstat(f.fileno())
-        size = fs.st_size
-        mtime = fs.st_mtime
-        return size, mtime
+    def read_cgi_headers(self):
+        """Reads the header block of the CGI script whose response is pending
+and queues the response, or a 502 (504 if the script timed out) when the
+block was malformed, too large or never ended. Returns False if the script
+has not written all of it yet"""
+        body = self._cgi_head
+        limit = self.cfg.get('MAX_HEADER_SIZE')
+        while True:
+            end = self.CGI_HEADER_END.search(body.head)
+            if end or len(body.head) > limit: break
+            data = self.read_script(body)
+            if data is None: return False
+            if not data: break
+            body.head += data
+        self._cgi_head = None
+        headers = None
+        if end:
+            headers = []
+            for line in body.head[:end.start()].split(b'\n'):
+                name, sep, value = line.decode('latin-1').partition(':')
+                if not sep or not name.strip():
+                    headers = None
+                    break
+                headers.append((name.strip(), value.strip()))
+        if headers is None:
+            body.close()
+            self.send_error(504 if body.killed else 502)
+            return True
+        data, body.head = body.head[end.end():], b''
+        self.queue_cgi_response(body, headers, data)
+        return True
+
+    def queue_cgi_response(self, body, headers, data):
+        """adds the response of a CGI script to response queue: the script's
+headers followed by a CgiBody that streams the rest of its output. Output
+without a Content-Length is sent chunked to HTTP/1.1 clients and delimited
+by closing the connection otherwise"""
+        code, message, length, fields = 200, None, None, []
+        try:
+            for name, value in headers:
+                key = name.lower()
+                if key == 'status':
+                    code, _, message = value.partition(' ')
+                    code = int(code)
+                    if code < 100 or code > 599: raise ValueError(value)
+                elif key == 'content-length':
+                    length = int(value)
+                    if length < 0: raise ValueError(value)
+                # NOTE: Hop-by-hop headers are set by the server
+                elif key not in ('connection', 'transfer-encoding'):
+                    if key == 'location' and code == 200: code = 302
+                    fields.append((name, value))
+        except ValueError:
+            body.close()
+            self.send_error(502)
+            return
+        self.add_response(code, message or None)
+        body.length = length
+        body.chunked = length is None and self._version == 'HTTP/1.1' and \
+                self.version == 'HTTP/1.1'
+        if length is None and not body.chunked: self.close = True
+        body.frame(data)
+        if self._version != 'HTTP/0.9':
+            for name, value in fields: self.add_header(name, value)
+            if length is not None: self.add_header('Content-Length', str(length))
+            elif body.chunked: self.add_header('Transfer-Encoding', 'chunked')
+            if self.close: self.add_header('Connection', 'close')
+            else: self.add_header('Connection', 'keep-alive')
+        self.add_end_header()
+        if self._method == 'HEAD':
+            body.close()
+            body = None
+        self.queue_response(body)
+        #self.server.stats.add_success(self.addr)
+        if __debug__: Stats.set_count(self.addr, 'success', '+')
 
     def get_file_type(self, filepath):
         """Finds the corresponsing mime type for a file, given the file path"""
@@ -709,13 +1578,58 @@ class HttpHandler():
         self._response += encoded
         self.queue_response()
 
-class BaseServer(object):
+class CachesMixIn(object):
+    """Caches shared by the handlers of a server"""
+    def setup_caches(self):
+        """Creates the caches configured in self.cfg and, if PRECOMPRESS is
+set, the precompressed sidecar files of PUBLIC_DIR"""
+        # Request path resolutions
+        self.path_cache = cache.PathCache(self.cfg.get('PATH_CACHE_SIZE'),
+                self.cfg.get('PATH_CACHE_TTL'))
+        # Fully rendered responses of small static files
+        self.response_cache = cache.ResponseCache(
+                self.cfg.get('RESPONSE_CACHE_SIZE'),
+                self.cfg.get('RESPONSE_CACHE_MAX_FILE'))
+        # Files compressed on the fly, keyed by (path, coding)
+        self.compressed_cache = cache.ResponseCache(
+                self.cfg.get('COMPRESSION_CACHE_SIZE'),
+                self.cfg.get('COMPRESSION_MAX_FILE'))
+        if self.cfg.get('PRECOMPRESS'):
+            written = compression.precompress(self.cfg.get('PUBLIC_DIR'),
+                    HttpHandler(cfg=self.cfg).get_file_type,
+                    self.cfg.get('COMPRESSION_MIN_SIZE'))
+            print("* Wrote {0} precompressed files".format(written))
+
+    def setup_metrics(self):
+        """Creates the in-process metrics, with a row for each pre-forked
+worker (see metrics)"""
+        self.metrics = metrics.Metrics(1 + max(0, self.cfg.get('WORKERS', 0)),
+                [self.path_cache, self.response_cache, self.compressed_cache])
+
+    def setup_cgi_pool(self):
+        """Starts the CGI worker pool if CGI_POOL_SIZE is set"""
+        self.cgi_pool = None
+        size = self.cfg.get('CGI_POOL_SIZE')
+        if size > 0:
+            self.cgi_pool = cgipool.Pool(size,
+                    self.cfg.get('CGI_POOL_MAX_REQUESTS'),
+                    self.cfg.get('CGI_POOL_IDLE'),
+                    self.cfg.get('CGI_POOL_SOCKET') or None)
+            print("* Started {0} CGI pool workers on {1}".format(size,
+                self.cgi_pool.path))
+
+class BaseServer(CachesMixIn):
 
     def __init__(self, config_filename="server.conf"):
 
         # Reading settings from config file
         # CAUTION path/filename?
         self.configure(config_filename)
+        self.setup_caches()
+        self.setup_metrics()
+        self.setup_cgi_pool()
+        if __debug__: Stats.configure(self.cfg.get('STATS_BUFFER_SIZE'),
+                self.cfg.get('STATS_FLUSH_INTERVAL'))
         # Setting up the HTTP handler
         self.handler = HttpHandler
         # Setting up the statistics object
@@ -723,72 +1637,21 @@ class BaseServer(object):
         # Set up a socket
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.socket.bind((self.HOST, self.PORT))
+        self.socket.bind((self.cfg.get('HOST'), self.cfg.get('PORT')))
         self.socket.listen(20000) # Should be set in confing / Test it
 
     def configure(self, filepath):
-        # Defaults:
-        self.HOST = ""
-        self.PORT = 8000
-        self.REQ_BUFFSIZE = 65536
-        self.PUBLIC_DIR = "www"
-        self.HTTP_VERSION = 1.0
-        self.INDEX_FILES = ["index.html", "index.htm"]
-        self.LOGGING = True
-        self.LOG_FILE = "server.log"
-
-        if os.path.isfile(filepath):
-            # Python 3.^
-            if sys.version_info > (3, 0):
-                config = configparser.ConfigParser()
-                config.read(filepath)
-                if "server" in config:
-                    for key in config["server"]:
-                        try:
-                            value = config["server"][key]
-                            if key.upper() == "PORT" or key.upper() == \
-                                    "REQ_BUFFSIZE": value = int(value)
-                            elif key.upper() == "HTTP_VERSION": value = float(config["server"][key])
-                            elif key.upper() == "INDEX_FILES": value = config["server"][key].split()
-                            else: value = str(config["server"][key])
-                            setattr(self, key.upper(), value)
-                            #print(getattr(self, key.upper()))
-                        except ValueError:
-                            raise
-                else:
-                    print("* Wrong or incorrect configuration")
-                    print("* Assuming default settings")
-            # Python 2.^
-            else:
-                with io.open(filepath, "rb") as f:
-                    config = ConfigParser.ConfigParser()
-                    config.readfp(f)
-                    try:
-                        for pair in config.items("server"):
-                            try:
-                                key, value = pair[0], pair[1]
-                                if key.upper() in ["PORT", "REQ_BUFFSIZE"]: value = int(value)
-                                elif key.upper() == "HTTP_VERSION": value = float(value)
-                                elif key.upper() == "INDEX_FILES": value = value.split()
-                                elif key.upper() == "LOGGING": value = bool(value)
-                                setattr(self, pair[0].upper(), value)
-                            except ValueError:
-                                raise
-                    except ConfigParser.NoSectionError:
-                        print("* Wrong or incorrect configuration")
-                        print("* Assuming default settings")
-
-        else:
-            # Should create a new config file
-            print("* Missing configuration file")
-            print("* Assuming default settings")
+        """Reads the settings of the configuration file into cfg, the one
+copy of them the server and its handlers use"""
+        self.cfg = config.Config()
+        self.cfg.file(filepath)
 
     def log(self, message):
         # To be implemented
         pass
 
     def serve_single(self):
-        print("* Waiting for a single HTTP request at port {0}".format(self.PORT))
+        print("* Waiting for a single HTTP request at port {0}".format(self.cfg.get('PORT')))
         self.conn, self.addr = self.socket.accept()
         try:
             if self.conn: self.handler = HttpHandler(self)
@@ -805,6 +1668,12 @@ class BaseServer(object):
         conn.close()
 
 class ForkingServer(BaseServer):
+    # A worker that fails within WORKER_MIN_LIFETIME seconds of being spawned
+    # is respawned after a delay that doubles with each such failure, up to
+    # WORKER_MAX_BACKOFF seconds
+    WORKER_MIN_LIFETIME = 1.0
+    WORKER_MAX_BACKOFF = 30.0
+
     def __init__(self, config='server.conf'):
         super(self.__class__, self).__init__(config)
         self.conn = None
@@ -813,22 +1682,28 @@ class ForkingServer(BaseServer):
         self.stats = stats.Store()
 
     def serve_persistent(self):
+        if self.cfg.get('WORKERS') > 0:
+            return self.serve_prefork()
         self.conn = None
         self.connected = False
         #self.close_connection = False
-        print("* Serving HTTP at port {0} (Press CTRL+C to quit)".format(self.PORT))
+        print("* Serving HTTP at port {0} (Press CTRL+C to quit)".format(self.cfg.get('PORT')))
         signal.signal(signal.SIGCHLD, self.signal_handler)
         try:
             while True:
                 if self.connected:
                     self.handler.handle()
                     self.handler.send()
+                    # Answer pipelined requests held back by the high-water mark
+                    while self.handler.resume(): self.handler.send()
                     if self.handler.close:
                         self.conn.close()
                         if __debug__: Stats.set_time(self.handler.addr, 't_close', time.time())
+                        self.metrics.closed()
                         #self.stats.close(self.handler.addr)
                         self.connected = False
                         del self.handler
+                        if __debug__: Stats.flush()
                         os._exit(0)
                 else:
                     try:
@@ -851,9 +1726,11 @@ class ForkingServer(BaseServer):
                             self.conn.close()
                         else:
                             self.socket.close()
-                            self.handler = HttpHandler(self.conn, self.addr, self)
+                            self.metrics.detach()
+                            self.handler = HttpHandler(self.conn, self.addr, self, self.cfg)
                             #self.stats.add_handler(self.addr)
                             if __debug__: Stats.register(self.addr)
+                            self.metrics.opened()
                             self.connected = True
         except KeyboardInterrupt:
             if self.conn: self.conn.close()
@@ -863,6 +1740,97 @@ class ForkingServer(BaseServer):
             #print("Total {}".format(str(self.stats.get_total())))
             #print("Times standard deviation: {}".format(self.stats.get_time_sd()))
 
+    def serve_prefork(self):
+        """Serves with a pool of WORKERS long-lived processes that accept on the
+shared listening socket. The master respawns workers that exit, either
+because they crashed or because they served MAX_REQUESTS requests. Workers
+that crash on startup are respawned with an increasing delay."""
+        print("* Serving HTTP at port {0} with {1} workers (Press CTRL+C to quit)"\
+                .format(self.cfg.get('PORT'), self.cfg.get('WORKERS')))
+        self.workers = {}
+        # Metrics row of each worker (pid:slot), passed on to its replacement
+        self.slots = {}
+        signal.signal(signal.SIGTERM, self.terminate_handler)
+        backoff = 0
+        try:
+            for slot in range(self.cfg.get('WORKERS')):
+                self.spawn_worker(slot + 1)
+            while True:
+                pid, status = os.wait()
+                if pid in self.workers:
+                    lifetime = time.time() - self.workers.pop(pid)
+                    if lifetime >= self.WORKER_MIN_LIFETIME:
+                        backoff = 0
+                    if os.WIFSIGNALED(status) or os.WEXITSTATUS(status) != 0:
+                        if lifetime < self.WORKER_MIN_LIFETIME:
+                            backoff = min(self.WORKER_MAX_BACKOFF,
+                                    backoff * 2 or 0.1)
+                        print("* Worker {0} died (status {1}), respawning{2}"\
+                                .format(pid, status, " in {0:g}s".format(
+                                    backoff) if backoff else ""))
+                        time.sleep(backoff)
+                    self.spawn_worker(self.slots.pop(pid))
+        except (KeyboardInterrupt, SystemExit):
+            self.stop_workers()
+            self.socket.close()
+
+    def spawn_worker(self, slot=1):
+        """Forks a worker process writing its metrics to row slot; returns its
+pid in the master"""
+        pid = os.fork()
+        if pid != 0: # Parent
+            self.workers[pid] = time.time()
+            self.slots[pid] = slot
+            return pid
+        self.metrics.attach(slot)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        exit_code = 0
+        try:
+            self.worker_loop()
+        except KeyboardInterrupt:
+            pass
+        except Exception:
+            traceback.print_exc()
+            exit_code = 1
+        finally:
+            if __debug__: Stats.flush()
+            os._exit(exit_code)
+
+    def worker_loop(self):
+        """Accepts and serves connections until MAX_REQUESTS were served"""
+        max_requests = self.cfg.get('MAX_REQUESTS')
+        served = 0
+        while not max_requests or served < max_requests:
+            conn, addr = self.socket.accept()
+            conn.settimeout(self.cfg.get('KEEPALIVE_TIMEOUT'))
+            handler = HttpHandler(conn, addr, self, self.cfg)
+            if max_requests: handler.max_requests = max_requests - served
+            try:
+                handler.handle_loop()
+            except socket.error:
+                pass
+            finally:
+                self.shutdown_connection(conn)
+            served += handler.requests
+
+    def stop_workers(self):
+        """Terminates and reaps all workers"""
+        for pid in self.workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+        for pid in self.workers:
+            try:
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
+        self.workers = {}
+
+    def terminate_handler(self, signum, frame):
+        sys.exit(0)
+
     def signal_handler(self, signum, frame):
         while True:
             try:
@@ -881,83 +1849,187 @@ class NonBlockingServer(BaseServer):
         # Set socket to non-blocking
         self.socket.setblocking(0)
 
-        # Sockets from which we expect to read
-        self.inputs = [self.socket]
+        # Allow as many connections as the hard limit of open files permits
+        if self.cfg.get('RAISE_NOFILE_LIMIT'):
+            try:
+                soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+                if soft != hard:
+                    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+                    print("* Raised the open files limit from {0} to {1}"
+                            .format(soft, hard))
+            except (ValueError, OSError):
+                print("* Could not raise the open files limit")
 
-        # Sockets to which we expect to write
-        self.outputs = []
+        # Readiness notification backend (epoll, kqueue, poll or select)
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.socket, selectors.EVENT_READ)
 
-        # Current handlers queue (HttpHandler:Queue)
+        # Current handlers (file descriptor:HttpHandler)
         self.handlers = {}
+        # Output of the CGI scripts handlers wait for (connection file
+        # descriptor:script file descriptor)
+        self.scripts = {}
     #@profile
     def serve_persistent(self):
-        print("* Serving HTTP at port {0} (Press CTRL+C to quit)".format(self.PORT))
+        print("* Serving HTTP at port {0} (Press CTRL+C to quit)".format(self.cfg.get('PORT')))
         try:
-            while self.inputs:
+            while True:
                 # Wait for at least one socket to be ready for processing
-                # Needs error handling (Keyboard Interrupt)
-                r, w, e = select.select(self.inputs, self.outputs, self.inputs, 0.5)
-                # Handle inputs
-                for s in r:
-                    if s is self.socket:
-                        # Server is ready to accept a connection
-                        conn, addr = self.socket.accept()
-                        # Set to non-blocking
-                        conn.setblocking(False)
-                        self.inputs.append(conn)
-                        self.handlers[conn] = HttpHandler(conn, addr, self)
-                        #self.stats.add_handler(addr, time.time())
-                        if __debug__: Stats.register(addr, time.time())
-                    else:
-                        handler = self.handlers[s]
-                        handler.handle()
-                        if handler.finished:
-                            if s not in self.outputs:
-                                self.outputs.append(s)
-                            if handler.response_queue.qsize() == 0 and \
-                                    handler.close:
-                                self.clear(s)
-                                #self.stats.close(handler.addr, time.time())
-                                if __debug__: Stats.set_time(handler.addr, 't_close',time.time())
-                                if s in w: w.remove(s)
-                # Handle outputs
-                for s in w:
-                    handler = self.handlers[s]
-                    if not handler.send():
-                        # XXX: ?
-                        self.outputs.remove(s)
-                        if handler.finished and handler.close:
-                            #self.stats.close(handler.addr, time.time())
-                            if __debug__: Stats.set_time(handler.addr, 't_close', time.time())
-                            self.clear(s)
-                # Handle "exceptional conditions"
-                for s in e:
-                    self.clear(s)
+                for key, mask in self.selector.select(0.5):
+                    if key.fileobj is self.socket:
+                        # Server is ready to accept connections
+                        self.accept()
+                        continue
+                    handler = key.data
+                    if key.fileobj is not handler.conn:
+                        # A CGI script the handler waits for wrote output
+                        self.handle_write(handler)
+                        continue
+                    if mask & selectors.EVENT_READ:
+                        self.handle_read(handler)
+                    if mask & selectors.EVENT_WRITE and \
+                            handler.conn.fileno() in self.handlers:
+                        self.handle_write(handler)
+                self.expire_scripts()
+                CgiProcess.reap()
         except KeyboardInterrupt:
             #self.stats.print_stats()
             self.clear(self.socket)
 
+    def accept(self):
+        """Accepts every pending connection from the listen backlog"""
+        while True:
+            try:
+                conn, addr = self.socket.accept()
+            except socket.error as e:
+                if e.errno == errno.EINTR or e.errno == errno.ECONNABORTED:
+                    continue
+                # EWOULDBLOCK - backlog drained; EMFILE, ENFILE, etc. - retry
+                # on the next event
+                return
+            # Set to non-blocking
+            conn.setblocking(False)
+            handler = HttpHandler(conn, addr, self, self.cfg)
+            self.handlers[conn.fileno()] = handler
+            self.selector.register(conn, selectors.EVENT_READ, handler)
+            #self.stats.add_handler(addr, time.time())
+            if __debug__: Stats.register(addr, time.time())
+            self.metrics.opened()
+
+    def handle_read(self, handler):
+        """Processes incoming data and closes or updates the connection. A
+client that goes away while a CGI script runs is not waited for"""
+        alive = handler.handle()
+        if handler.finished and handler.close and (not handler.pending() or
+                not alive and handler.waiting() is not None):
+            #self.stats.close(handler.addr, time.time())
+            if __debug__: Stats.set_time(handler.addr, 't_close', time.time())
+            self.metrics.closed()
+            self.clear(handler.conn)
+        else:
+            self.update(handler)
+
+    def handle_write(self, handler):
+        """Sends queued responses and closes or updates the connection.
+Requests held back by the high-water mark are processed once the output
+drained below it"""
+        if handler.send() and handler.finished and handler.close:
+            #self.stats.close(handler.addr, time.time())
+            if __debug__: Stats.set_time(handler.addr, 't_close', time.time())
+            self.metrics.closed()
+            self.clear(handler.conn)
+        else:
+            handler.resume()
+            self.update(handler)
+
+    def expire_scripts(self):
+        """Lets handlers kill the CGI scripts they waited for too long"""
+        for fd in list(self.scripts):
+            handler = self.handlers.get(fd)
+            if handler is not None and handler.waiting() is not None and \
+                    handler.waiting().expired():
+                self.handle_write(handler)
+
+    def update(self, handler):
+        """Waits for writability only while the handler has queued output and
+stops reading while the output is over the high-water mark. A handler
+waiting for a CGI script waits for the script's output instead, and for
+the connection only while it may buffer more input (see reading())"""
+        fd = handler.conn.fileno()
+        script = handler.waiting()
+        if self.scripts.get(fd) != (script and script.fd):
+            self.unwatch(fd)
+            if script is not None:
+                self.selector.register(script.fd, selectors.EVENT_READ, handler)
+                self.scripts[fd] = script.fd
+        events = 0 if handler.paused() else selectors.EVENT_READ
+        if handler.pending() and script is None:
+            events |= selectors.EVENT_WRITE
+        # NOTE: The connection is still read while only a script is waited
+        # for, so that a client going away is noticed, unless the client
+        # already sent more than the paused handler may buffer
+        if not events and (script is None or handler.reading()):
+            events = selectors.EVENT_READ
+        key = self.selector.get_map().get(fd)
+        if not events:
+            if key is not None: self.selector.unregister(handler.conn)
+        elif key is None:
+            self.selector.register(handler.conn, events, handler)
+        elif key.events != events:
+            self.selector.modify(handler.conn, events, handler)
+
+    def unwatch(self, fd):
+        """Stops waiting for the CGI script of the connection fd"""
+        script = self.scripts.pop(fd, None)
+        if script is None: return
+        try:
+            self.selector.unregister(script)
+        except (KeyError, ValueError):
+            pass
+
     def clear(self, connection):
-        if connection in self.outputs:
-            self.outputs.remove(connection)
-        if connection in self.inputs:
-            self.inputs.remove(connection)
+        fd = connection.fileno()
+        self.unwatch(fd)
+        if fd in self.handlers: self.handlers[fd].discard()
+        try:
+            self.selector.unregister(connection)
+        except (KeyError, ValueError):
+            pass
         try:
             self.shutdown_connection(connection)
         except socket.error as e:
             pass
-        if connection in self.handlers:
-            del self.handlers[connection]
+        if fd in self.handlers:
+            del self.handlers[fd]
+
+class AsyncHttpHandler(HttpHandler):
+    """HTTP Handler for gevent sockets"""
+    def wait_write(self):
+        """Yields to the gevent hub until the socket is writable"""
+        wait_write(self.conn.fileno(), self.conn.gettimeout())
 
-class AsyncServer(StreamServer):
+    def wait_script(self, body):
+        """Yields to the gevent hub until the script of a CgiBody wrote output
+or timed out"""
+        try:
+            wait_read(body.fd, body.remaining())
+        except socket.timeout:
+            pass
+
+class AsyncServer(CachesMixIn, StreamServer):
     def __init__(self, cfg=None, listener=None, **ssl_args):
-        if not listener: listener = ("", 8000)
         self.cfg = config.Config()
         self.cfg.defaults()
         if cfg: self.cfg.file(cfg)
+        if not listener: listener = (self.cfg.get('HOST'), self.cfg.get('PORT'))
+        self.setup_caches()
+        self.setup_metrics()
+        self.setup_cgi_pool()
+        if __debug__: Stats.configure(self.cfg.get('STATS_BUFFER_SIZE'),
+                self.cfg.get('STATS_FLUSH_INTERVAL'))
         StreamServer.__init__(self, listener, **ssl_args)
         self.max_accept = 1000  
-        self.handler = HttpHandler
+        self.handler = AsyncHttpHandler
         self.stats = stats.Store()
 
     #@profile
@@ -975,10 +2047,190 @@ class AsyncServer(StreamServer):
             pass
             #self.stats.print_stats()
 
+class AsyncioHttpProtocol(asyncio.Protocol):
+    """Drives an HttpHandler from an asyncio transport. Received data is fed
+to the handler and its queued responses are written to the transport, files
+with loop.sendfile()"""
+    def __init__(self, server, loop):
+        self.server = server
+        self.loop = loop
+        self.handler = None
+        self.transport = None
+        # Task writing the queued responses, while there are any
+        self.sender = None
+        # Cleared while the transport's buffer is over its high-water mark
+        self.writable = asyncio.Event()
+        self.writable.set()
+        self.timer = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        addr = transport.get_extra_info('peername')
+        self.handler = HttpHandler(transport.get_extra_info('socket'), addr,
+                self.server, getattr(self.server, 'cfg', None))
+        if __debug__: Stats.register(addr, time.time())
+        self.handler.metrics.opened()
+        self.touch()
+
+    def data_received(self, data):
+        self.touch()
+        self.handler.feed(data)
+        self.flush()
+
+    def eof_received(self):
+        # NOTE: Responses still being written are finished first
+        self.handler.close = True
+        return self.sender is not None
+
+    def connection_lost(self, exc):
+        if self.timer is not None: self.timer.cancel()
+        if self.sender is not None: self.sender.cancel()
+        self.handler.discard()
+        self.writable.set()
+        if __debug__: Stats.set_time(self.handler.addr, 't_close', time.time())
+        self.handler.metrics.closed()
+
+    def pause_writing(self):
+        self.writable.clear()
+
+    def resume_writing(self):
+        self.writable.set()
+
+    def touch(self):
+        """Restarts the keep-alive timeout of the connection"""
+        timeout = self.handler.cfg.get('KEEPALIVE_TIMEOUT')
+        if self.timer is not None: self.timer.cancel()
+        if timeout: self.timer = self.loop.call_later(timeout, self.expire)
+
+    def expire(self):
+        """Closes the connection if it is idle"""
+        if self.sender is None: self.transport.close()
+        else: self.touch()
+
+    def flush(self):
+        """Starts writing queued responses unless they are being written and
+stops reading while the handler is paused"""
+        if self.sender is None:
+            if self.handler.pending():
+                self.sender = self.loop.create_task(self.send())
+            elif self.handler.close:
+                self.transport.close()
+                return
+        if self.handler.paused(): self.transport.pause_reading()
+        else: self.transport.resume_reading()
+
+    async def send(self):
+        """Writes queued responses until none are left, processing requests
+held back while the output was over the high-water mark as it drains"""
+        handler = self.handler
+        queue = handler.response_queue
+        try:
+            while True:
+                if not queue:
+                    if handler._cgi_head is not None:
+                        if not handler.read_cgi_headers():
+                            await self.wait_script(handler.waiting())
+                        continue
+                    if handler.close or not handler.resume(): break
+                    continue
+                item = queue.popleft()
+                if isinstance(item, FileBody):
+                    handler.output_size -= item.remaining
+                    handler.sent_bytes += item.remaining
+                    try:
+                        await self.loop.sendfile(self.transport, item.file,
+                                item.offset, item.remaining)
+                    finally:
+                        item.close()
+                elif isinstance(item, CgiBody):
+                    await self.send_cgi(item)
+                else:
+                    await self.writable.wait()
+                    self.transport.write(item)
+                    handler.output_size -= len(item)
+                    handler.sent_bytes += len(item)
+                handler.completed()
+        except (ConnectionError, RuntimeError, OSError):
+            # NOTE: The transport was closed while writing
+            handler.discard()
+            handler.close = True
+        finally:
+            self.sender = None
+        self.touch()
+        if not self.transport.is_closing(): self.flush()
+
+    async def send_cgi(self, body):
+        """Writes the output of a CgiBody as the script produces it"""
+        handler = self.handler
+        try:
+            while not body.eof or body.pending:
+                if body.pending:
+                    await self.writable.wait()
+                    self.transport.write(body.pending)
+                    handler.output_size -= len(body.pending)
+                    handler.sent_bytes += len(body.pending)
+                    body.pending = b''
+                    continue
+                data = b''
+                if body.length != 0:
+                    data = handler.read_script(body)
+                    if data is None:
+                        await self.wait_script(body)
+                        continue
+                body.feed(data)
+                handler.output_size += len(body.pending)
+            # NOTE: The promised Content-Length can no longer be honoured
+            if body.truncated(): handler.close = True
+        finally:
+            body.close()
+
+    async def wait_script(self, body):
+        """Waits until the script of a CgiBody wrote output or timed out"""
+        ready = self.loop.create_future()
+        self.loop.add_reader(body.fd, lambda: ready.done() or
+                ready.set_result(None))
+        try:
+            await asyncio.wait_for(ready, body.remaining())
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            self.loop.remove_reader(body.fd)
+
+class AsyncioServer(BaseServer):
+    """Serves connections with asyncio protocols and transports, on uvloop's
+event loop if it is installed and UVLOOP is set"""
+    def __init__(self, config="server.conf"):
+        BaseServer.__init__(self, config)
+        self.socket.setblocking(False)
+
+    def serve_persistent(self):
+        name = 'asyncio'
+        if uvloop is not None and self.cfg.get('UVLOOP'):
+            asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+            name = 'uvloop'
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        server = loop.run_until_complete(loop.create_server(
+            lambda: AsyncioHttpProtocol(self, loop), sock=self.socket))
+        def reap():
+            CgiProcess.reap()
+            loop.call_later(1, reap)
+        reap()
+        print("* Serving HTTP at port {0} with {1} (Press CTRL+C to quit)"
+                .format(self.cfg.get('PORT'), name))
+        try:
+            loop.run_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.close()
+            loop.close()
+
 def test():
     server = ForkingServer()
     #server = NonBlockingServer()
     #server = AsyncServer('server.conf')
+    #server = AsyncioServer()
     server.serve_persistent()
 
 if __name__ == "__main__":
@@ -0,0 +1,193 @@
+""" Statistics snapshot module
+
+Saves the records of an ArrayStore to disk and loads them back without
+pickle. A snapshot file is a file header followed by segments:
+
+    file header  MAGIC and VERSION (16 bytes)
+    segment      SEGMENT, the length of a JSON description and the
+                 description (fields, counts, latency histograms), then the
+                 records as raw array data and the new addresses as UTF-8
+                 strings separated by NUL bytes, each aligned to 8 bytes
+
+A full snapshot is a base segment holding every record. Appending to a
+snapshot adds a segment with only the records that were added or changed
+since, so that periodic snapshots stay cheap. The arrays are memory mapped
+when read, and a file with a single segment is used in place
+Usage: python snapshot.py <snapshot> [csv_file]
+"""
+
+from __future__ import print_function
+
+import csv
+import json
+import os
+import struct
+import sys
+import time
+import numpy
+
+__all__ = ["write", "read", "export_csv", "is_snapshot"]
+
+MAGIC = b'BISTROSS'
+VERSION = 1
+FILE_HEADER = struct.Struct('<8sH6x')
+SEGMENT = struct.Struct('<4sI')
+SEGMENT_MAGIC = b'SEG1'
+ALIGN = 8
+
+
+def padding(size):
+    return -size % ALIGN
+
+
+def is_snapshot(filename):
+    """returns True if filename is a snapshot file"""
+    try:
+        with open(filename, 'rb') as f:
+            return f.read(len(MAGIC)) == MAGIC
+    except (IOError, OSError):
+        return False
+
+
+def segments(filename):
+    """Yields the description, records (memory mapped read-only) and new
+addresses of every segment of a snapshot. Raises ValueError if the file
+is not a snapshot of a supported version or is truncated"""
+    size = os.path.getsize(filename)
+    with open(filename, 'rb') as f:
+        header = f.read(FILE_HEADER.size)
+        if len(header) < FILE_HEADER.size: raise ValueError("Not a snapshot")
+        magic, version = FILE_HEADER.unpack(header)
+        if magic != MAGIC: raise ValueError("Not a snapshot")
+        if version != VERSION:
+            raise ValueError("Unsupported snapshot version {0}".format(version))
+        offset = FILE_HEADER.size
+        while offset < size:
+            f.seek(offset)
+            head = f.read(SEGMENT.size)
+            if len(head) < SEGMENT.size: raise ValueError("Truncated snapshot")
+            magic, length = SEGMENT.unpack(head)
+            if magic != SEGMENT_MAGIC: raise ValueError("Invalid segment")
+            try:
+                info = json.loads(f.read(length).decode('utf-8'))
+            except (UnicodeDecodeError, ValueError):
+                raise ValueError("Invalid segment")
+            offset += SEGMENT.size + length + padding(SEGMENT.size + length)
+            dtype = numpy.dtype([tuple(field) for field in info['dtype']])
+            length = info['records'] * dtype.itemsize
+            if offset + length + padding(length) + info['size'] > size:
+                raise ValueError("Truncated snapshot")
+            records = numpy.memmap(f, dtype, 'r', offset, (info['records'],)) \
+                    if info['records'] else numpy.zeros(0, dtype)
+            offset += length + padding(length)
+            f.seek(offset)
+            addresses = f.read(info['size']).decode('utf-8').split('\0') \
+                    if info['addresses'] else []
+            if len(addresses) != info['addresses']:
+                raise ValueError("Invalid segment")
+            offset += info['size'] + padding(info['size'])
+            yield info, records, addresses
+
+
+def read(filename, dtype):
+    """Returns the records (as an array of dtype), addresses and latency
+histograms (encoded, by key) a snapshot holds after applying its segments.
+The records of a snapshot with a single segment are mapped copy-on-write"""
+    records, addresses, latency = None, [], {}
+    for info, segment, new in segments(filename):
+        if info['base']: records, addresses = None, []
+        addresses.extend(new)
+        latency = info['latency']
+        if records is None and isinstance(segment, numpy.memmap) and \
+                segment.dtype == dtype and len(segment) == info['rows']:
+            # NOTE: Pages are only copied once they are written to
+            records = numpy.memmap(filename, dtype, 'c', segment.offset,
+                    segment.shape)
+            continue
+        merged = numpy.zeros(info['rows'], dtype)
+        merged['addr'] = numpy.arange(info['rows'])
+        merged['t_closed'] = numpy.nan
+        if records is not None: merged[:len(records)] = records
+        # NOTE: Records are matched to their rows by the addr field, so fields
+        # of other versions are copied by name
+        rows = numpy.asarray(segment['addr'])
+        for name in segment.dtype.names:
+            if name in dtype.names and name != 'addr':
+                merged[name][rows] = segment[name]
+        records = merged
+    if records is None: raise ValueError("Empty snapshot")
+    if len(addresses) != len(records): raise ValueError("Inconsistent snapshot")
+    return records, addresses, latency
+
+
+def write(filename, records, addresses, latency=None, append=False):
+    """Writes records (a structured array with an addr field holding the row
+of each record) and their addresses to a snapshot. With append, only the
+records that were added or changed since the snapshot in filename are
+written, unless its addresses are not a prefix of these. Returns the number
+of records written"""
+    latency = latency or {}
+    base, saved = True, None
+    if append and is_snapshot(filename):
+        saved, known, _ = read(filename, records.dtype)
+        base = len(known) > len(addresses) or known != addresses[:len(known)]
+    if base:
+        segment, new = records, addresses
+        f = open(filename + '.tmp', 'wb')
+        f.write(FILE_HEADER.pack(MAGIC, VERSION))
+    else:
+        # NOTE: Compares the raw bytes, so that NaN times compare equal
+        n = len(saved)
+        itemsize = records.dtype.itemsize
+        current = numpy.ascontiguousarray(records[:n]).view(numpy.uint8)
+        changed = (current.reshape(n, itemsize) !=
+                numpy.asarray(saved).view(numpy.uint8).reshape(n, itemsize)).any(axis=1)
+        segment = numpy.concatenate([records[:n][changed], records[n:]])
+        new = addresses[n:]
+        del saved, current
+        f = open(filename, 'ab')
+    # NOTE: Addresses are str(addr) of peer addresses, which have no NULs
+    blob = '\0'.join(new).encode('utf-8')
+    info = json.dumps({'base': base, 'time': time.time(),
+        'rows': len(records), 'records': len(segment),
+        'addresses': len(new), 'size': len(blob),
+        'dtype': records.dtype.descr, 'latency': latency}).encode('utf-8')
+    try:
+        f.write(SEGMENT.pack(SEGMENT_MAGIC, len(info)) + info +
+                b'\0' * padding(SEGMENT.size + len(info)))
+        data = numpy.ascontiguousarray(segment).tobytes()
+        f.write(data + b'\0' * padding(len(data)))
+        f.write(blob + b'\0' * padding(len(blob)))
+    finally:
+        f.close()
+    # NOTE: A full snapshot replaces the old file only once it is complete
+    if base: os.rename(filename + '.tmp', filename)
+    return len(segment)
+
+
+def export_csv(filename, records, addresses):
+    """Writes the records with their addresses to a CSV file; open
+connections have an empty t_closed"""
+    names = [name for name in records.dtype.names if name != 'addr']
+    with open(filename, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['address'] + names)
+        for address, row in zip(addresses, records[names].tolist()):
+            writer.writerow([address] + ['' if value != value else value
+                for value in row])
+    return len(addresses)
+
+
+def main():
+    """Prints a summary of a snapshot, or exports it to CSV"""
+    import stats
+    store = stats.ArrayStore.load(sys.argv[1])
+    if len(sys.argv) > 2:
+        n = store.export_csv(sys.argv[2])
+        print("* Exported {0} records to {1}".format(n, sys.argv[2]))
+    else:
+        print(store.get_total())
+        store.print_latency()
+
+if __name__ == "__main__":
+    main()
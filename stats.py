@@ -1,12 +1,15 @@
 """Handler statistics"""
 
-__all__ = ['Stats']
+__all__ = ['Store', 'ArrayStore', 'TimeSeries', 'WindowStore']
 
 # Redis pubsub channel
 CHANNEL = 'test'
 
 import time
 import numpy
+from histogram import Histogram
+import wire
+import snapshot
 from pickle import dump
 from os.path import isfile
 from sys import version
@@ -18,21 +21,38 @@ except ModuleNotFoundError:
     pass
 
 class Store(object):
+    # Methods applying each operation of the wire format
+    METHODS = {'register': 'add_handler', 'recv': 'add_received',
+            'success': 'add_success', 'error': 'add_error',
+            'not_modified': 'add_not_modified', 't_open': 'open',
+            't_close': 'close', 'latency': 'add_latency', 'bytes': 'add_bytes',
+            'path': 'add_path'}
+    # Most paths counted separately; the rest are counted as '(other)'
+    MAX_PATHS = 10000
+
     def __init__(self):
         self._statistics = {}
+        self.latency = {}
+        self.paths = {}
     
     def reset(self):
         """Resets the Stats object. WARNING: Deletes all values"""
         self._statistics = {}
+        self.latency = {}
+        self.paths = {}
     
     def get_total(self):
         """Used to retrieve a total for all of the handlers"""
-        total_statistics = {'handlers':0, 'received':0, 'success':0, 'error':0}
+        total_statistics = {'handlers':0, 'received':0, 'success':0, 'error':0,
+                'not_modified':0, 'bytes':0}
         total_statistics['handlers'] = len(self._statistics)
         for key in self._statistics:
             total_statistics['received'] += self._statistics[key]['received']
             total_statistics['success'] += self._statistics[key]['success']
             total_statistics['error'] += self._statistics[key]['error']
+            total_statistics['not_modified'] += \
+                    self._statistics[key].get('not_modified', 0)
+            total_statistics['bytes'] += self._statistics[key].get('bytes', 0)
         return total_statistics
 
     def add_handler(self, address, timestamp=None):
@@ -47,7 +67,8 @@ Timestamp should be in UTC"""
             self._statistics[address]['times_connected'] += 1
         else:
             self._statistics[address] = {'received' : 0, 'success' : 0, 'error' : 0, \
-                't_opened' : timestamp, 'times_connected' : 1}
+                'not_modified' : 0, 'bytes' : 0, 't_opened' : timestamp,
+                'times_connected' : 1}
     
     def get_handler(self, address, stat=None):
         """Used to retreive the stats for a particular handler.
@@ -72,6 +93,15 @@ Can also retrieve a single stat if parameter stat was set"""
     def add_error(self, address, value=1):
         """Increments the number of received requests by value (or by default +1)"""
         self._statistics[address]['error'] += int(value)
+
+    def add_not_modified(self, address, value=1):
+        """Increments the number of 304 responses, i.e. file bodies that did
+not have to be sent, by value (or by default +1)"""
+        self._statistics[address]['not_modified'] += int(value)
+
+    def add_bytes(self, address, value):
+        """Increments the number of bytes sent by value"""
+        self._statistics[address]['bytes'] += int(value)
     
     def close(self, address, timestamp=None):
         """Used to set the time when the connection is closed.
@@ -91,6 +121,57 @@ Timestamp should be in UTC"""
             timestamp = float(timestamp)
         self._statistics[address]['t_opened'] = timestamp
     
+    def add_events(self, strings, events):
+        """Applies the events of a decoded wire message in order. Returns the
+number of events that were invalid, e.g. for an unknown address"""
+        invalid = 0
+        methods = dict((code, getattr(self, self.METHODS[op]))
+                for op, code in wire.CODES.items())
+        for op, addr, value in events.tolist():
+            try:
+                if op == wire.LATENCY: value = strings[int(value)]
+                methods[op](strings[addr], value)
+            except (KeyError, ValueError, IndexError):
+                invalid += 1
+        return invalid
+
+    def add_latency(self, key, data):
+        """Merges an encoded latency histogram (see histogram.Histogram) into
+the one of key, e.g. 'ForkingServer/2xx'"""
+        histogram = Histogram.decode(data)
+        if key in self.latency: self.latency[key].merge(histogram)
+        else: self.latency[key] = histogram
+
+    def add_path(self, path, value=1):
+        """Increments the number of requests for path by value"""
+        if path not in self.paths and len(self.paths) >= self.MAX_PATHS:
+            path = '(other)'
+        self.paths[path] = self.paths.get(path, 0) + int(value)
+
+    def get_latency(self, backend=None, status=None):
+        """returns a histogram merging those of a server class and/or a
+status class (e.g. '2xx'), or of every request"""
+        merged = Histogram()
+        for key, histogram in self.latency.items():
+            name, _, group = key.rpartition('/')
+            if backend and name != backend: continue
+            if status and group != status: continue
+            merged.merge(histogram)
+        return merged
+
+    def print_latency(self):
+        """Prints request latency percentiles in milliseconds per server and
+status class"""
+        if not self.latency:
+            print("No request latencies")
+            return
+        print("Request Latency (ms)      count      p50      p90      p99     p999      max")
+        for key in sorted(self.latency):
+            histogram = self.latency[key]
+            values = histogram.percentiles() + [histogram.max]
+            print("{:<20} {:>10} ".format(key, histogram.total) +
+                    " ".join("{:>8.3f}".format(v / 1000.0) for v in values))
+
     def save(self, filename=None):
         if isfile(filename):
             ans = input("File with name '{}' already exists. Override? (Y/n): ".format(filename))
@@ -167,6 +248,443 @@ Timestamp should be in UTC"""
         print("Close Times Standard Deviation: {}".format(close_sd))    
         print("Received Requests Standard Deviation: {}".format(n_recv_sd))
 
+class ArrayStore(Store):
+    """Store keeping one record per address in a growable NumPy structured
+array, so that aggregates are computed without walking Python objects.
+get_all_* return arrays instead of lists"""
+    # Record fields; t_closed is NaN while the connection is open
+    dtype = numpy.dtype([('addr', 'i8'), ('t_opened', 'f8'), ('t_closed', 'f8'),
+        ('received', 'i8'), ('success', 'i8'), ('error', 'i8'),
+        ('not_modified', 'i8'), ('times_connected', 'i8'), ('bytes', 'i8')])
+    COUNTERS = ('received', 'success', 'error', 'not_modified', 'bytes')
+
+    def __init__(self, capacity=1024):
+        self._capacity = capacity
+        self.reset()
+
+    def reset(self):
+        """Resets the Stats object. WARNING: Deletes all values"""
+        self.latency = {}
+        self.paths = {}
+        # Row of every address and address of every row
+        self._index = {}
+        self._addresses = []
+        self.allocate(self._capacity)
+
+    def allocate(self, capacity):
+        """Moves the records to an array of capacity rows"""
+        records = numpy.zeros(capacity, dtype=self.dtype)
+        # NOTE: Rows are prepared for add_handler(), which then only sets
+        # the opening time and connection count
+        records['addr'] = numpy.arange(capacity)
+        records['t_closed'] = numpy.nan
+        if hasattr(self, '_records'):
+            records[:len(self._addresses)] = self._rows
+        self._records = records
+        self.bind()
+
+    def bind(self):
+        """Keeps a view of every field of the records"""
+        # NOTE: Getting a field view costs more than the update done with it
+        self._columns = dict((name, self._records[name])
+                for name in self.dtype.names)
+
+    def __getattr__(self, name):
+        # NOTE: Stores loaded from a snapshot index their addresses on first
+        # use, which costs more than loading the records
+        if name != '_index': raise AttributeError(name)
+        self._index = dict(zip(self._addresses, range(len(self._addresses))))
+        return self._index
+
+    def __getstate__(self):
+        # NOTE: Pickled views would no longer share the records' memory
+        state = self.__dict__.copy()
+        del state['_columns']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.bind()
+
+    @property
+    def _rows(self):
+        """the used part of the record array"""
+        return self._records[:len(self._addresses)]
+
+    def get_total(self):
+        """Used to retrieve a total for all of the handlers"""
+        rows = self._rows
+        total_statistics = {'handlers': len(rows)}
+        for name in self.COUNTERS:
+            total_statistics[name] = int(rows[name].sum())
+        return total_statistics
+
+    def add_handler(self, address, timestamp=None):
+        """Adds a new address refference to our stats dictionary.
+Timestamp should be in UTC"""
+        if not timestamp:
+            timestamp = time.time()
+        else:
+            timestamp = float(timestamp)
+        row = self._index.get(address)
+        if row is not None:
+            self._columns['times_connected'][row] += 1
+            return
+        row = len(self._addresses)
+        # NOTE: Doubling keeps appends amortized O(1)
+        if row == len(self._records): self.allocate(2 * row)
+        self._columns['t_opened'][row] = timestamp
+        self._columns['times_connected'][row] = 1
+        self._index[address] = row
+        self._addresses.append(address)
+
+    def get_handler(self, address, stat=None):
+        """Used to retreive the stats for a particular handler.
+Can also retrieve a single stat if parameter stat was set"""
+        record = self._records[self._index[address]]
+        handler = {}
+        for name in self.dtype.names[1:]:
+            value = record[name].item()
+            # NOTE: Open connections have no t_closed, as with Store
+            if name == 't_closed' and value != value: continue
+            handler[name] = value
+        if stat: return handler[stat]
+        return handler
+
+    def get_all(self):
+        """Used to retrive the statistics dictionary"""
+        return dict((address, self.get_handler(address))
+                for address in self._addresses)
+
+    def add_received(self, address, value=1):
+        """Increments the number of received requests by value (or by default +1)"""
+        self._columns['received'][self._index[address]] += int(value)
+
+    def add_success(self, address, value=1):
+        """Increments the number of successful responses by value (or by default +1)"""
+        self._columns['success'][self._index[address]] += int(value)
+
+    def add_error(self, address, value=1):
+        """Increments the number of error responses by value (or by default +1)"""
+        self._columns['error'][self._index[address]] += int(value)
+
+    def add_not_modified(self, address, value=1):
+        """Increments the number of 304 responses by value (or by default +1)"""
+        self._columns['not_modified'][self._index[address]] += int(value)
+
+    def add_bytes(self, address, value):
+        """Increments the number of bytes sent by value"""
+        self._columns['bytes'][self._index[address]] += int(value)
+
+    def close(self, address, timestamp=None):
+        """Used to set the time when the connection is closed.
+Timestamp should be in UTC"""
+        if not timestamp:
+            timestamp = time.time()
+        else:
+            timestamp = float(timestamp)
+        self._columns['t_closed'][self._index[address]] = timestamp
+
+    def open(self, address, timestamp=None):
+        """Used to set the time when the connection is first opened.
+Timestamp should be in UTC"""
+        if not timestamp:
+            timestamp = time.time()
+        else:
+            timestamp = float(timestamp)
+        self._columns['t_opened'][self._index[address]] = timestamp
+
+    def add_events(self, strings, events):
+        """Applies the events of a decoded wire message one operation at a
+time. Returns the number of events that were invalid, e.g. for an unknown
+address"""
+        ops, values = events['op'], events['value']
+        invalid = 0
+        # NOTE: Registrations come first, so counters of a connection opened
+        # in the same batch apply
+        for i in numpy.flatnonzero(ops == wire.CODES['register']):
+            self.add_handler(strings[events['addr'][i]], values[i])
+        rows = numpy.array([self._index.get(s, -1) for s in strings],
+                dtype=numpy.int64)[events['addr']]
+        for name, field in [('recv', 'received'), ('success', 'success'),
+                ('error', 'error'), ('not_modified', 'not_modified'),
+                ('bytes', 'bytes'), ('t_open', 't_opened'), ('t_close', 't_closed')]:
+            selected = ops == wire.CODES[name]
+            if not selected.any(): continue
+            known = selected & (rows >= 0)
+            invalid += int(selected.sum() - known.sum())
+            if field.startswith('t_'):
+                # NOTE: With several times for a row the last one is kept
+                self._columns[field][rows[known]] = values[known]
+            else:
+                numpy.add.at(self._columns[field], rows[known],
+                        values[known].astype(numpy.int64))
+        for i in numpy.flatnonzero(ops == wire.CODES['path']):
+            self.add_path(strings[events['addr'][i]], values[i])
+        for i in numpy.flatnonzero(ops == wire.LATENCY):
+            try:
+                self.add_latency(strings[events['addr'][i]],
+                        strings[int(values[i])])
+            except (ValueError, IndexError):
+                invalid += 1
+        invalid += int((ops == 0).sum() + (ops > len(wire.OPERATIONS)).sum())
+        return invalid
+
+    def save(self, filename, append=False):
+        """Writes a snapshot of the statistics to filename (see snapshot).
+With append, only what changed since the snapshot in filename is added to
+it. Returns the number of records written"""
+        latency = dict((key, histogram.encode())
+                for key, histogram in self.latency.items())
+        return snapshot.write(filename, self._rows, self._addresses, latency,
+                append)
+
+    @classmethod
+    def load(cls, filename):
+        """Returns a store with the statistics of a snapshot. Its records
+stay memory mapped until they are modified or outgrown"""
+        records, addresses, latency = snapshot.read(filename, cls.dtype)
+        store = cls()
+        if len(records):
+            store._records = records
+            store._addresses = addresses
+            del store._index
+            store.bind()
+        store.latency = dict((key, Histogram.decode(data))
+                for key, data in latency.items())
+        return store
+
+    def export_csv(self, filename):
+        """Writes one line per address to a CSV file. Returns the number of
+lines written"""
+        return snapshot.export_csv(filename, self._rows, self._addresses)
+
+    def closed(self):
+        """returns the records of closed connections"""
+        rows = self._rows
+        return rows[~numpy.isnan(rows['t_closed'])]
+
+    def get_all_dtime(self):
+        """returns the durations of the connections, or None if one is open"""
+        rows = self._rows
+        if numpy.isnan(rows['t_closed']).any(): return None
+        return rows['t_closed'] - rows['t_opened']
+
+    def get_all_open(self):
+        return self._rows['t_opened'].copy()
+
+    def get_all_close(self):
+        """returns the closing times, or None if a connection is open"""
+        rows = self._rows
+        if numpy.isnan(rows['t_closed']).any(): return None
+        return rows['t_closed'].copy()
+
+    def get_all_recv(self):
+        return self._rows['received'].copy()
+
+    @staticmethod
+    def describe(values):
+        """Returns min, max, mean, standard deviation and the 50th, 90th and
+99th percentiles of an array"""
+        if not len(values): raise ValueError("No values")
+        p50, p90, p99 = numpy.percentile(values, [50, 90, 99])
+        return {'min': values.min(), 'max': values.max(), 'mean': values.mean(),
+                'std': values.std(dtype=numpy.float64), 'p50': p50, 'p90': p90,
+                'p99': p99}
+
+    def print_stats(self):
+        # NOTE: Durations and closing times only count closed connections
+        rows = self._rows
+        closed = self.closed()
+        if not len(closed): raise ValueError("No closed connections")
+        d_times = self.describe(closed['t_closed'] - closed['t_opened'])
+        o_times = self.describe(rows['t_opened'])
+        c_times = self.describe(closed['t_closed'])
+        n_recv = self.describe(rows['received'])
+        print("Delta Time Standard Deviatioin: {}".format(d_times['std']))
+        print("Delta Last Closed - First Opened: {}".format(c_times['max'] - o_times['min']))
+        print("Delta Last Opened - First Opened: {}".format(o_times['max'] - o_times['min']))
+        print("Delta Last Closed - First Closed: {}".format(c_times['max'] - c_times['min']))
+        print("Open Time Standard Deviation: {}".format(o_times['std']))
+        print("Close Times Standard Deviation: {}".format(c_times['std']))
+        print("Received Requests Standard Deviation: {}".format(n_recv['std']))
+        print("Connection Time p50/p90/p99/max: {p50:.6f}/{p90:.6f}/{p99:.6f}/{max:.6f}"
+                .format(**d_times))
+        print("Received Requests p50/p90/p99/max: {p50:g}/{p90:g}/{p99:g}/{max:g}"
+                .format(**n_recv))
+
+class TimeSeries(object):
+    """Counters per period in fixed-size ring buffers, one per resolution.
+Every value is added at each resolution, so coarser ones are always the sum
+of the finer ones and need no separate downsampling. Memory does not grow"""
+    FIELDS = ('connections', 'received', 'success', 'error', 'not_modified',
+            'bytes')
+    # (seconds per period, number of periods kept): an hour of seconds, a
+    # day of minutes and a month of hours
+    RESOLUTIONS = ((1, 3600), (60, 1440), (3600, 720))
+
+    def __init__(self, resolutions=None):
+        self.resolutions = tuple(resolutions or self.RESOLUTIONS)
+        self._columns = dict((name, i) for i, name in enumerate(self.FIELDS))
+        self.reset()
+
+    def reset(self):
+        # Counters and the period each slot holds (-1 none) per resolution
+        self._levels = [(step, numpy.zeros((size, len(self.FIELDS)), numpy.int64),
+            numpy.full(size, -1, numpy.int64)) for step, size in self.resolutions]
+
+    def add(self, field, value=1, timestamp=None):
+        """Adds value to field at timestamp (now by default). Values older
+than a ring holds are dropped from it"""
+        if timestamp is None: timestamp = time.time()
+        column = self._columns[field]
+        for step, counts, periods in self._levels:
+            period = int(timestamp // step)
+            slot = period % len(periods)
+            if periods[slot] != period:
+                if periods[slot] > period: continue
+                # NOTE: The slot held a period that fell out of the window
+                counts[slot] = 0
+                periods[slot] = period
+            counts[slot, column] += value
+
+    def level(self, seconds):
+        """returns the finest resolution whose ring covers seconds"""
+        for level in self._levels:
+            if level[0] * len(level[2]) >= seconds: return level
+        return self._levels[-1]
+
+    def series(self, field, seconds, now=None):
+        """returns the counts of field over the last seconds as an array with
+one value per period of the finest resolution covering them, oldest first,
+and the period length. The current, incomplete period is not included"""
+        if now is None: now = time.time()
+        step, counts, periods = self.level(seconds)
+        n = min(len(periods), max(1, int(-(-seconds // step))))
+        wanted = numpy.arange(int(now // step) - n, int(now // step))
+        slots = wanted % len(periods)
+        values = counts[slots, self._columns[field]]
+        return numpy.where(periods[slots] == wanted, values, 0), step
+
+    def total(self, field, seconds, now=None):
+        """returns the sum of field over the last seconds"""
+        return int(self.series(field, seconds, now)[0].sum())
+
+    def rate(self, field, seconds, now=None):
+        """returns field per second over the last seconds"""
+        values, step = self.series(field, seconds, now)
+        return values.sum() / float(len(values) * step)
+
+
+class WindowStore(Store):
+    """Store keeping time series of the counters of all addresses together
+instead of per address records, so that it can run indefinitely. Counter
+events are counted at the time they are applied; connections at their
+opening time"""
+    def __init__(self, resolutions=None):
+        self.series = TimeSeries(resolutions)
+        self.reset()
+
+    def reset(self):
+        """Resets the Stats object. WARNING: Deletes all values"""
+        self.series.reset()
+        self.latency = {}
+        self.paths = {}
+        self.active = 0
+        self._totals = dict((name, 0) for name in TimeSeries.FIELDS)
+
+    def count(self, field, value, timestamp=None):
+        value = int(value)
+        self._totals[field] += value
+        self.series.add(field, value, timestamp)
+
+    def get_total(self):
+        """Used to retrieve a total for all of the handlers"""
+        totals = dict(self._totals)
+        totals['handlers'] = totals.pop('connections')
+        return totals
+
+    def add_handler(self, address, timestamp=None):
+        """Counts a new connection at timestamp (UTC)"""
+        self.count('connections', 1, float(timestamp) if timestamp else None)
+        self.active += 1
+
+    def get_handler(self, address, stat=None):
+        raise KeyError("Per address statistics are not kept")
+
+    def get_all(self):
+        return {}
+
+    def add_received(self, address, value=1):
+        self.count('received', value)
+
+    def add_success(self, address, value=1):
+        self.count('success', value)
+
+    def add_error(self, address, value=1):
+        self.count('error', value)
+
+    def add_not_modified(self, address, value=1):
+        self.count('not_modified', value)
+
+    def add_bytes(self, address, value):
+        self.count('bytes', value)
+
+    def close(self, address, timestamp=None):
+        """Counts a closed connection"""
+        self.active = max(0, self.active - 1)
+
+    def open(self, address, timestamp=None):
+        pass
+
+    def add_events(self, strings, events):
+        """Applies the events of a decoded wire message, adding up the
+counters of the batch before updating the time series"""
+        ops, values = events['op'], events['value']
+        now = time.time()
+        invalid = 0
+        register = ops == wire.CODES['register']
+        if register.any():
+            # NOTE: Connections are counted per second of their opening time
+            seconds, n = numpy.unique(values[register] // 1, return_counts=True)
+            for second, count in zip(seconds.tolist(), n.tolist()):
+                self.count('connections', count, second)
+            self.active += int(n.sum())
+        for name, field in [('recv', 'received'), ('success', 'success'),
+                ('error', 'error'), ('not_modified', 'not_modified'),
+                ('bytes', 'bytes')]:
+            selected = ops == wire.CODES[name]
+            if selected.any(): self.count(field, values[selected].sum(), now)
+        self.active = max(0, self.active - int((ops == wire.CODES['t_close']).sum()))
+        for i in numpy.flatnonzero(ops == wire.CODES['path']):
+            self.add_path(strings[events['addr'][i]], values[i])
+        for i in numpy.flatnonzero(ops == wire.LATENCY):
+            try:
+                self.add_latency(strings[events['addr'][i]],
+                        strings[int(values[i])])
+            except (ValueError, IndexError):
+                invalid += 1
+        invalid += int((ops == 0).sum() + (ops > len(wire.OPERATIONS)).sum())
+        return invalid
+
+    def rate(self, field, seconds=1, now=None):
+        """returns field (e.g. 'received' for requests) per second over the
+last seconds"""
+        return self.series.rate(field, seconds, now)
+
+    def print_stats(self):
+        now = time.time()
+        print("Active Connections: {}".format(self.active))
+        print("Window          conn/s      req/s    errors/s   error %      bytes/s")
+        for label, seconds in [('1s', 1), ('10s', 10), ('1m', 60), ('1h', 3600),
+                ('1d', 86400)]:
+            requests = self.series.rate('received', seconds, now)
+            errors = self.series.rate('error', seconds, now)
+            print("{:<8} {:>11.1f} {:>10.1f} {:>11.1f} {:>9.2f} {:>12.0f}".format(
+                label, self.series.rate('connections', seconds, now), requests,
+                errors, 100.0 * errors / requests if requests else 0.0,
+                self.series.rate('bytes', seconds, now)))
+
 class RedisMixIn:
     r = redis.Redis()
     
@@ -203,6 +721,10 @@ Can also retrieve a single stat if parameter stat was set"""
     def add_error(self, address, value=1):
         """Increments the number of received requests by value (or by default +1)"""
         self.r.publish(CHANNEL, 'add_received("' + str(address) + '",' + str(value) + ')')
+
+    def add_not_modified(self, address, value=1):
+        """Increments the number of 304 responses by value (or by default +1)"""
+        self.r.publish(CHANNEL, 'add_not_modified("' + str(address) + '",' + str(value) + ')')
     
     def close(self, address, timestamp=None):
         """Used to set the time when the connection is closed.
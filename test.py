@@ -1,14 +1,38 @@
 #!/usr/bin/env python
 import unittest
 import server
+import httpparser
 import socket
+import threading
+import os
+import gzip
+import config
+import io
+import re
+import types
+import asyncio
+import select
+import signal
+import tempfile
+import time
+import shutil
+from interface import Stats
+import stats
+from histogram import Histogram
+import wire
+import collector
+import monitor
+import metrics
+from bench import micro
+try:
+    from unittest import mock
+except ImportError:
+    import mock
 
 class UnitTest(unittest.TestCase):
 
     def setUp(self):
-        self.server = server.NonBlockingServer()
-        self.server.socket.close()
-        self.server.PUBLIC_DIR = 'www'
+        self.server = micro.OfflineServer('server.conf')
         self.handler = server.HttpHandler(server = self.server)
     
     def test_validate_version(self):
@@ -34,6 +58,43 @@ class UnitTest(unittest.TestCase):
         for path in invalid_paths:
             self.assertFalse(self.handler.validate_path(path), 'path \'' + path + '\' should be invalid')
     
+    def test_path_cache(self):
+        cache = self.handler.path_cache
+        cache.clear()
+        for path in ['/', '/index.tml']:
+            self.handler.validate_path(path)
+            with mock.patch('os.stat', wraps=os.stat) as stat:
+                self.handler.validate_path(path)
+                self.assertEqual(stat.call_count, 0, path + ' should be cached')
+        self.assertEqual(cache.hits, 2)
+        self.assertEqual(cache.misses, 2)
+        cache.ttl = -1
+        cache.clear()
+        self.handler.validate_path('/')
+        with mock.patch('os.stat', wraps=os.stat) as stat:
+            self.assertTrue(self.handler.validate_path('/'))
+            self.assertGreater(stat.call_count, 0)
+
+    def test_response_cache(self):
+        responses = self.handler.response_cache
+        responses.clear()
+        self.handler._method = 'GET'
+        self.handler._version = 'HTTP/1.1'
+        self.assertTrue(self.handler.validate_path('/index.html'))
+        path = self.handler._path
+        self.handler.queue_file()
+        with mock.patch('io.open') as open_file:
+            self.handler._method = 'GET'
+            self.assertTrue(self.handler.validate_path('/index.html'))
+            self.handler.queue_file()
+            self.assertEqual(open_file.call_count, 0)
+        first, second = self.handler.response_queue
+        self.assertEqual(first.split(b'\r\n', 3)[3], second.split(b'\r\n', 3)[3])
+        self.assertEqual(responses.hits, 1)
+        # A changed mtime invalidates the entry
+        self.assertIsNone(responses.get(path, 0))
+        self.assertEqual(responses.invalidations, 1)
+
     def test_add_response(self):
         invalid = ['','a',None,[],['20'],'500']
         for code in invalid:
@@ -48,6 +109,819 @@ class UnitTest(unittest.TestCase):
             self.handler.add_response(code)
             self.assertTrue(True)
 
+class ParserTest(unittest.TestCase):
+
+    request = b'GET / HTTP/1.1\r\nHost: localhost\r\nX-A: 1\r\nx-a: 2\r\n\r\n'
+
+    def test_incremental(self):
+        parser = httpparser.RequestParser()
+        line = headers = None
+        for i in range(len(self.request)):
+            parser.feed(self.request[i:i + 1])
+            if line is None: line = parser.parse_request_line()
+            if line is not None and headers is None:
+                headers = parser.parse_headers()
+        self.assertEqual(line, b'GET / HTTP/1.1')
+        self.assertEqual(headers['HOST'], 'localhost')
+        self.assertEqual(headers.get('X-a'), '1, 2')
+        self.assertEqual(len(parser), 0)
+
+    def test_pipelined(self):
+        parser = httpparser.RequestParser()
+        parser.feed(self.request * 3 + b'POST / HTTP/1.1\r\n\r\nbody')
+        for i in range(3):
+            self.assertEqual(parser.parse_request_line(), b'GET / HTTP/1.1')
+            self.assertIn('host', parser.parse_headers())
+        self.assertEqual(parser.parse_request_line(), b'POST / HTTP/1.1')
+        self.assertEqual(parser.parse_headers(), {})
+        self.assertIsNone(parser.read(5))
+        self.assertEqual(parser.read(4), b'body')
+
+    def test_limits(self):
+        parser = httpparser.RequestParser(max_line=16, max_headers=2,
+                max_header_size=64)
+        parser.feed(b'GET /' + b'a' * 16)
+        with self.assertRaises(httpparser.ParseError) as cm:
+            parser.parse_request_line()
+        self.assertEqual(cm.exception.code, 414)
+        for block, code in [(b'A: 1\r\nB: 2\r\nC: 3\r\n\r\n', 431),
+                (b'X: ' + b'x' * 64, 431), (b'A : 1\r\n\r\n', 400),
+                (b'A: 1\r\n folded\r\n\r\n', 400)]:
+            parser.reset()
+            parser.feed(b'GET / HTTP/1.1\r\n' + block)
+            parser.parse_request_line()
+            with self.assertRaises(httpparser.ParseError) as cm:
+                parser.parse_headers()
+            self.assertEqual(cm.exception.code, code)
+
+    def test_parse_range(self):
+        for value, ranges in [('bytes=0-499', [(0, 499)]),
+                ('bytes=-500', [(500, 999)]), ('bytes=900-', [(900, 999)]),
+                ('bytes=0-1,2-3,10-2000', [(0, 3), (10, 999)]),
+                ('bytes=1000-', []), ('bytes=-0', []), ('bytes=5-1', None),
+                ('bytes=x-', None), ('items=0-1', None)]:
+            self.assertEqual(httpparser.parse_range(value, 1000), ranges, value)
+
+class SendTest(unittest.TestCase):
+
+    def get_file(self, path, sendfile=True):
+        """Queues and sends the file at path; returns (headers, body)"""
+        conn, client = socket.socketpair()
+        received = []
+        def read_all():
+            data = client.recv(65536)
+            while data:
+                received.append(data)
+                data = client.recv(65536)
+        reader = threading.Thread(target=read_all)
+        reader.start()
+        self.handler = server.HttpHandler(conn, ('127.0.0.1', 0))
+        self.handler._version = 'HTTP/1.0'
+        self.handler._method = 'GET'
+        self.assertTrue(self.handler.validate_path(path))
+        self.handler.queue_file()
+        if not sendfile:
+            self.handler.response_queue[-1].sendfile = False
+        self.assertTrue(self.handler.send())
+        conn.close()
+        reader.join()
+        client.close()
+        return b''.join(received).split(b'\r\n\r\n', 1)
+
+    def test_send_large_file(self):
+        with open('www/pic/a.png', 'rb') as f:
+            content = f.read()
+        for sendfile in [True, False]:
+            headers, body = self.get_file('/pic/a.png', sendfile)
+            self.assertIn(b'Content-Length: ' + str(len(content)).encode(), headers)
+            self.assertEqual(body, content)
+
+    def test_send_small_file(self):
+        with open('www/index.html', 'rb') as f:
+            content = f.read()
+        headers, body = self.get_file('/index.html')
+        self.assertEqual(body, content)
+        self.assertFalse(self.handler.pending())
+
+    def exchange(self, requests, cfg=None, srv=None):
+        """Handles the requests on one connection; returns what was sent back"""
+        conn, client = socket.socketpair()
+        client.sendall(requests)
+        received = []
+        def read_all():
+            data = client.recv(65536)
+            while data:
+                received.append(data)
+                data = client.recv(65536)
+        reader = threading.Thread(target=read_all)
+        reader.start()
+        self.handler = server.HttpHandler(conn, ('127.0.0.1', 0), srv, cfg=cfg)
+        self.assertTrue(self.handler.handle())
+        self.assertTrue(self.handler.send())
+        conn.close()
+        reader.join()
+        client.close()
+        return b''.join(received)
+
+    def test_pipelined_responses(self):
+        received = self.exchange(b'GET /index.html HTTP/1.1\r\n\r\n'
+                b'GET /missing HTTP/1.1\r\n\r\n'
+                b'HEAD /index.html HTTP/1.1\r\n\r\n')
+        self.assertEqual(self.handler.requests, 3)
+        self.assertFalse(self.handler.close)
+        statuses = re.findall(br'HTTP/1\.[01] (\d{3}) ', received)
+        self.assertEqual(statuses, [b'200', b'404', b'200'])
+
+    def test_request_latency(self):
+        with mock.patch.object(Stats, 'set_latency') as set_latency:
+            self.exchange(b'GET /index.html HTTP/1.1\r\n\r\n'
+                    b'GET /missing HTTP/1.1\r\n\r\n'
+                    b'GET /pic/a.png HTTP/1.1\r\n\r\n')
+        # One latency per response, recorded once it was completely sent
+        keys = [c[0][0] for c in set_latency.call_args_list]
+        self.assertEqual(keys, ['HttpHandler/2xx', 'HttpHandler/4xx',
+            'HttpHandler/2xx'])
+        for c in set_latency.call_args_list:
+            self.assertTrue(0 <= c[0][1] < 5)
+        self.assertFalse(self.handler._timings)
+
+    def test_fake_connection(self):
+        handler = micro.OfflineServer('server.conf').handler(
+                b'GET /index.html HTTP/1.1\r\n\r\n'
+                b'GET /pic/a.png HTTP/1.1\r\n\r\n'
+                b'GET /missing HTTP/1.1\r\n\r\n')
+        self.assertTrue(handler.handle())
+        self.assertTrue(handler.send())
+        received = handler.conn.received()
+        statuses = re.findall(br'HTTP/1\.1 (\d{3}) ', received)
+        self.assertEqual(statuses, [b'200', b'200', b'404'])
+        with open('www/pic/a.png', 'rb') as f:
+            self.assertIn(f.read(), received)
+        self.assertEqual(handler.conn.sent, len(received))
+        # An exhausted connection reads as closed by the client
+        self.assertFalse(handler.handle())
+
+    def test_metrics_endpoint(self):
+        srv = types.SimpleNamespace(metrics=metrics.Metrics(),
+                cfg=config.Config())
+        srv.cfg.defaults()
+        self.exchange(b'GET /index.html HTTP/1.1\r\n\r\n'
+                b'GET /missing HTTP/1.1\r\n\r\n', srv=srv)
+        # The metrics are not served unless a path is configured
+        received = self.exchange(b'GET /__bistro/metrics HTTP/1.1\r\n\r\n',
+                srv=srv)
+        self.assertTrue(re.match(br'HTTP/1\.[01] 404 ', received))
+        srv.cfg.set('METRICS_PATH', '/__bistro/metrics')
+        received = self.exchange(b'GET /__bistro/metrics?x=1 HTTP/1.1\r\n\r\n',
+                srv=srv)
+        body = received.split(b'text/plain; version=0.0.4')[1]
+        self.assertIn(b'bistro_requests_total{method="GET",code="200"} 1\n', body)
+        self.assertIn(b'bistro_requests_total{method="GET",code="404"} 2\n', body)
+        self.assertIn(b'bistro_request_duration_seconds_count 3\n', body)
+        self.assertIn(b'bistro_request_duration_seconds_bucket{le="+Inf"} 3\n', body)
+        # Handlers without a server share one table
+        self.assertIs(server.HttpHandler().metrics, server.HttpHandler().metrics)
+
+    def test_metrics_forked(self):
+        # Workers write to their own rows, processes forked per connection
+        # add their counts to row 0 when the connection closes
+        m = metrics.Metrics(3)
+        for slot in [None, 1, 2]:
+            pid = os.fork()
+            if pid == 0:
+                if slot is None: m.detach()
+                else: m.attach(slot)
+                m.opened()
+                m.request('GET', 200)
+                m.request('BREW', 501)
+                m.sent(100)
+                m.observe(0.002)
+                if slot is None: m.closed()
+                os._exit(0)
+            os.waitpid(pid, 0)
+        totals = m.totals()
+        self.assertEqual(totals[metrics.OFFSETS['GET'] + 200], 3)
+        self.assertEqual(totals[metrics.OTHER + 501], 3)
+        self.assertEqual(totals[metrics.SENT], 300)
+        self.assertEqual(totals[metrics.CONNECTIONS], 3)
+        self.assertEqual(totals[metrics.ACTIVE], 2)
+        self.assertIn(b'bistro_request_duration_seconds_bucket{le="0.0025"} 3\n',
+                m.render())
+
+    def test_range_requests(self):
+        with open('www/pic/a.png', 'rb') as f:
+            content = f.read()
+        size = str(len(content)).encode()
+        headers, body = self.exchange(b'GET /pic/a.png HTTP/1.1\r\n'
+                b'Range: bytes=100-199\r\n\r\n').split(b'\r\n\r\n', 1)
+        self.assertIn(b' 206 ', headers)
+        self.assertIn(b'Content-Range: bytes 100-199/' + size, headers)
+        self.assertEqual(body, content[100:200])
+        headers, body = self.exchange(b'GET /pic/a.png HTTP/1.1\r\n'
+                b'Range: bytes=0-9,-10\r\n\r\n').split(b'\r\n\r\n', 1)
+        boundary = re.search(br'boundary=(\w+)', headers).group(1)
+        parts = body.split(b'--' + boundary)
+        self.assertEqual(len(parts), 4)
+        self.assertTrue(parts[1].endswith(b'\r\n\r\n' + content[:10] + b'\r\n'))
+        self.assertTrue(parts[2].endswith(b'\r\n\r\n' + content[-10:] + b'\r\n'))
+        self.assertIn(b'Content-Length: ' + str(len(body)).encode(), headers)
+        received = self.exchange(b'GET /pic/a.png HTTP/1.1\r\n'
+                b'Range: bytes=' + size + b'-\r\n\r\n')
+        self.assertIn(b' 416 ', received)
+        self.assertIn(b'Content-Range: bytes */' + size, received)
+        # A stale If-Range validator gets the whole file
+        received = self.exchange(b'GET /pic/a.png HTTP/1.1\r\n'
+                b'Range: bytes=0-9\r\nIf-Range: "stale"\r\n\r\n')
+        self.assertIn(b' 200 ', received)
+        self.assertTrue(received.endswith(content))
+
+    def test_conditional_requests(self):
+        received = self.exchange(b'GET /index.html HTTP/1.1\r\n\r\n')
+        etag = re.search(br'ETag: (\S+)', received).group(1)
+        modified = re.search(br'Last-Modified: ([^\r]+)', received).group(1)
+        for headers, status in [(b'If-None-Match: ' + etag, b'304'),
+                (b'If-None-Match: "x", ' + etag[2:], b'304'),
+                (b'If-Modified-Since: ' + modified, b'304'),
+                (b'If-Modified-Since: Sat, 01 Jan 2000 00:00:00 GMT', b'200'),
+                (b'If-None-Match: "x"\r\nIf-Modified-Since: ' + modified, b'200')]:
+            with mock.patch('io.open', wraps=io.open) as open_file:
+                received = self.exchange(b'GET /index.html HTTP/1.1\r\n' +
+                        headers + b'\r\n\r\n')
+            self.assertIn(b' ' + status + b' ', received.split(b'\r\n', 1)[0])
+            if status == b'304':
+                self.assertEqual(open_file.call_count, 0)
+                self.assertTrue(received.endswith(b'\r\n\r\n'))
+                self.assertIn(b'ETag: ' + etag, received)
+
+    def test_compression(self):
+        with open('www/index.html', 'rb') as f:
+            content = f.read()
+        cfg = config.Config()
+        cfg.defaults()
+        cfg.set('COMPRESSION_MIN_SIZE', 0)
+        headers, body = self.exchange(b'GET /index.html HTTP/1.1\r\n'
+                b'Accept-Encoding: gzip, deflate\r\n\r\n', cfg).split(b'\r\n\r\n', 1)
+        self.assertIn(b'Content-Encoding: gzip', headers)
+        self.assertIn(b'Vary: Accept-Encoding', headers)
+        self.assertEqual(gzip.decompress(body), content)
+        headers, body = self.exchange(b'GET /index.html HTTP/1.1\r\n'
+                b'Accept-Encoding: gzip;q=0, identity\r\n\r\n', cfg).split(b'\r\n\r\n', 1)
+        self.assertNotIn(b'Content-Encoding', headers)
+        self.assertIn(b'Vary: Accept-Encoding', headers)
+        self.assertEqual(body, content)
+
+    def test_cgi_streaming(self):
+        cfg = config.Config()
+        cfg.defaults()
+        cfg.set('HTTP_VERSION', 1.1)
+        headers, body = self.exchange(b'GET /cgi-bin/stream.py HTTP/1.1\r\n'
+                b'Connection: close\r\n\r\n', cfg).split(b'\r\n\r\n', 1)
+        self.assertIn(b'Transfer-Encoding: chunked', headers)
+        self.assertNotIn(b'Content-Length', headers)
+        content = b''
+        while True:
+            size, body = body.split(b'\r\n', 1)
+            if int(size, 16) == 0: break
+            content += body[:int(size, 16)]
+            body = body[int(size, 16) + 2:]
+        self.assertEqual(body, b'\r\n')
+        self.assertEqual(content.splitlines()[-1], b'line 9')
+        # HTTP/1.0 clients get the output delimited by the closed connection
+        headers, body = self.exchange(b'GET /cgi-bin/stream.py HTTP/1.0\r\n'
+                b'\r\n', cfg).split(b'\r\n\r\n', 1)
+        self.assertNotIn(b'chunked', headers)
+        self.assertEqual(body, content)
+
+    def test_nonblocking_cgi(self):
+        conn, client = socket.socketpair()
+        conn.setblocking(False)
+        client.sendall(b'GET /cgi-bin/stream.py HTTP/1.1\r\n\r\n'
+                b'GET /index.html HTTP/1.1\r\n\r\n')
+        cfg = config.Config()
+        cfg.defaults()
+        cfg.set('HTTP_VERSION', 1.1)
+        self.handler = server.HttpHandler(conn, ('127.0.0.1', 0), cfg=cfg)
+        self.assertTrue(self.handler.handle())
+        # The script was started but nothing waits for its output
+        self.assertTrue(self.handler.paused())
+        self.assertEqual(self.handler.requests, 0)
+        while not self.handler.send() or self.handler.resume():
+            if self.handler.waiting() is not None:
+                select.select([self.handler.waiting().fd], [], [], 1)
+        conn.close()
+        received = b''
+        data = client.recv(65536)
+        while data:
+            received += data
+            data = client.recv(65536)
+        self.assertEqual(self.handler.requests, 2)
+        self.assertEqual(re.findall(br'HTTP/1\.[01] (\d{3}) ', received),
+                [b'200', b'200'])
+        self.assertIn(b'line 9\n\r\n0\r\n\r\n', received)
+        # A script that writes nothing for CGI_TIMEOUT seconds is killed
+        cfg.set('CGI_TIMEOUT', 0.05)
+        headers, body = self.exchange(b'GET /cgi-bin/stream.py HTTP/1.1\r\n'
+                b'\r\n', cfg).split(b'\r\n\r\n', 1)
+        self.assertIn(b'Transfer-Encoding: chunked', headers)
+        self.assertTrue(self.handler.close)
+        self.assertNotIn(b'0\r\n\r\n', body)
+        client.close()
+
+    def test_paused_input(self):
+        conn, client = socket.socketpair()
+        conn.setblocking(False)
+        client.setblocking(False)
+        request = b'GET /index.html HTTP/1.1\r\n\r\n'
+        sent = 0
+        try:
+            while sent < 1048576: sent += client.send(request * 1024)
+        except BlockingIOError:
+            pass
+        self.handler = server.HttpHandler(conn, ('127.0.0.1', 0))
+        parser = self.handler._parser
+        limit = parser.max_line + parser.max_header_size + \
+                self.handler.cfg.get('REQ_BUFFSIZE')
+        # A handler paused behind a CGI script reads at most about one
+        # request's worth of the pipelined input
+        with mock.patch.object(self.handler, 'paused', return_value=True):
+            for _ in range(10): self.assertTrue(self.handler.handle())
+            self.assertFalse(self.handler.reading())
+        self.assertLess(len(parser), limit)
+        self.assertGreater(sent, limit)
+        conn.close()
+        client.close()
+
+    def test_cgi_reaping(self):
+        # A script that closed its output and keeps running is not waited for
+        process = server.subprocess.Popen(['sh', '-c', 'exec >&-; sleep 10'],
+                stdout=server.subprocess.PIPE)
+        started = time.time()
+        server.CgiProcess(process).close()
+        self.assertLess(time.time() - started, 1)
+        self.assertIn(process, server.CgiProcess.unreaped)
+        process.kill()
+        deadline = time.time() + 5
+        while process in server.CgiProcess.unreaped and time.time() < deadline:
+            time.sleep(0.01)
+            server.CgiProcess.reap()
+        self.assertNotIn(process, server.CgiProcess.unreaped)
+        self.assertIsNotNone(process.returncode)
+
+    def test_cgi_pool(self):
+        srv = types.SimpleNamespace(cfg=config.Config(), cgi_pool=None)
+        srv.cfg.defaults()
+        srv.cfg.set('CGI_POOL_SIZE', 1)
+        server.CachesMixIn.setup_cgi_pool(srv)
+        try:
+            workers = list(srv.cgi_pool.workers)
+            for _ in range(3):
+                received = self.exchange(b'POST /cgi-bin/script.py HTTP/1.1\r\n'
+                        b'Content-Length: 11\r\n\r\nhello=world', srv=srv)
+                self.assertTrue(re.match(br'HTTP/1\.[01] 200 ', received))
+                self.assertIn(b'<p>hello=world</p>', received)
+                self.assertIn(b"'REQUEST_METHOD': 'POST'", received)
+            # The same worker served every request
+            self.assertEqual(srv.cgi_pool.workers, workers)
+            self.assertEqual(srv.cgi_pool.alive(), 1)
+        finally:
+            srv.cgi_pool.close()
+        self.assertFalse(os.path.exists(srv.cgi_pool.path))
+
+    def test_prefork_recycling(self):
+        root = tempfile.mkdtemp()
+        conf = os.path.join(root, 'server.conf')
+        with open(conf, 'w') as f:
+            f.write('[server]\nhost = 127.0.0.1\nport = 0\npublic_dir = {0}\n'
+                    'http_version = 1.1\nworkers = 1\nmax_requests = 5\n'
+                    .format(os.path.abspath('www')))
+        srv = server.ForkingServer(conf)
+        port = srv.socket.getsockname()[1]
+        pid = os.fork()
+        if pid == 0:
+            try:
+                srv.serve_persistent()
+            finally:
+                os._exit(0)
+        srv.socket.close()
+        def exchange(requests):
+            client = socket.create_connection(('127.0.0.1', port))
+            client.settimeout(5)
+            client.sendall(requests)
+            received = []
+            data = client.recv(65536)
+            while data:
+                received.append(data)
+                data = client.recv(65536)
+            client.close()
+            return b''.join(received)
+        try:
+            request = b'GET /index.html HTTP/1.1\r\n\r\n'
+            received = exchange(request * 8)
+            # The worker answers up to max_requests requests and the last
+            # response closes the connection
+            self.assertEqual(re.findall(br'HTTP/1\.1 (\d{3}) ', received),
+                    [b'200'] * 5)
+            self.assertEqual(re.findall(br'Connection: (\S+)\r\n', received),
+                    [b'keep-alive'] * 4 + [b'close'])
+            # Its replacement serves the next connection
+            received = exchange(request.replace(b'\r\n\r\n',
+                b'\r\nConnection: close\r\n\r\n'))
+            self.assertTrue(received.startswith(b'HTTP/1.1 200 '))
+        finally:
+            os.kill(pid, signal.SIGTERM)
+            os.waitpid(pid, 0)
+            shutil.rmtree(root)
+
+    def test_prefork_backoff(self):
+        root = tempfile.mkdtemp()
+        conf = os.path.join(root, 'server.conf')
+        with open(conf, 'w') as f:
+            f.write('[server]\nhost = 127.0.0.1\nport = 0\nworkers = 1\n')
+        srv = server.ForkingServer(conf)
+        spawned, output = os.pipe()
+        os.set_blocking(output, False)
+        def worker_loop():
+            # A worker that fails on startup
+            try:
+                os.write(output, b'.')
+            except BlockingIOError:
+                pass
+            raise RuntimeError('broken worker')
+        srv.worker_loop = worker_loop
+        pid = os.fork()
+        if pid == 0:
+            devnull = os.open(os.devnull, os.O_WRONLY)
+            os.dup2(devnull, 1)
+            os.dup2(devnull, 2)
+            try:
+                srv.serve_persistent()
+            finally:
+                os._exit(0)
+        srv.socket.close()
+        os.close(output)
+        try:
+            time.sleep(1)
+        finally:
+            os.kill(pid, signal.SIGTERM)
+            os.waitpid(pid, 0)
+            shutil.rmtree(root)
+        # Respawned after 0.1, 0.2 and 0.4 seconds rather than in a loop
+        self.assertLessEqual(len(os.read(spawned, 65536)), 5)
+        os.close(spawned)
+
+    def test_asyncio_protocol(self):
+        conn, client = socket.socketpair()
+        client.sendall(b'GET /index.html HTTP/1.1\r\n\r\n'
+                b'GET /pic/a.png HTTP/1.1\r\n\r\n'
+                b'GET /missing HTTP/1.1\r\nConnection: close\r\n\r\n')
+        loop = asyncio.new_event_loop()
+        try:
+            transport, protocol = loop.run_until_complete(
+                    loop.connect_accepted_socket(
+                        lambda: server.AsyncioHttpProtocol(None, loop), conn))
+            client.setblocking(False)
+            received = b''
+            data = None
+            while data != b'':
+                loop.run_until_complete(asyncio.sleep(0.001))
+                try:
+                    data = client.recv(65536)
+                    received += data
+                except BlockingIOError:
+                    pass
+        finally:
+            loop.close()
+            client.close()
+        self.assertEqual(protocol.handler.requests, 3)
+        self.assertEqual(re.findall(br'HTTP/1\.[01] (\d{3}) ', received),
+                [b'200', b'200', b'404'])
+        with open('www/pic/a.png', 'rb') as f:
+            self.assertIn(f.read(), received)
+
+    def test_asyncio_cgi(self):
+        # NOTE: CGI scripts get the client's address, which a socketpair lacks
+        listener = socket.create_server(('127.0.0.1', 0))
+        client = socket.create_connection(listener.getsockname())
+        conn = listener.accept()[0]
+        listener.close()
+        client.sendall(b'GET /cgi-bin/script.py HTTP/1.1\r\n\r\n' * 6 +
+                b'GET /cgi-bin/stream.py HTTP/1.1\r\n\r\n'
+                b'GET /index.html HTTP/1.1\r\nConnection: close\r\n\r\n')
+        srv = types.SimpleNamespace(cfg=config.Config(), cgi_pool=None)
+        srv.cfg.defaults()
+        srv.cfg.set('HTTP_VERSION', 1.1)
+        srv.cfg.set('OUTPUT_HIGH_WATER', 1024)
+        loop = asyncio.new_event_loop()
+        try:
+            transport, protocol = loop.run_until_complete(
+                    loop.connect_accepted_socket(
+                        lambda: server.AsyncioHttpProtocol(srv, loop), conn))
+            client.setblocking(False)
+            received = b''
+            data = None
+            deadline = time.time() + 10
+            while data != b'' and time.time() < deadline:
+                loop.run_until_complete(asyncio.sleep(0.001))
+                try:
+                    data = client.recv(65536)
+                    received += data
+                except BlockingIOError:
+                    pass
+        finally:
+            loop.close()
+            client.close()
+        # The output of the scripts drained from the output size, so that
+        # the requests after them were not held back
+        self.assertEqual(protocol.handler.requests, 8)
+        self.assertEqual(protocol.handler.output_size, 0)
+        self.assertEqual(re.findall(br'HTTP/1\.1 (\d{3}) ', received),
+                [b'200'] * 8)
+        self.assertIn(b'line 9\n\r\n0\r\n\r\n', received)
+
+    def test_partial_writes(self):
+        conn, client = socket.socketpair()
+        conn.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+        conn.setblocking(False)
+        client.sendall(b'GET /index.html HTTP/1.1\r\n\r\n' * 50)
+        self.handler = server.HttpHandler(conn, ('127.0.0.1', 0))
+        self.handler.high_water = 4096
+        self.assertTrue(self.handler.handle())
+        # Processing stops once the output is over the high-water mark
+        self.assertTrue(self.handler.paused())
+        self.assertLess(self.handler.requests, 50)
+        received = b''
+        while self.handler.requests < 50 or self.handler.pending():
+            if self.handler.send(): self.handler.resume()
+            else: self.assertIsInstance(self.handler._sending, memoryview)
+            received += client.recv(65536)
+        self.assertEqual(self.handler.output_size, 0)
+        conn.close()
+        data = client.recv(65536)
+        while data:
+            received += data
+            data = client.recv(65536)
+        client.close()
+        with open('www/index.html', 'rb') as f:
+            content = f.read()
+        self.assertEqual(received.count(content), 50)
+
+class StatsTest(unittest.TestCase):
+    def test_buffered_publishing(self):
+        channel = Stats.get_channel()
+        Stats.set_channel('test')
+        Stats.configure(size=4, interval=60)
+        try:
+            dropped = Stats.counters()['dropped']
+            for _ in range(6): Stats.set_count('127.0.0.1:1', 'recv', '+')
+            # Nothing is published from the request path
+            self.assertEqual(Stats.counters()['queued'], 4)
+            self.assertEqual(Stats.counters()['dropped'], dropped + 2)
+            Stats.flush()
+            self.assertEqual(Stats.counters()['queued'], 0)
+        finally:
+            Stats.configure(size=65536, interval=0.05)
+            Stats.set_channel(channel)
+
+    def test_sender_errors(self):
+        channel = Stats.get_channel()
+        Stats.set_channel('test')
+        Stats.configure(interval=0.01)
+        # NOTE: A running sender may still sleep for an earlier interval
+        Stats._start()
+        def queued():
+            deadline = time.time() + 5
+            while Stats.counters()['queued'] and time.time() < deadline:
+                time.sleep(0.01)
+            return Stats.counters()['queued']
+        try:
+            failed = Stats.counters()['failed']
+            # A batch that cannot be encoded is dropped
+            Stats.set_count('127.0.0.1:1', 'recv', '+')
+            with mock.patch('wire.encode', side_effect=ValueError('bad')):
+                self.assertEqual(queued(), 0)
+            self.assertEqual(Stats.counters()['failed'], failed + 1)
+            # Any other error is reported and publishing goes on
+            with mock.patch.object(Stats, 'r') as r, \
+                    mock.patch('traceback.print_exc') as print_exc:
+                r.publish.side_effect = RuntimeError('broken')
+                Stats.set_count('127.0.0.1:1', 'recv', '+')
+                deadline = time.time() + 5
+                while not print_exc.called and time.time() < deadline:
+                    time.sleep(0.01)
+                self.assertTrue(print_exc.called)
+            self.assertEqual(queued(), 0)
+            self.assertTrue(Stats._sender.is_alive())
+        finally:
+            Stats.configure(interval=0.05)
+            Stats.set_channel(channel)
+
+    def test_concurrent_latency(self):
+        published = []
+        def total():
+            n = 0
+            for message in published:
+                strings, events = wire.decode(message)
+                for event in events[events['op'] == wire.LATENCY]:
+                    n += Histogram.decode(strings[int(event['value'])]).total
+            return n
+        def record():
+            for i in range(20000):
+                Stats.set_latency('Test{0}/2xx'.format(i % 500), 0.001)
+        with mock.patch.object(Stats, 'r') as r:
+            r.publish.side_effect = lambda channel, message: \
+                    published.append(message)
+            Stats.flush()
+            del published[:]
+            # Histograms are added and recorded while flush() swaps them
+            recorder = threading.Thread(target=record)
+            recorder.start()
+            while recorder.is_alive(): Stats.flush()
+            recorder.join()
+            Stats.flush()
+        self.assertEqual(total(), 20000)
+
+    def test_concurrent_paths(self):
+        published = []
+        def record():
+            for i in range(20000):
+                Stats.set_path('/page/{0}?q=1'.format(i % 500))
+        with mock.patch.object(Stats, 'r') as r:
+            r.publish.side_effect = lambda channel, message: \
+                    published.append(message)
+            Stats.flush()
+            del published[:]
+            # Paths are added while flush() swaps and iterates the counts
+            recorder = threading.Thread(target=record)
+            recorder.start()
+            while recorder.is_alive(): Stats.flush()
+            recorder.join()
+            Stats.flush()
+        n = 0
+        for message in published:
+            strings, events = wire.decode(message)
+            n += int(events[events['op'] == wire.CODES['path']]['value'].sum())
+        self.assertEqual(n, 20000)
+
+    def test_array_store(self):
+        events = [(stats.Store.add_handler, 'a', 1.0),
+                (stats.Store.add_handler, 'b', 2.0),
+                (stats.Store.add_received, 'a', 3),
+                (stats.Store.add_success, 'a', 2),
+                (stats.Store.add_error, 'b', 1),
+                (stats.Store.add_handler, 'a', 4.0),
+                (stats.Store.close, 'a', 5.0),
+                (stats.Store.close, 'b', 8.0)]
+        store, arrays = stats.Store(), stats.ArrayStore(capacity=1)
+        for method, address, value in events:
+            method(store, address, value)
+            getattr(arrays, method.__name__)(address, value)
+        self.assertEqual(arrays.get_total(), store.get_total())
+        self.assertEqual(arrays.get_all(), store.get_all())
+        self.assertEqual(list(arrays.get_all_dtime()), store.get_all_dtime())
+        self.assertEqual(list(arrays.get_all_recv()), store.get_all_recv())
+        self.assertRaises(KeyError, arrays.add_received, 'c')
+        arrays.reset()
+        self.assertEqual(arrays.get_total()['handlers'], 0)
+
+    def test_wire_format(self):
+        h = Histogram()
+        h.record(1500)
+        events = [(('10.0.0.1', 1), 'register', 1.0),
+                (('10.0.0.1', 1), 'recv', 2),
+                (('10.0.0.1', 1), 'success', 1),
+                (('10.0.0.1', 1), 'error', 1),
+                (('10.0.0.2', 2), 'recv', 1), # never registered
+                (('10.0.0.1', 1), 't_close', 3.5),
+                ('ForkingServer/2xx', 'latency', h.encode())]
+        message = wire.encode(events)
+        strings, decoded = wire.decode(message)
+        self.assertEqual(len(decoded), len(events))
+        store, arrays = stats.Store(), stats.ArrayStore()
+        self.assertEqual(store.add_events(strings, decoded), 1)
+        self.assertEqual(arrays.add_events(strings, decoded), 1)
+        self.assertEqual(arrays.get_all(), store.get_all())
+        self.assertEqual(arrays.get_handler("('10.0.0.1', 1)", 'received'), 2)
+        self.assertEqual(arrays.get_latency().total, 1)
+        for bad in [message[:-1], b'BS\x02' + message[3:], message + b'x']:
+            self.assertRaises(ValueError, wire.decode, bad)
+        c = collector.Collector(mock.Mock(), ['statistics'])
+        for data in [message, message[:-3], b'no operation']:
+            c.work({'data': data})
+        self.assertEqual((c.invalid, c.rejected), (2, 1))
+        self.assertEqual(c.stats.get_total()['success'], 1)
+
+    def test_snapshot(self):
+        directory = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(directory, 'stats.snap')
+            store = stats.ArrayStore(capacity=2)
+            for i in range(5):
+                store.add_handler('a{0}'.format(i), float(i))
+                store.add_received('a{0}'.format(i), i)
+            store.close('a1', 9.0)
+            store.add_latency('ForkingServer/2xx', '12;12:1')
+            self.assertEqual(store.save(filename), 5)
+            # Only the changed and the new records are appended
+            store.add_success('a2')
+            store.add_handler('b', 10.0)
+            self.assertEqual(store.save(filename, append=True), 2)
+            loaded = stats.ArrayStore.load(filename)
+            self.assertEqual(loaded.get_all(), store.get_all())
+            self.assertEqual(loaded.get_latency().max, 12)
+            # Loaded stores keep collecting
+            loaded.add_received('b', 2)
+            loaded.add_handler('c', 11.0)
+            self.assertEqual(loaded.get_total()['received'], 12)
+            csv_file = os.path.join(directory, 'stats.csv')
+            self.assertEqual(loaded.export_csv(csv_file), 7)
+            with open(csv_file) as f:
+                lines = f.read().splitlines()
+            self.assertEqual(lines[0].split(',')[:3], ['address', 't_opened', 't_closed'])
+            self.assertEqual(lines[2], 'a1,1.0,9.0,1,0,0,0,1,0')
+            with open(filename, 'r+b') as f: f.truncate(100)
+            self.assertRaises(ValueError, stats.ArrayStore.load, filename)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_window_store(self):
+        series = stats.TimeSeries(((1, 10), (5, 4)))
+        for second in range(100, 130):
+            series.add('received', second - 99, second + 0.5)
+        # The current second is incomplete and left out
+        self.assertEqual(series.total('received', 1, 130.2), 30)
+        self.assertEqual(series.rate('received', 4, 130.2), 28.5)
+        # Longer windows come from the coarser ring; older periods are gone
+        self.assertEqual(series.total('received', 20, 130.2), sum(range(11, 31)))
+        self.assertEqual(series.total('received', 100, 130.2), sum(range(11, 31)))
+        self.assertEqual(series.total('received', 1, 150.2), 0)
+        store = stats.WindowStore()
+        now = time.time()
+        events = [(('10.0.0.1', 1), 'register', now),
+                (('10.0.0.2', 2), 'register', now),
+                (('10.0.0.1', 1), 'recv', 3),
+                (('10.0.0.1', 1), 'error', 1),
+                (('10.0.0.1', 1), 'bytes', 1000),
+                (('10.0.0.2', 2), 't_close', now)]
+        self.assertEqual(store.add_events(*wire.decode(wire.encode(events))), 0)
+        self.assertEqual(store.active, 1)
+        self.assertEqual(store.get_total()['handlers'], 2)
+        self.assertEqual(store.series.total('received', 60, now + 1), 3)
+        self.assertEqual(store.rate('bytes', 10, now + 1), 100)
+        self.assertEqual(store.get_all(), {})
+
+    def test_monitor(self):
+        store = monitor.MonitorStore()
+        now = time.time()
+        h = Histogram()
+        h.record(2500)
+        events = [(('10.0.0.1', 1), 'register', now - 2),
+                (('10.0.0.1', 1), 'recv', 1),
+                (('10.0.0.1', 1), 'bytes', 2048),
+                (('10.0.0.2', 7), 'recv', 1),
+                (('10.0.0.1', 2), 'recv', 1),
+                ('/index.html', 'path', 2),
+                ('/missing', 'path', 1),
+                ('ForkingServer/2xx', 'latency', h.encode())]
+        store.add_events(*wire.decode(wire.encode(events)))
+        dashboard = monitor.Dashboard(store, interval=1.0)
+        lines = dashboard.render(now, width=100, height=40)
+        clients = lines.index(next(l for l in lines if l.startswith('Top clients')))
+        self.assertTrue(lines[clients + 1].startswith('10.0.0.1 '))
+        self.assertIn('2.0 KiB', lines[clients + 1])
+        self.assertTrue(any(l.startswith('/index.html ') for l in lines))
+        self.assertTrue(any(l.startswith('ForkingServer/2xx ') for l in lines))
+        # Recent counts are taken by each refresh
+        self.assertEqual(store.take(), ({}, {}, {}))
+        self.assertEqual(store.get_total()['received'], 3)
+
+    def test_latency_histogram(self):
+        h = Histogram()
+        for value in range(1, 10001): h.record(value)
+        p50, p90, p99, p999 = h.percentiles()
+        # Buckets are within about 3% of their values
+        for p, value in [(p50, 5000), (p90, 9000), (p99, 9900), (p999, 9990)]:
+            self.assertTrue(value <= p <= value * 1.035, (p, value))
+        self.assertEqual(h.max, 10000)
+        other = Histogram()
+        other.record(20000, 10)
+        h.merge(other)
+        self.assertEqual(h.total, 10010)
+        self.assertEqual(h.percentile(100), 20000)
+        copy = Histogram.decode(h.encode())
+        self.assertEqual((copy.counts, copy.total, copy.max),
+                (h.counts, h.total, h.max))
+        self.assertRaises(ValueError, Histogram.decode, 'x;1:2')
+        store = stats.ArrayStore()
+        store.add_latency('ForkingServer/2xx', h.encode())
+        store.add_latency('ForkingServer/2xx', other.encode())
+        store.add_latency('AsyncServer/4xx', other.encode())
+        self.assertEqual(store.get_latency('ForkingServer').total, 10020)
+        self.assertEqual(store.get_latency(status='4xx').total, 10)
+        h.reset()
+        store.reset()
+        self.assertEqual(h.percentile(99), 0)
+        self.assertEqual(store.get_latency().total, 0)
+
 def test():
     unittest.main()
 
@@ -0,0 +1,85 @@
+""" Statistics wire format module
+
+Binary messages carrying a batch of statistics events, as published by
+interface.Stats on the statistics channel. A message is a header, a table of
+strings (addresses, and the encoded histograms of latency events) and
+fixed-size event records referring to it:
+
+    header  MAGIC, VERSION, number of strings, number of events
+    strings for each, its length (2 bytes) and UTF-8 bytes
+    events  for each, operation (1 byte), string index of the address
+            (2 bytes) and value (8-byte float; the string index of the
+            histogram for latency events)
+
+All numbers are little endian. Fixed-size records let the collector decode
+all events of a message at once into a NumPy array
+"""
+
+import struct
+import numpy
+
+__all__ = ["encode", "decode", "OPERATIONS"]
+
+MAGIC = b'BS'
+VERSION = 1
+
+# Operation codes are the positions in this list, counted from 1
+OPERATIONS = ['register', 'recv', 'success', 'error', 'not_modified',
+        't_open', 't_close', 'latency', 'bytes', 'path']
+CODES = dict((op, code) for code, op in enumerate(OPERATIONS, 1))
+LATENCY = CODES['latency']
+
+HEADER = struct.Struct('<2sBHH')
+STRING = struct.Struct('<H')
+EVENT = struct.Struct('<BHd')
+EVENTS = numpy.dtype([('op', '<u1'), ('addr', '<u2'), ('value', '<f8')])
+
+# Most events in one message, as string indexes have 2 bytes
+MAX_EVENTS = 32767
+
+
+def encode(events):
+    """returns a message with up to MAX_EVENTS (addr, op, value) events;
+addresses are sent as str(addr)"""
+    strings = {}
+    records = []
+    for addr, op, value in events:
+        key = str(addr)
+        index = strings.get(key)
+        if index is None: index = strings[key] = len(strings)
+        code = CODES[op]
+        if code == LATENCY:
+            value = strings.setdefault(value, len(strings))
+        records.append(EVENT.pack(code, index, value))
+    # NOTE: Request paths may hold undecodable bytes as surrogates
+    table = b''.join(STRING.pack(len(s)) + s
+            for s in (key.encode('utf-8', 'replace') for key in strings))
+    return HEADER.pack(MAGIC, VERSION, len(strings), len(records)) + table + \
+            b''.join(records)
+
+
+def decode(data):
+    """returns the strings and a structured array of the events (fields op,
+addr and value) of a message; raises ValueError if it is malformed or of
+another version"""
+    try:
+        magic, version, n_strings, n_events = HEADER.unpack_from(data)
+        if magic != MAGIC: raise ValueError("Not a statistics message")
+        if version != VERSION:
+            raise ValueError("Unsupported version {0}".format(version))
+        offset = HEADER.size
+        strings = []
+        for _ in range(n_strings):
+            length, = STRING.unpack_from(data, offset)
+            offset += STRING.size
+            if offset + length > len(data): raise ValueError("Truncated message")
+            strings.append(data[offset:offset + length].decode('utf-8'))
+            offset += length
+    except (struct.error, UnicodeDecodeError) as e:
+        raise ValueError(str(e))
+    if offset + n_events * EVENTS.itemsize != len(data):
+        raise ValueError("Message size does not match its header")
+    events = numpy.frombuffer(data, EVENTS, n_events, offset)
+    if n_events and events['addr'].max() >= n_strings:
+        raise ValueError("Invalid string index")
+    return strings, events
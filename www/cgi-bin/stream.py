@@ -0,0 +1,12 @@
+#!/usr/bin/env python
+import sys
+import time
+
+# Response without a Content-Length; the server streams it as it is written
+print("Content-Type: text/plain", end = "\r\n")
+print(end = "\r\n")
+sys.stdout.flush()
+for i in range(0, 10):
+    print("line {0}".format(i))
+    sys.stdout.flush()
+    time.sleep(0.1)